@@ -0,0 +1,6 @@
+"""
+Benchmarks for BottleSaml
+
+- fakeidp: a local, offline IdP minting signed SAMLResponses
+- bench_acs: '/saml/acs' throughput and per-stage latency
+"""
@@ -0,0 +1,226 @@
+"""
+ACS throughput benchmark
+
+Drives '/saml/acs' of a real Bottle app with SamlSP installed, using
+SAMLResponses minted by a local FakeIdP. Runs fully offline.
+
+    python -m benchmarks.bench_acs --requests 500 --attributes 40
+
+Reports requests per second, p50/p95/p99 latency, and a per-stage breakdown
+(form parse, validate_response, validate_requestID, login hooks, session close)
+collected through SamlSP's metrics= instrumentation surface.
+"""
+import argparse
+import io
+import json
+import pickle
+import sys
+import time
+from urllib.parse import urlencode
+
+from bottle import Bottle, request
+
+from BottleSaml import Metrics, SamlSP
+
+from .fakeidp import FakeIdP
+
+clock = time.perf_counter
+
+STAGES = ['session_open', 'form', 'precheck', 'validate', 'request_id', 'replay', 'issuer', 'hooks', 'session_close']
+
+
+class StubSessions:
+    """
+    Stand-in for BottleSessions
+
+    - open_session() attaches a fresh dict as request.session
+    - close_session() serializes the session, as a backing store would
+    """
+
+    def __init__(self):
+        self.saved = 0
+
+    def open_session(self):
+        session = {}
+        request.session = session
+        return session
+
+    def close_session(self, session):
+        pickle.dumps(session)
+        self.saved += 1
+
+
+class QuietLog:
+    """ Discards log output so the benchmark measures SamlSP, not stderr """
+
+    def info(self, *args, **kwargs):
+        pass
+
+    warn = debug = error = info
+
+
+class StageTimer(Metrics):
+    """ Collects durations per ACS stage """
+
+    def __init__(self):
+        self.samples = {stage: [] for stage in STAGES}
+
+    def stage(self, stage, seconds, outcome):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def reset(self):
+        for samples in self.samples.values():
+            samples.clear()
+
+
+def percentile(samples, pct):
+    """ Nearest-rank percentile of samples """
+
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def build_app(idp, idp_ok=True, attributes=(), log=None, metrics=None, **config):
+    """ Bottle app with SamlSP and a stub session manager """
+
+    app = Bottle()
+    sess = StubSessions()
+    config = idp.saml_config(idp_ok=idp_ok, assertions=list(attributes), **config)
+    saml = SamlSP(app, sess, saml_config=config, log=log, metrics=metrics)
+    return app, sess, saml
+
+
+def make_environ(body):
+    return {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/saml/acs',
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'sp.example.test',
+        'SERVER_PORT': '443',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.url_scheme': 'https',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)),
+    }
+
+
+def mint_bodies(idp, saml, count, attributes):
+    """ Pre-mint signed SAMLResponse POST bodies (signing is not measured) """
+
+    attr_values = {name: f'value of {name}' for name in attributes}
+    bodies = []
+    for n in range(count):
+        saml_resp = idp.saml_response(
+                saml.saml_audience,
+                name_id=f'user{n}@example.test',
+                in_response_to=saml.reqid.new_requestID(),
+                attributes=attr_values)
+        form = {'SAMLResponse': saml_resp, 'RelayState': urlencode({'next': '/home'})}
+        bodies.append(urlencode(form).encode('ascii'))
+    return bodies
+
+
+def run(app, bodies):
+    """ Drive the ACS with each body, returning per-request latencies and failures """
+
+    statuses = []
+
+    def start_response(status, headers, exc_info=None):
+        statuses.append(status)
+
+    latencies = []
+    for body in bodies:
+        environ = make_environ(body)
+        start = clock()
+        for _ in app(environ, start_response):
+            pass
+        latencies.append(clock() - start)
+
+    failures = sum(1 for status in statuses if not status.startswith('302'))
+    return latencies, failures
+
+
+def report(latencies, wall, failures, timer):
+
+    ms = 1000.0
+    result = {
+        'requests': len(latencies),
+        'failures': failures,
+        'rps': len(latencies) / wall if wall else 0.0,
+        'p50_ms': percentile(latencies, 50) * ms,
+        'p95_ms': percentile(latencies, 95) * ms,
+        'p99_ms': percentile(latencies, 99) * ms,
+        'stages': {},
+    }
+    for stage, samples in timer.samples.items():
+        result['stages'][stage] = {
+            'count': len(samples),
+            'mean_ms': (sum(samples) / len(samples)) * ms if samples else 0.0,
+            'p50_ms': percentile(samples, 50) * ms,
+            'p95_ms': percentile(samples, 95) * ms,
+        }
+    return result
+
+
+def print_report(result, file=sys.stdout):
+
+    print(f"requests  {result['requests']}  failures {result['failures']}", file=file)
+    print(f"rps       {result['rps']:.1f}", file=file)
+    print(f"latency   p50 {result['p50_ms']:.3f}ms  p95 {result['p95_ms']:.3f}ms  "
+          f"p99 {result['p99_ms']:.3f}ms", file=file)
+    print('stage                  count    mean_ms     p50_ms     p95_ms', file=file)
+    for stage, s in result['stages'].items():
+        print(f"{stage:<20} {s['count']:>7} {s['mean_ms']:>10.3f} {s['p50_ms']:>10.3f} "
+              f"{s['p95_ms']:>10.3f}", file=file)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='SamlSP ACS throughput benchmark')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured warmup requests')
+    parser.add_argument('--attributes', type=int, default=10, help='attributes per response')
+    parser.add_argument('--key-size', type=int, default=2048, help='IdP RSA key size')
+    parser.add_argument('--no-idp-ok', action='store_true',
+            help='validate request IDs (idp_ok False)')
+    parser.add_argument('--reqid-engine', default='fernet', choices=['fernet', 'hmac'],
+            help='request ID engine (with --no-idp-ok)')
+    parser.add_argument('--processes', type=int, default=0,
+            help='validate on this many worker processes (validate_processes)')
+    parser.add_argument('--stderr-log', action='store_true',
+            help="use SamlSP's default stderr logging")
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    idp = FakeIdP(key_size=args.key_size)
+    attributes = [f'http://schemas.example.test/claims/attribute{n}' for n in range(args.attributes)]
+
+    timer = StageTimer()
+    app, sess, saml = build_app(idp, idp_ok=not args.no_idp_ok, attributes=attributes,
+            log=None if args.stderr_log else QuietLog(), metrics=timer,
+            reqid_engine=args.reqid_engine, validate_processes=args.processes)
+
+    bodies = mint_bodies(idp, saml, args.warmup + args.requests, attributes)
+
+    run(app, bodies[:args.warmup])
+    timer.reset()
+
+    start = clock()
+    latencies, failures = run(app, bodies[args.warmup:])
+    wall = clock() - start
+
+    result = report(latencies, wall, failures, timer)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+AuthnRequest redirect benchmark
+
+Compares minisaml's get_request_redirect_url() with SamlSP's template based
+AuthnRequestBuilder, after checking both produce identical URLs.
+
+    python -m benchmarks.bench_redirect --number 20000
+"""
+import argparse
+import sys
+import time
+import timeit
+from urllib.parse import urlencode
+
+from minisaml.request import get_request_redirect_url
+
+from BottleSaml.authnreq import AuthnRequestBuilder
+from BottleSaml.reqID import ReqID
+
+ENDPOINT = 'https://idp.example.test/sso'
+ISSUER = 'https://sp.example.test/'
+ACS_URL = 'https://sp.example.test/saml/acs'
+
+
+def same_second(f):
+    """ Call f until it completes within one clock second (IssueInstant matches) """
+
+    while True:
+        start = int(time.time())
+        result = f()
+        if int(time.time()) == start:
+            return result
+
+
+def check_identical(builder, reqid, number=200):
+    """ Builder URLs are byte identical to minisaml's """
+
+    relay_states = [None, '', urlencode({'next': 'https://sp.example.test/a b?c=d&e=f#g'}),
+            urlencode({'next': '/café', 'x': ['1', '2']}, doseq=True),
+            # relay states as given, not urlencoded
+            'next=/x y', "!$'()*,;=+&%41#[]{}|\\^`\"<>", '/\t\n\x00\x7f', 'é€😀 %zz',
+            ''.join(map(chr, range(128)))]
+
+    for n in range(number):
+        request_id = reqid.new_requestID()
+        force = bool(n % 2)
+        relay_state = relay_states[n % len(relay_states)]
+
+        expected, got = same_second(lambda: (
+            get_request_redirect_url(saml_endpoint=ENDPOINT, expected_audience=ISSUER,
+                acs_url=ACS_URL, force_reauthentication=force,
+                request_id=request_id, relay_state=relay_state),
+            builder.redirect_url(request_id, force, relay_state)))
+
+        if expected != got:
+            raise AssertionError(f'URL mismatch:\n  minisaml {expected}\n  builder  {got}')
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='AuthnRequest redirect benchmark')
+    parser.add_argument('--number', type=int, default=20000, help='iterations per builder')
+    args = parser.parse_args(argv)
+
+    reqid = ReqID(idpok=False, engine='hmac')
+    builder = AuthnRequestBuilder(ENDPOINT, ISSUER, ACS_URL)
+    check_identical(builder, reqid)
+    print('output identical to minisaml')
+
+    request_id = reqid.new_requestID()
+    relay_state = urlencode({'next': 'https://sp.example.test/home'})
+
+    minisaml_us = timeit.timeit(lambda: get_request_redirect_url(
+            saml_endpoint=ENDPOINT, expected_audience=ISSUER, acs_url=ACS_URL,
+            request_id=request_id, relay_state=relay_state), number=args.number) / args.number * 1e6
+    builder_us = timeit.timeit(lambda: builder.redirect_url(request_id, False, relay_state),
+            number=args.number) / args.number * 1e6
+
+    print(f'minisaml  {minisaml_us:8.2f} us')
+    print(f'template  {builder_us:8.2f} us')
+    print(f'speedup   x{minisaml_us / builder_us:.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
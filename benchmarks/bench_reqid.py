@@ -0,0 +1,51 @@
+"""
+ReqID microbenchmark
+
+Compares the request ID engines on the issue (new_requestID) and
+validate (validate_requestID) paths.
+
+    python -m benchmarks.bench_reqid --number 20000
+"""
+import argparse
+import sys
+import timeit
+
+from BottleSaml.reqID import ReqID
+
+ENGINES = ['fernet', 'hmac']
+
+
+def bench(engine, number):
+    """ Mean microseconds per issue and per validate for engine """
+
+    reqid = ReqID(idpok=False, ttl=60, engine=engine)
+    ids = [reqid.new_requestID() for _ in range(number)]
+    assert all(reqid.validate_requestID(i) for i in ids[:100])
+
+    it = iter(ids)
+    issue = timeit.timeit(reqid.new_requestID, number=number) / number
+    validate = timeit.timeit(lambda: reqid.validate_requestID(next(it)), number=number) / number
+
+    return {'engine': engine, 'issue_us': issue * 1e6, 'validate_us': validate * 1e6,
+            'length': len(ids[0])}
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='ReqID engine microbenchmark')
+    parser.add_argument('--number', type=int, default=20000, help='iterations per path')
+    args = parser.parse_args(argv)
+
+    print('engine     issue_us  validate_us  length')
+    results = [bench(engine, args.number) for engine in ENGINES]
+    for r in results:
+        print(f"{r['engine']:<8} {r['issue_us']:>10.2f} {r['validate_us']:>12.2f} {r['length']:>7}")
+
+    base, fast = results
+    print(f"hmac speedup: issue x{base['issue_us'] / fast['issue_us']:.1f}, "
+          f"validate x{base['validate_us'] / fast['validate_us']:.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""
+FakeIdP - a local, offline SAML Identity Provider for benchmarks
+
+- Generates a throwaway RSA key and self-signed certificate
+- Mints signed SAMLResponses (the Assertion is signed) for a SamlSP to consume
+- Nothing here is suitable for anything but testing
+"""
+import base64
+import datetime
+from secrets import token_hex
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from lxml import etree
+from lxml.builder import ElementMaker
+from minisignxml.sign import sign
+
+SAMLP = 'urn:oasis:names:tc:SAML:2.0:protocol'
+SAML = 'urn:oasis:names:tc:SAML:2.0:assertion'
+MD = 'urn:oasis:names:tc:SAML:2.0:metadata'
+DS = 'http://www.w3.org/2000/09/xmldsig#'
+REDIRECT = 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect'
+
+samlp = ElementMaker(namespace=SAMLP, nsmap={'samlp': SAMLP})
+saml = ElementMaker(namespace=SAML, nsmap={'saml': SAML})
+md = ElementMaker(namespace=MD, nsmap={'md': MD, 'ds': DS})
+ds = ElementMaker(namespace=DS, nsmap={'ds': DS})
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def _saml_time(t):
+    return t.strftime(DATE_FORMAT)
+
+
+class FakeIdP:
+    """
+    Fake IdP minting signed SAMLResponses
+
+    idp = FakeIdP(issuer, key_size=2048)
+
+    issuer - the IdP's issuer (entity id)
+    key_size - RSA key size of the throwaway signing key
+    """
+
+    def __init__(self, issuer='https://idp.example.test/', key_size=2048):
+
+        self.issuer = issuer
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'FakeIdP')])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(self.key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=30))
+            .sign(self.key, hashes.SHA256())
+        )
+
+
+    @property
+    def certificate_pem(self):
+        """ The signing certificate as a PEM string (for saml_config) """
+
+        return self.certificate.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+
+    def saml_config(self, **kwargs):
+        """ A saml_config dict for a SamlSP trusting this IdP """
+
+        config = {
+            'saml_endpoint': 'https://idp.example.test/sso',
+            'issuer': self.issuer,
+            'spid': 'https://sp.example.test/',
+            'acs_url': 'https://sp.example.test/saml/acs',
+            'certificate': self.certificate_pem,
+        }
+        config.update(kwargs)
+        return config
+
+
+    def metadata_xml(self, endpoint='https://idp.example.test/sso'):
+        """ IdP metadata (bytes) describing this IdP """
+
+        der = self.certificate.public_bytes(serialization.Encoding.DER)
+        entity = md.EntityDescriptor(
+            md.IDPSSODescriptor(
+                md.KeyDescriptor(
+                    ds.KeyInfo(ds.X509Data(ds.X509Certificate(base64.b64encode(der).decode('ascii')))),
+                    use='signing'),
+                md.SingleSignOnService(Binding=REDIRECT, Location=endpoint),
+                protocolSupportEnumeration='urn:oasis:names:tc:SAML:2.0:protocol'),
+            entityID=self.issuer)
+        return etree.tostring(entity)
+
+
+    def response_xml(self, audience, name_id='user@example.test',
+            in_response_to=None, attributes=None, lifetime=300, issuer=None):
+        """
+        Build and sign a SAMLResponse document
+
+        - audience - the SP's entity id
+        - attributes - dict of name => value or list of values
+        - returns the serialized XML (bytes)
+        """
+
+        now = datetime.datetime.utcnow()
+        not_before = _saml_time(now - datetime.timedelta(seconds=60))
+        not_after = _saml_time(now + datetime.timedelta(seconds=lifetime))
+        issued = _saml_time(now)
+        issuer = issuer or self.issuer
+
+        confirmation = {'NotOnOrAfter': not_after}
+        if in_response_to:
+            confirmation['InResponseTo'] = in_response_to
+
+        statement = saml.AttributeStatement()
+        for name, values in (attributes or {}).items():
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            statement.append(saml.Attribute(
+                *[saml.AttributeValue(v) for v in values], Name=name))
+
+        assertion = saml.Assertion(
+            saml.Issuer(issuer),
+            saml.Subject(
+                saml.NameID(name_id),
+                saml.SubjectConfirmation(
+                    saml.SubjectConfirmationData(**confirmation),
+                    Method='urn:oasis:names:tc:SAML:2.0:cm:bearer'),
+            ),
+            saml.Conditions(
+                saml.AudienceRestriction(saml.Audience(audience)),
+                NotBefore=not_before, NotOnOrAfter=not_after),
+            saml.AuthnStatement(
+                saml.AuthnContext(saml.AuthnContextClassRef(
+                    'urn:oasis:names:tc:SAML:2.0:ac:classes:Password')),
+                AuthnInstant=issued, SessionNotOnOrAfter=not_after),
+            statement,
+            ID='_' + token_hex(16), Version='2.0', IssueInstant=issued,
+        )
+
+        resp_attrs = {'ID': '_' + token_hex(16), 'Version': '2.0', 'IssueInstant': issued}
+        if in_response_to:
+            resp_attrs['InResponseTo'] = in_response_to
+
+        samlp.Response(
+            saml.Issuer(issuer),
+            samlp.Status(samlp.StatusCode(Value='urn:oasis:names:tc:SAML:2.0:status:Success')),
+            assertion,
+            **resp_attrs
+        )
+
+        # signature goes after the assertion's Issuer
+        return sign(element=assertion, private_key=self.key,
+                certificate=self.certificate, index=1)
+
+
+    def saml_response(self, audience, **kwargs):
+        """ A base64 encoded SAMLResponse as POSTed to the ACS """
+
+        return base64.b64encode(self.response_xml(audience, **kwargs)).decode('ascii')
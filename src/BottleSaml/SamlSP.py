@@ -9,24 +9,32 @@ SamlSP - SAML2 Service Provider for Bottle
 
 - Assertion Control Service endpoint '/saml/acs' by default
 
+- A Bottle adapter over SamlCore (core.py), which does the SAML work
+  independent of the framework
+
 """
-import os
-import sys
 import time
-from urllib.parse import urlencode, parse_qs
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.x509 import load_pem_x509_certificate
-from minisaml.response import validate_response
-from minisaml.request import get_request_redirect_url
-from bottle import request, response
+from bottle import PluginError, request, response
+
+from .core import NO_CACHE_HEADERS, SamlCore
+from .paths import PathRules
+from .prometheus import CONTENT_TYPE
+
+clock = time.perf_counter
+
+# request.environ key memoizing is_authenticated for the request
+AUTHN_KEY = 'bottlesaml.authenticated'
+
+# request.environ key memoizing my_attrs (decoded) for the request
+ATTRS_KEY = 'bottlesaml.attrs'
 
-from .reqID import ReqID
 
 """
 SAML Service Provider module for Bottle
 
-saml = SamlSP(app, saml_config, log=None)
+saml = SamlSP(app, saml_config, log=None, metrics=None, replay_cache=None, keyring=None,
+            attr_store=None)
 
 - Creates an instance if the saml service provider authenticator
 
@@ -41,11 +49,57 @@ saml_config - Dict of SAML configuration parameters: (Required)
     'acs_url'           URL of our Assertion Control Service endpoint
     'user_attr'         SAML assertion to use for username (def: name_id)
     'auth_duration'     Number of seconds authentication considered valid (def: 3600)
+    'renew_window'      Renew a login passively this many seconds before it expires (def: None - never)
     'assertions'        A list of assertions to collect for attributes (def: None)
-    'certificate'        The IdP's public certificate for signing verification
+    'assertion_rules'   Dict of per-assertion rename/shape rules (def: None)
+    'attribute_map'     An AttrMapper spec run as the first login hook after ours (def: None)
+    'hook_budget'       Seconds allowed each login hook (def: None - unlimited)
+    'hook_budget_action' Over budget: 'log' a warning, or 'fail' the login (def: 'log')
+    'hook_workers'      Threads running budgeted and concurrent login hooks, per process (def: 8)
+    'acs_limit'         ACS requests in flight at once (def: None - no limit)
+    'acs_queue'         ACS requests that may wait for a slot (def: 0)
+    'acs_queue_wait'    Seconds a queued ACS request waits (def: 1.0)
+    'acs_retry_after'   Retry-After seconds for refused ACS requests (def: 5)
+    'validate_processes' Worker processes verifying SAMLResponses, 0 for inline (def: 0)
+    'validate_pending'  Validations queued or running at once (def: 2 per process)
+    'certificate'        The IdP's public certificate(s) for signing verification
+    'idps'              A list of dicts configuring further IdPs (def: [])
+    'idp_metadata'      IdP metadata file path(s) or https URL(s) configuring IdPs (def: None)
+    'idp_metadata_cache' Directory caching parsed metadata across restarts (def: None)
+    'idp_metadata_refresh' Seconds between metadata re-checks, 0 for never (def: 3600)
+    'replay_ttl'        Seconds a consumed request/assertion ID is remembered (def: 600)
+    'replay_max'        Maximum IDs remembered by the default replay cache (def: 100000)
+    'max_response_size' Largest ACS POST body accepted, in bytes (def: 102400)
+    'reqid_engine'      Request ID scheme when idp_ok is False: 'fernet' or 'hmac' (def: 'fernet')
+    'reqid_keyfile'     File of request ID secrets shared by worker processes (def: None)
+    'reqid_keyenv'      Environment variable of request ID secrets (def: None)
+    'reqid_rotate'      Seconds between request ID key rotations (def: None - never)
+    'authn_all_routes'  When installed as a plugin, require login on every route (def: True)
+    'authn_exempt'      Path prefixes not requiring login as a plugin (def: [])
+    'authn_protect'     Path prefixes requiring login as a plugin (def: [])
+    'session_encoding'  'full' attribute dicts, or 'compact' (see compact.py) in the session (def: 'full')
+    'session_schema'    Attribute names stored by index when compact (def: from assertions)
+    'session_compress'  Compact attributes over this many bytes are compressed (def: None - never)
+    'metrics_route'     Serve metrics.render() here - True for '/saml/metrics' (def: None)
 
 log -   A logger instance (Optional) 
-        default log is None - log to stderr
+        default log is None - a QueueLog: JSON lines to stderr, written
+        by a background thread
+
+metrics - A Metrics instance receiving ACS stage and login hook timings (Optional)
+        default metrics is None - timings are discarded
+        PrometheusMetrics counts logins and failures for a metrics_route
+
+replay_cache - A cache of consumed request and assertion IDs (Optional)
+        default replay_cache is None - an in-process MemoryReplayCache
+        use SqliteReplayCache or SharedMemoryReplayCache to share across workers
+
+keyring - A KeyRing of request ID keys (Optional)
+        default keyring is None - built from the reqid_key* config, or a
+        random key valid in this process only
+
+attr_store - An AttrStore keeping bulky attribute values out of the session (Optional)
+        default attr_store is None - all values are kept in the session
 """
 
 class SamlSP:
@@ -53,56 +107,56 @@ class SamlSP:
     name = 'SamlSP'     # Bottle Plugin API v2 required
     api = 2             # Bottle Plugin API v2 required
 
-    def __init__(self, app, sess, saml_config=None, log=None, **kwargs):
+    def __init__(self, app, sess, saml_config=None, log=None, metrics=None,
+            replay_cache=None, keyring=None, attr_store=None, **kwargs):
 
         config = saml_config
 
         # session manager
         self.sess = sess
-        
-        self.saml_endpoint = config['saml_endpoint']
-        self.saml_audience = config['spid']
-        self.saml_issuer = config['issuer']
-
-        # Optional 'ForceAuth' to IdP
-        self.force_reauth = config.get('force_reauth', False)
-
-        # This is SAML claim we use to set 'username'
-        self.attr_uid = config.get('user_attr', 'name_id')
-        
-        # A list of the SAML claims we will add to the session attribute
-        temp_attrs = config.get('assertions', [])
-        # Convert these all to lower case...
-        self.saml_attrs = [attr.lower() for attr in temp_attrs ]
-
-        # What our ACS URL is registered as with the IdP
-        self.acs_url = os.environ.get('ACS_ENDPOINT', config.get('acs_url'))
 
-        # Load IdP (public) certificate - use to validate assertions
-        self.saml_certificate = load_pem_x509_certificate(
-            config['certificate'].encode('utf-8'), default_backend())
+        # the SAML work - idps, reqid, replay_cache, login_hooks, metrics, log...
+        self.core = SamlCore(config, log=log, metrics=metrics,
+                replay_cache=replay_cache, keyring=keyring, attr_store=attr_store)
 
+        # Plugin: which routes require login (decided per route in apply())
         self.authn_all_routes = config.get('authn_all_routes', True)
 
-        # how long till we expire the auth?
-        self.auth_duration = config.get('auth_duration',3600)
-
-        self.log = log if log else _Log()
-
-        # login hooks - build_attrs_list must be first
-        self.login_hooks = [self.__build_attrs_list]
-
-        # Accept responses from IDP initiated requests
-        self.idp_ok = config.get('idp_ok', True)
-        
-        # Request ID generator/validator
-        self.reqid = ReqID(idpok=self.idp_ok, ttl=config.get('reqid_life',60))
+        # Plugin: path prefix rules - longest matching prefix decides
+        self.path_rules = PathRules(
+                protect=config.get('authn_protect', []),
+                exempt=config.get('authn_exempt', []),
+                default=self.authn_all_routes)
 
         # Install the Assertion Control Service (ACS) endpoint
         app.route('/saml/acs', name='ACS', 
                 callback=self.finish_saml_login, 
                 method=['POST'], 
                 skip=True)    # No middleware on this route
+
+        # Metrics in the Prometheus text format, if asked for
+        route = config.get('metrics_route')
+        if route:
+            self.mount_metrics(app, '/saml/metrics' if route is True else route)
+
+
+    def __getattr__(self, name):
+        """ SamlCore's settings and components, as saml.<name> """
+
+        if name == 'core':
+            raise AttributeError(name)
+        return getattr(self.core, name)
+
+
+    def __setattr__(self, name, value):
+        """ Set SamlCore's settings as saml.<name> = value, too """
+
+        core = self.__dict__.get('core')
+        if (core is not None and name not in self.__dict__
+                and not hasattr(type(self), name) and hasattr(core, name)):
+            setattr(core, name, value)
+        else:
+            object.__setattr__(self, name, value)
     
 
     @property
@@ -112,28 +166,43 @@ class SamlSP:
         - Return True iff:
             - request.session has a username
             - && the session has not expired
+        - Memoized for the request: the ACS and logout() reset it
         """
-        sess = request.session
+        environ = request.environ
 
-        try:
-            if sess['username'] and sess['attributes']['_saml']['expires'] >= int(time.time()):
-                return True
-        except:
-            pass   
+        authn = environ.get(AUTHN_KEY)
+        if authn is None:
+            # with an attr_store, the attributes resolved to tell are kept for my_attrs
+            authn, attrs = self.core.authenticate(request.session)
+            environ[AUTHN_KEY] = authn
+            if attrs is not None:
+                environ[ATTRS_KEY] = attrs
 
-        return False
+        return authn
     
 
     @property
     def my_attrs(self):
-        """ Return collected assertions for the current session. """
+        """
+        Return collected assertions for the current session.
+        - Full names, even if session_encoding is 'compact'
+        """
+
+        if not self.is_authenticated:
+            return {'status': 'unauthenticated'}
+
+        environ = request.environ
 
-        return request.session['attributes'] if self.is_authenticated else {'status': 'unauthenticated'}
+        attrs = environ.get(ATTRS_KEY)
+        if attrs is None:
+            attrs = environ[ATTRS_KEY] = self.core.session_attrs(request.session)
 
+        return attrs
 
-    def initiate_login(self, force_reauth=False, userhint=None, **kwargs):
+
+    def initiate_login(self, force_reauth=False, userhint=None, idp=None, **kwargs):
         """
-        saml.initiate_login(next, force_reauth, userhint, **kwargs) => Response
+        saml.initiate_login(next, force_reauth, userhint, idp, **kwargs) => Response
         
         - Builds and returns a SAMLRequest redirect to iDP to initiate login
 
@@ -143,36 +212,13 @@ class SamlSP:
 
             userhint - provides the IdP with username hint (optional)
 
+            idp - issuer of the IdP to log in with (optional, def: the default IdP)
+
             **kwargs - arguments added to relay state
         """
 
-        # Create a request id
-        request_id = self.reqid.new_requestID()
-
-        # encode relay state
-        relay_state = urlencode(kwargs, doseq=True) if kwargs else None
-        
-        # Build the URL with SAMLRequest
-        url = get_request_redirect_url(
-                saml_endpoint=self.saml_endpoint,
-                expected_audience = self.saml_audience,
-                acs_url = self.acs_url,
-                force_reauthentication = self.force_reauth or force_reauth,
-                request_id= request_id,
-                relay_state= relay_state
-            )
-
-        if userhint:
-            sep = '&' if '?' in url else '?'
-            url = url + sep + 'login_hint=' + userhint
-        
-        self.log.info(f'SAML: SP created authentication request {request_id}')
-
         # Redirect user to IdP
-        response.status = 302
-        response.set_header('Location', url)
-        set_no_cache_headers()
-        return ''
+        return send_reply(self.core.initiate_login(force_reauth, userhint, idp, **kwargs))
 
 
     # /saml/acs
@@ -180,11 +226,31 @@ class SamlSP:
         """
         Wrap session context for assertion control service
         """
-        session = self.sess.open_session()
+        metrics = self.metrics
 
-        ret = self.finish_saml_login_work(session)
-        
-        self.sess.close_session(session)
+        # Refuse at once over the in flight limit - before any session I/O
+        admission = self.core.admission
+        if admission is not None:
+            start = clock()
+            if not admission.enter():
+                metrics.stage('admission', clock() - start, 'fail')
+                return send_reply(self.core.busy())
+            metrics.stage('admission', clock() - start, 'ok')
+
+        try:
+            start = clock()
+            session = self.sess.open_session()
+            metrics.stage('session_open', clock() - start, 'ok')
+
+            ret = self.finish_saml_login_work(session)
+            
+            start = clock()
+            self.sess.close_session(session)
+            metrics.stage('session_close', clock() - start, 'ok')
+
+        finally:
+            if admission is not None:
+                admission.leave()
         
         return ret
 
@@ -196,207 +262,216 @@ class SamlSP:
             Post to saml._finish_saml_login()
 
         - invoked as POST by browser on response from IdP
-        - SAML response signing verified with IdP cert
-        - Issuer verified
-        - Claims gathered as attributes and optionally massaged with login_hooks
-        - first login hook moves attributes from saml_response to a dict
-        - attributes and username set into session object
+        - SamlCore.acs() validates it and logs in the session
         - redirect user to 'next' in RelayState or '/' if missing
 
         """ 
-        
-        if self.is_authenticated:
-            return AppError('ACS invoked for authenticated user')
 
-        relay_state = parse_qs(request.forms.get('RelayState',b''))
+        # the form is only read if the post isn't too large
+        reply = self.core.acs(session, lambda: request.forms,
+                content_length=request.content_length)
 
-        try:
-            raw_saml_resp = request.forms["SAMLResponse"]
+        self.__reset_authenticated()
+        return send_reply(reply)
 
-            saml_resp = validate_response(
-                    data=raw_saml_resp, 
-                    certificate = self.saml_certificate, 
-                    expected_audience = self.saml_audience
-                )
-            
-        except Exception as e:
-            msg = f'SAML: response_validation failed: {str(e)}'
-            self.log.info(msg)
-            #session.clear()
-            return BadRequestError(msg)
-            
-        self.log.info(f'SAML: ACS received SAMLResponse to {saml_resp.in_response_to}')
 
-        if self.reqid.validate_requestID(saml_resp.in_response_to) is False:
-            msg = f'SAML: Invalid Request: "{saml_resp.in_response_to}"'
-            self.log.info(msg)
+    def renew(self):
+        """
+        saml.renew() => Response
 
-            # If we're not allowing IdP initiated login,issue BadRequest
-            return BadRequestError(msg)
+        - Redirects the browser through a passive (IsPassive) login with the
+          IdP, renewing the session's login, and back to request.url
+        - The plugin and decorators call this on a page load within
+          renew_window of the login's expiry
+        """
 
-        # Validate this was from where we requested it
-        if saml_resp.issuer != self.saml_issuer:
-            msg = f'SAML: Issuer mismatch: rcvd "{saml_resp.issuer}" expected "{self.saml_issuer}"'
-            self.log.info(msg)
-            return ConflictError(msg)
+        return send_reply(self.core.start_renewal(request.session, request.url))
 
-        # First login hook will convert saml_resp to dict
-        username = saml_resp.name_id
-        attrs = saml_resp
 
-        try: 
-            # Run all the login hooks.
-            for login_hook in self.login_hooks:
-                username, attrs = login_hook(username, attrs)
+    def __renewal_due(self):
+        """ Renew on this request? Only a page load - never an XHR, fetch or POST """
 
-            # set the actual session values
-            session['attributes'] = attrs
-            session['username'] = username
+        return self.core.renew_window and is_page_load() and self.core.renewal_due(request.session)
 
-            self.log.info(f'SAML: User "{saml_resp.name_id}" authenticated')
-            
-        except Exception as e:
-            # failed hooks also fail the login
-            msg = f'SAML: login_hooks failed: {str(e)}'
-            self.log.info(msg)
-            session.clear()
-            return ForbiddenError(msg)
-
-        # Quo vidas?
-        if 'next' in relay_state:
-            url = relay_state['next'][0]
-        else:
-            url = '/'
 
-        self.log.info(f'SAML: Authenticated user {username} redirected to {url}')
+    def logout(self):
+        """
+        Log out the current session (locally - not a SAML Single Logout)
+
+        - clears the session, and the memoized is_authenticated
+        """
+
+        request.session.clear()
+        self.__reset_authenticated()
+
+
+    def __reset_authenticated(self):
+        """ The session changed: forget is_authenticated for this request """
+
+        request.environ.pop(AUTHN_KEY, None)
+        request.environ.pop(ATTRS_KEY, None)
+
+
+    def mount_metrics(self, app, path='/saml/metrics'):
+        """
+        Serve the metrics in the Prometheus text format at path on app
+
+        - metrics must render() them, like PrometheusMetrics
+        - the route skips all plugins: restrict it to the scraper upstream
+        """
+
+        if not hasattr(self.metrics, 'render'):
+            raise PluginError(f'SamlSP: metrics {type(self.metrics).__name__} can\'t render() for {path}')
+
+        app.route(path, name='SAML metrics',
+                callback=self.metrics_page,
+                method=['GET'],
+                skip=True)
 
-        # Redirect back to the url that initiated the login           
-        response.status = 302
-        response.add_header('Location', url)
+
+    def metrics_page(self):
+        """ The metrics route """
+
+        response.content_type = CONTENT_TYPE
         set_no_cache_headers()
-        return ''
+        return self.metrics.render()
 
 
-    def add_login_hook(self, f):
-        """ Add login hook Decorator """
-        
-        self.login_hooks.append(f)           
-        return f
+    def add_login_hook(self, f=None, budget=None, reads=None, writes=None):
+        """
+        Add login hook Decorator
 
+        - budget: seconds allowed this hook (def: hook_budget)
+        - reads, writes: attribute keys the hook reads and writes - declared
+          hooks that don't conflict run concurrently
+        - @saml.add_login_hook or @saml.add_login_hook(budget=0.5)
+        """
 
-    def require_login(self, f):
-        """ Require Login Decorator """
+        return self.core.add_login_hook(f, budget, reads, writes)
 
-        def wrapper(*args, **kwargs):
-            if self.is_authenticated:
-                return f(*args, **kwargs)
-            else:
-                return self.initiate_login(next=request.url)
-    
-        wrapper.__name__ = f.__name__
-        return wrapper
 
+    def setup(self, app):
+        """
+        Bottle Plugin API - app.install(saml)
 
-    def __build_attrs_list(self, username, saml_resp):
+        - only one SamlSP per app
         """
-        Build attribute list from SAML response.
-        
-        - This needs to be the first login hook
-        - creates dict to replace minisaml.SamlResponse
-        - items in self.attributes list are saved in the dict
-        - sets username to attribute self.attr_uid, or response 'nameid' 
-        - adds [_SAML] dict with authentication information
-        - returns updated username and atttribute dict
+
+        for plugin in app.plugins:
+            if isinstance(plugin, SamlSP) and plugin is not self:
+                raise PluginError('Only one SamlSP plugin per app is supported')
+
+
+    def apply(self, callback, route):
+        """
+        Bottle Plugin API - decide once per route if it requires login
+
+        - route config 'authn' (True/False) decides if present:
+            @app.route('/health', authn=False)
+        - else the path rules: longest authn_protect/authn_exempt prefix,
+          or authn_all_routes
+        - routes not requiring login get back the callback untouched
+        - only a route whose wildcards span differing path rules checks
+          the path on each request
         """
 
-        attrs = {}
-        for attr in saml_resp.attributes:
-            # we can deliver singles and lists 
-            # from what minisaml parsed
+        authn = self.route_requires_login(route)
 
-            if attr.name in self.saml_attrs:
-                
-                if len(attr.values)==1:
-                    # single value
-                    attrs[attr.name] = attr.values[0]
+        if authn is None:
+            return self.require_login_by_path(callback)
 
-                elif len(attr.values)>1:
-                    # list of values 
-                    attrs[attr.name] = attr.values
+        if authn:
+            return self.require_login(callback)
 
-                else:
-                    # no values found
-                    attrs[attr.name] = None
+        return callback
 
-        # prefered username or use the name_id
-        if self.attr_uid in attrs:
-            username = attrs[self.attr_uid]
-        
-        if not 'username' in attrs:
-            attrs['username'] = username
-
-        attrs['_saml'] = {
-            'name_id': saml_resp.name_id,
-            'request_id': saml_resp.in_response_to,
-            'issuer': saml_resp.issuer,
-            'audience': saml_resp.audience,
-            'expires': int(time.time()) + self.auth_duration
-        }
-            
-        return username, attrs
 
-def set_no_cache_headers():
-    """
-    Set various "no cache" headers for this response
-    """
+    def route_requires_login(self, route):
+        """
+        Does route require login under the plugin?
 
-    # MDN recommended for various browsers
-    response.add_header('Cache-Control', 'no-cache')
-    response.add_header('Cache-Control', 'must-revalidate')
-    response.add_header('Pragma', 'no-cache')
-    response.add_header('Expires', 'Sun, 25 Jul 2021 15:42:14 GMT')
+        - True or False, or None when it depends on the request path
+        """
+
+        authn = route.config.get('authn')
+        if authn is not None:
+            return bool(authn)
+
+        # the rule's static part decides, unless longer rules split it
+        rule = route.rule
+        wildcard = rule.find('<')
+        if wildcard < 0:
+            return self.path_rules.requires_login(rule)
 
+        return self.path_rules.decide(rule[:wildcard])
 
-def response_error(status=401, body='', hdrs=None):
-        response.status = status
-        response.headers.update({
-            'Cache-Control': 'no-cache',
-            'Pragma': 'no-cache',
-            'Expires': 'Sun, 25 Jul 2021 15:42:14 GMT'
-        })
-        return body
 
-def UnauthorizedError(body):
-    return response_error(status=401, body=body)
+    def require_login_by_path(self, f):
+        """ Require Login Decorator - if the path rules require it for request.path """
 
-def BadRequestError(body):
-    return response_error(status=400, body=body)
+        requires_login = self.path_rules.requires_login
 
-def AppError(body):
-    return response_error(status=400, body=body)
+        def wrapper(*args, **kwargs):
+            if requires_login(request.path):
+                if not self.is_authenticated:
+                    return self.initiate_login(next=request.url)
+                if self.__renewal_due():
+                    return self.renew()
+            return f(*args, **kwargs)
+
+        wrapper.__name__ = f.__name__
+        return wrapper
 
-def ConflictError(body):
-    return response_error(status=400, body=body)
 
-def ForbiddenError(body):
-    return response_error(status=403, body=body)
+    def require_login(self, f):
+        """ Require Login Decorator """
 
-class _Log:
+        def wrapper(*args, **kwargs):
+            if self.is_authenticated:
+                if self.__renewal_due():
+                    return self.renew()
+                return f(*args, **kwargs)
+            else:
+                return self.initiate_login(next=request.url)
+    
+        wrapper.__name__ = f.__name__
+        return wrapper
+
+
+def send_reply(reply):
+    """ Send a SamlCore Reply as bottle's response """
+
+    response.status = reply.status
+    for name, value in reply.headers():
+        response.add_header(name, value)
+    return reply.body
+
+
+def is_page_load():
     """
-    Mock logger - mocks flask's logger.
+    Is this request a top-level page load (safe to redirect through the IdP)?
+
+    - Sec-Fetch-Mode/Dest decide when the browser sends them, else a GET
+      accepting HTML, not marked X-Requested-With
     """
-    level = 'info'
 
-    def info(self, *args, **kwargs):
-        if self.level in ['info']:
-            print('INFO - ', *args, **kwargs, file=sys.stderr)
+    if request.method != 'GET':
+        return False
 
-    def warn(self, *args, **kwargs):
-        print('WARN', *args, **kwargs, file=sys.stderr)
+    headers = request.headers
+    mode = headers.get('Sec-Fetch-Mode')
+    if mode is not None:
+        return mode == 'navigate' and headers.get('Sec-Fetch-Dest', 'document') == 'document'
 
-    def debug(self, *args, **kwargs):
-        print('DEBUG', *args, **kwargs, file=sys.stderr)
+    return ('text/html' in headers.get('Accept', '')
+            and headers.get('X-Requested-With') is None)
 
-    def error(self, *args, **kwargs):
-        print('ERROR', *args, **kwargs, file=sys.stderr)
 
+def set_no_cache_headers():
+    """
+    Set various "no cache" headers for this response
+    """
+
+    # MDN recommended for various browsers
+    for name, value in NO_CACHE_HEADERS:
+        response.add_header(name, value)
@@ -1 +1,12 @@
 from .SamlSP import SamlSP
+from .attrstore import AttrStore, MemoryAttrBackend, SqliteAttrBackend
+from .compact import CompactAttrs
+from .core import Reply, SamlCore
+from .hooks import HookTimeout, LoginHooks, LoginRejected
+from .keyring import EnvKeys, FileKeys, KeyRing, KVKeys, LocalKV, new_secret
+from .log import QueueLog
+from .mapping import AttrMapper, MappingError
+from .metadata import IdPMetadata, MetadataError, parse_metadata
+from .metrics import Metrics, StatsMetrics
+from .prometheus import PrometheusMetrics
+from .replay import MemoryReplayCache, SqliteReplayCache, SharedMemoryReplayCache
@@ -0,0 +1,117 @@
+"""
+Admission - a limit on ACS requests in flight, with a short wait queue
+
+admission = Admission(limit=8, queue=16, wait=1.0, retry_after=5)
+
+if not admission.enter():
+    ... reply 503, Retry-After: admission.retry_after
+try:
+    ... the ACS
+finally:
+    admission.leave()
+
+- Up to limit requests run at once. Up to queue more wait, each at most
+  wait seconds, for one to finish. The rest are refused at once - a 503 now,
+  rather than a timeout after queueing behind expensive validations - so
+  ACS latency stays bounded and the app's other routes keep their workers.
+- enter_async() is enter() for asyncio: it waits without blocking the loop.
+"""
+import asyncio
+import threading
+import time
+
+
+class Admission:
+    """
+    limit - ACS requests in flight at once
+    queue - requests that may wait for a slot (def: 0 - refuse at once)
+    wait - seconds a queued request waits before it is refused
+    retry_after - seconds suggested to refused browsers (Retry-After)
+    """
+
+    def __init__(self, limit, queue=0, wait=1.0, retry_after=5):
+
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self.retry_after = retry_after
+
+        self.cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.refused = 0
+
+
+    def enter(self):
+        """ Take a slot, waiting if queued: False if refused """
+
+        with self.cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+
+            if self.waiting >= self.queue:
+                self.refused += 1
+                return False
+
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.wait
+                while self.active >= self.limit:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        self.refused += 1
+                        return False
+                    self.cond.wait(left)
+
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+
+    def try_enter(self):
+        """ Take a slot if one is free now """
+
+        with self.cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            return False
+
+
+    async def enter_async(self):
+        """ enter() for a coroutine: queued, it waits on the event loop """
+
+        if self.try_enter():
+            return True
+
+        with self.cond:
+            if self.waiting >= self.queue:
+                self.refused += 1
+                return False
+            self.waiting += 1
+
+        try:
+            deadline = time.monotonic() + self.wait
+            delay = 0.001
+            while time.monotonic() < deadline:
+                await asyncio.sleep(delay)
+                if self.try_enter():
+                    return True
+                delay = min(delay * 2, 0.05)
+        finally:
+            with self.cond:
+                self.waiting -= 1
+
+        with self.cond:
+            self.refused += 1
+        return False
+
+
+    def leave(self):
+        """ Give back a slot """
+
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
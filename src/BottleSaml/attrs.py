@@ -0,0 +1,118 @@
+"""
+AttrProjector - picks and shapes the SAML attributes saved in the session
+
+projector = AttrProjector(assertions, rules=None)
+attrs = projector.project(saml_resp.attributes)
+
+assertions - attribute names to keep, matched case-insensitively, and
+             saved under the name as configured here
+rules - optional dict of per-attribute rules, by name (any case):
+
+    {'http://schemas.microsoft.com/identity/claims/objectidentifier':
+            {'as': 'object_id', 'shape': 'single'},
+     'groups': {'shape': 'list'}}
+
+    'as'        the key to save the attribute under (def: the name as configured)
+    'shape'     'auto'   - one value as is, several as a list, none as None (def)
+                'single' - the first value, or None
+                'list'   - a list of the values, possibly empty
+
+A rule's attribute is kept even if it is not in assertions.
+
+- The plan (lowercased name => key, shape) is built once. Projecting is one
+  dict lookup per attribute received, however many are configured; the
+  lowercased form of each attribute name seen is remembered too.
+- An attribute is saved under the same key however the IdP spells its name,
+  so user_attr, the compact session schema and login hooks can rely on it.
+"""
+
+SHAPES = ('auto', 'single', 'list')
+
+# attribute names remembered per projector
+SEEN_MAX = 4096
+
+
+class AttrProjector:
+
+    def __init__(self, assertions=(), rules=None):
+
+        # lowercased name => (key, shape)
+        self.plan = {name.lower(): (name, 'auto') for name in assertions}
+
+        for name, rule in (rules or {}).items():
+            shape = rule.get('shape', 'auto')
+            if shape not in SHAPES:
+                raise ValueError(f'Attribute "{name}" shape "{shape}" not one of {SHAPES}')
+            self.plan[name.lower()] = (rule.get('as') or name, shape)
+
+        # received name => plan entry (or None) - skips lower() next time
+        self.seen = {}
+
+
+    def __contains__(self, name):
+
+        return name.lower() in self.plan
+
+
+    def __bool__(self):
+
+        return bool(self.plan)
+
+
+    def keys(self):
+        """ The keys attributes are saved under, in configured order """
+
+        return [key for key, shape in self.plan.values()]
+
+
+    def key(self, name):
+        """ The key the attribute name is saved under (name, if not planned) """
+
+        entry = self.plan.get(name.lower())
+        return entry[0] if entry else name
+
+
+    def __entry(self, name):
+
+        try:
+            return self.seen[name]
+        except KeyError:
+            entry = self.plan.get(name.lower())
+            if len(self.seen) < SEEN_MAX:
+                self.seen[name] = entry
+            return entry
+
+
+    def project(self, attributes):
+        """ Dict of the planned attributes, shaped, from minisaml's Attribute list """
+
+        attrs = {}
+        if not self.plan:
+            return attrs
+
+        for attr in attributes:
+            entry = self.__entry(attr.name)
+            if entry is None:
+                continue
+
+            key, shape = entry
+            values = attr.values
+
+            if shape == 'auto':
+                if len(values) == 1:
+                    # single value
+                    value = values[0]
+                elif values:
+                    # list of values
+                    value = values
+                else:
+                    # no values found
+                    value = None
+            elif shape == 'single':
+                value = values[0] if values else None
+            else:
+                value = list(values)
+
+            attrs[key] = value
+
+        return attrs
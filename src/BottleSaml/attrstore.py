@@ -0,0 +1,214 @@
+"""
+AttrStore - bulky attribute values kept out of the session, by content hash
+
+store = AttrStore(backend=None, threshold=1024, lru=256)
+saml = SamlSP(app, sess, saml_config, attr_store=store)
+
+- At login, each list attribute whose JSON is over threshold bytes is put
+  in the store under the digest of its content, and the session keeps only
+  the digest (in attributes['_refs']). Users with the same groups share
+  one stored copy, and the session shipped on every request stays small.
+- saml.my_attrs resolves the digests on first access in a request: from an
+  in-process LRU of lru values, else from the backend.
+- A session with a value no longer in the backend resolves as None, and is
+  logged: it is not authenticated, and the user logs in again (as with a
+  compact session under another schema). Keep the backend's ttl longer than
+  auth_duration.
+
+Backends (both bounded, and expiring values ttl seconds after their last put):
+- MemoryAttrBackend         in-process (default)
+- SqliteAttrBackend         a SQLite file shared by processes on a host
+or any object with get(digest) => bytes or None, and put(digest, data).
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+
+from .replay import SqliteTable
+
+# attributes key holding {name: digest} of stored values
+REFS = '_refs'
+
+
+def content_digest(data):
+    """ Digest naming stored content """
+
+    return blake2b(data, digest_size=16).hexdigest()
+
+
+class MemoryAttrBackend:
+    """
+    In-process attribute value store
+
+    backend = MemoryAttrBackend(ttl=7200, max_entries=10000)
+
+    - When full, the least recently put value is evicted.
+    """
+
+    def __init__(self, ttl=7200, max_entries=10000):
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, digest):
+
+        entry = self.entries.get(digest)
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry[0]
+
+
+    def put(self, digest, data):
+
+        with self.lock:
+            self.entries[digest] = (data, time.time() + self.ttl)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class SqliteAttrBackend(SqliteTable):
+    """
+    SQLite attribute value store - shared by every process opening the same file
+
+    backend = SqliteAttrBackend(path, ttl=7200, max_entries=100000)
+
+    - One connection per thread, WAL journal
+    - Expired values are purged every purge_every puts
+    """
+
+    table = 'attrs'
+    key = 'digest'
+    columns = 'digest TEXT PRIMARY KEY, data BLOB NOT NULL'
+
+    def __init__(self, path, ttl=7200, max_entries=100000):
+
+        super().__init__(path, ttl, max_entries)
+
+
+    def get(self, digest):
+
+        row = self._conn().execute('SELECT data FROM attrs WHERE digest = ? AND expires >= ?',
+                (digest, time.time())).fetchone()
+        return row[0] if row else None
+
+
+    def put(self, digest, data):
+
+        conn = self._conn()
+        now = time.time()
+
+        # the same content is the same digest: a put only extends its life
+        conn.execute('INSERT INTO attrs (digest, data, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT (digest) DO UPDATE SET expires = excluded.expires',
+                (digest, data, now + self.ttl))
+
+        self._wrote(now)
+
+
+class AttrStore:
+    """
+    backend - where values are stored (def: None - a MemoryAttrBackend)
+    threshold - list attributes with JSON over this many bytes are stored
+    lru - values held in this process
+    """
+
+    def __init__(self, backend=None, threshold=1024, lru=256):
+
+        self.backend = backend if backend is not None else MemoryAttrBackend()
+        self.threshold = threshold
+        self.lru_size = lru
+
+        # digest => (serialized value, when last put here): each get decodes
+        # its own copy, so no session sees another's changes
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def __remember(self, digest, data, put):
+
+        with self.lock:
+            self.lru[digest] = (data, put)
+            self.lru.move_to_end(digest)
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+
+    def put(self, value):
+        """ Store value: returns its digest """
+
+        data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        digest = content_digest(data)
+
+        # a value put recently needn't be put again to stay alive
+        now = time.time()
+        cached = self.lru.get(digest)
+        ttl = getattr(self.backend, 'ttl', None)
+        if cached is None or ttl is None or cached[1] < now - ttl / 2:
+            self.backend.put(digest, data)
+            self.__remember(digest, data, now)
+
+        return digest
+
+
+    def get(self, digest):
+        """ A copy of the value stored as digest, or None if gone """
+
+        cached = self.lru.get(digest)
+        if cached is not None:
+            with self.lock:
+                if digest in self.lru:
+                    self.lru.move_to_end(digest)
+            return json.loads(cached[0])
+
+        data = self.backend.get(digest)
+        if data is None:
+            return None
+        self.__remember(digest, data, 0.0)
+        return json.loads(data)
+
+
+    def externalize(self, attrs):
+        """ attrs with bulky list values replaced by digests in attrs['_refs'] """
+
+        refs = {}
+        for name, value in attrs.items():
+            if not isinstance(value, list) or name == REFS:
+                continue
+            try:
+                size = len(json.dumps(value, separators=(',', ':')))
+            except (TypeError, ValueError):
+                continue
+            if size > self.threshold:
+                refs[name] = self.put(value)
+
+        if not refs:
+            return attrs
+
+        attrs = {name: value for name, value in attrs.items() if name not in refs}
+        attrs[REFS] = refs
+        return attrs
+
+
+    def resolve(self, attrs, log=None):
+        """ attrs with the values of attrs['_refs'] put back, or None if one is gone """
+
+        refs = attrs.get(REFS)
+        if not refs:
+            return attrs
+
+        attrs = {name: value for name, value in attrs.items() if name != REFS}
+        for name, digest in refs.items():
+            value = self.get(digest)
+            if value is None:
+                if log:
+                    log.warn('SAML: attribute "%s" (%s) no longer in the attribute store', name, digest)
+                return None
+            attrs[name] = value
+
+        return attrs
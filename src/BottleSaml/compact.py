@@ -0,0 +1,152 @@
+"""
+CompactAttrs - a smaller session['attributes'], for session stores that ship
+the session on every request
+
+codec = CompactAttrs(schema, compress=None)
+session['attributes'] = codec.encode(attrs)
+attrs = codec.decode(session['attributes'])     # the full named dict again
+
+schema - attribute names, in a fixed order: each is stored as its index in
+         the list. Add names at the end - an index must keep its name while
+         sessions encoded with it are alive.
+compress - encoded attributes longer than this many bytes are zlib
+           compressed (def: None - never)
+
+Encoded (JSON compatible, for any session serializer):
+
+    {'v': schema fingerprint,
+     'x': _saml expires,
+     'm': {'n': name_id, 'r': request_id, 'i': issuer, 'a': audience},
+     'a': [index or name, value, index or name, value, ...]}
+or  'z': base64 of the zlib compressed JSON of that list, in place of 'a'
+
+- Names not in the schema are stored as themselves.
+- A session encoded under another schema (its fingerprint differs) decodes
+  as None, and is not authenticated: the user logs in again, rather than
+  getting attributes under the wrong names.
+- A full dict (a session from before compact encoding was configured)
+  decodes as itself.
+"""
+import base64
+import hashlib
+import json
+import zlib
+
+# _saml keys => short keys
+SAML_KEYS = {
+    'name_id': 'n',
+    'request_id': 'r',
+    'issuer': 'i',
+    'audience': 'a',
+}
+SAML_NAMES = {short: name for name, short in SAML_KEYS.items()}
+
+
+class CompactAttrs:
+
+    def __init__(self, schema, compress=None):
+
+        # drop repeats, keeping the first index
+        self.schema = list(dict.fromkeys(schema))
+        self.compress = compress
+
+        self.index = {name: i for i, name in enumerate(self.schema)}
+        self.fingerprint = hashlib.blake2b(
+                json.dumps(self.schema).encode('utf-8'), digest_size=4).hexdigest()
+
+
+    @classmethod
+    def from_config(cls, config, idps):
+        """
+        The codec for saml_config's session_* parameters, or None
+
+        - the schema is session_schema, or else 'username', each IdP's
+          assertions and assertion_rules keys, and the attribute_map's new
+          keys, in configured order
+        """
+
+        if config.get('session_encoding', 'full') == 'full':
+            return None
+        if config['session_encoding'] != 'compact':
+            raise ValueError(f'session_encoding "{config["session_encoding"]}" not one of (\'full\', \'compact\')')
+
+        schema = config.get('session_schema')
+        if schema is None:
+            schema = ['username']
+            for idp in idps:
+                schema.extend(idp.attr_names)
+            spec = config.get('attribute_map') or {}
+            schema.extend(spec.get('rename', {}).values())
+            for flags in spec.get('flatten', {}).values():
+                schema.extend(flags)
+            schema.extend(spec.get('member', {}))
+
+        return cls(schema, compress=config.get('session_compress'))
+
+
+    def encode(self, attrs):
+        """ The compact form of a login's attribute dict """
+
+        index = self.index
+        saml = attrs.get('_saml', {})
+
+        flat = []
+        for name, value in attrs.items():
+            if name == '_saml':
+                continue
+            flat.append(index.get(name, name))
+            flat.append(value)
+
+        encoded = {
+            'v': self.fingerprint,
+            'x': saml.get('expires', 0),
+            'm': {SAML_KEYS.get(name, name): value for name, value in saml.items() if name != 'expires'},
+        }
+
+        if self.compress is not None:
+            try:
+                packed = json.dumps(flat, separators=(',', ':')).encode('utf-8')
+            except (TypeError, ValueError):
+                # a login hook stored something JSON can't hold - leave it be
+                packed = b''
+            if len(packed) > self.compress:
+                encoded['z'] = base64.b64encode(zlib.compress(packed)).decode('ascii')
+                return encoded
+
+        encoded['a'] = flat
+        return encoded
+
+
+    def decode(self, encoded):
+        """ The full attribute dict, or None if encoded under another schema """
+
+        if '_saml' in encoded:
+            return encoded
+        if encoded.get('v') != self.fingerprint:
+            return None
+
+        if 'z' in encoded:
+            flat = json.loads(zlib.decompress(base64.b64decode(encoded['z'])))
+        else:
+            flat = encoded['a']
+
+        schema = self.schema
+        attrs = {}
+        for i in range(0, len(flat), 2):
+            key = flat[i]
+            attrs[schema[key] if isinstance(key, int) else key] = flat[i + 1]
+
+        saml = {SAML_NAMES.get(name, name): value for name, value in encoded['m'].items()}
+        saml['expires'] = encoded['x']
+        attrs['_saml'] = saml
+        return attrs
+
+
+    def expires(self, encoded):
+        """ When the login expires (0 if encoded under another schema) - without decoding """
+
+        if '_saml' in encoded:
+            return encoded['_saml']['expires']
+        if encoded.get('v') != self.fingerprint:
+            return 0
+        return encoded['x']
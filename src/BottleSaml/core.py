@@ -0,0 +1,801 @@
+"""
+SamlCore - the SAML service provider, independent of any web framework
+
+core = SamlCore(saml_config, log=None, metrics=None, replay_cache=None,
+                keyring=None, executor=None, attr_store=None)
+
+- Works on plain values: a session is a dict, the ACS POST is its body
+  (bytes) or its decoded fields (a dict), and each call returns a Reply
+  (status, location, body) for the framework to send.
+- initiate_login() / acs() run on the calling thread. initiate_login_async()
+  / acs_async() are coroutines for asyncio (ASGI) apps: every ACS step that
+  may block - signature verification, login hooks, and the replay cache and
+  attribute store (SQLite, say) - runs on executor (def: the loop's default
+  executor), so the event loop - not a thread per login - waits on them,
+  and the app's async session store.
+- saml_config, log, metrics, replay_cache, keyring and attr_store are as for SamlSP
+  (see SamlSP.py). SamlSP is the Bottle adapter over a SamlCore.
+- With renew_window configured, a session near expiry is renewed by a
+  passive (IsPassive) login: the framework asks core.renewal_due(session)
+  on a top-level page load, and replies core.start_renewal(session, url).
+  The IdP sends the browser straight back - logged in again, or refused
+  (NoPassive), in which case the session carries on until it expires.
+  Renewals are counted in core.renewals and reported to metrics.renewal():
+    'early'     renewed before the session expired
+    'late'      renewed after it expired, or a full login replaced a
+                session that expired before it could be renewed
+    'failed'    the IdP refused, or the response was rejected
+- With acs_limit configured, core.admission (an Admission) limits ACS
+  requests in flight: the caller takes a slot before opening the session,
+  and replies core.busy() (503) if refused.
+
+ASGI sketch:
+
+    core = SamlCore(saml_config)
+
+    async def acs(scope, receive, send):
+        if core.admission and not await core.admission.enter_async():
+            return await send_reply(send, core.busy())
+        try:
+            session = await my_sessions.load(scope)
+            reply = await core.acs_async(session, await read_body(receive))
+            await my_sessions.save(scope, session)
+        finally:
+            if core.admission:
+                core.admission.leave()
+        await send_reply(send, reply)
+"""
+import asyncio
+import math
+import os
+import time
+from collections import namedtuple
+from urllib.parse import parse_qs, urlencode
+
+
+from .admission import Admission
+from .compact import CompactAttrs
+from .hooks import LoginHooks, LoginRejected
+from .idp import IdPRegistry
+from .keyring import EnvKeys, FileKeys, KeyRing
+from .log import QueueLog
+from .mapping import AttrMapper
+from .metrics import Metrics
+from .peek import PeekError, peek_response
+from .replay import MemoryReplayCache
+from .reqID import ReqID
+from .validate import REJECTED, ProcessValidator, verify_response
+
+clock = time.perf_counter
+
+# session key of a renewal in flight: {'t': started, 'x': expires, 'next': url}
+RENEW_KEY = 'saml_renew'
+
+RENEWAL_OUTCOMES = ('early', 'late', 'failed')
+
+NO_CACHE_HEADERS = [
+    ('Cache-Control', 'no-cache'),
+    ('Cache-Control', 'must-revalidate'),
+    ('Pragma', 'no-cache'),
+    ('Expires', 'Sun, 25 Jul 2021 15:42:14 GMT'),
+]
+
+
+class Reply(namedtuple('Reply', 'status location body retry_after', defaults=(None,))):
+    """ What to send the browser: a redirect (302, location) or an error (status, body) """
+
+    def headers(self):
+        """ Response headers: no caching, Location for a redirect, Retry-After if busy """
+
+        headers = list(NO_CACHE_HEADERS)
+        if self.location is not None:
+            headers.append(('Location', self.location))
+        if self.retry_after is not None:
+            headers.append(('Retry-After', str(self.retry_after)))
+        return headers
+
+
+def redirect(url):
+    return Reply(302, url, '')
+
+
+def error(status, body):
+    return Reply(status, None, body)
+
+
+class SamlCore:
+
+    def __init__(self, saml_config, log=None, metrics=None, replay_cache=None,
+            keyring=None, executor=None, attr_store=None):
+
+        config = saml_config
+
+        # What our ACS URL is registered as with the IdP
+        self.acs_url = os.environ.get('ACS_ENDPOINT', config.get('acs_url'))
+
+        # IdPs by issuer - certificates and AuthnRequests prepared once
+        self.idps = IdPRegistry.from_config(config, acs_url=self.acs_url)
+
+        # Set: overrides every IdP's force_reauth (see the force_reauth property)
+        self.__force_reauth = None
+
+        # how long till we expire the auth?
+        self.auth_duration = config.get('auth_duration',3600)
+
+        # Opt-in: renew sessions this many seconds before they expire
+        self.renew_window = config.get('renew_window')
+        self.renewals = dict.fromkeys(RENEWAL_OUTCOMES, 0)
+
+        self.log = log if log else QueueLog()
+
+        # Keep IdPs configured by metadata current (a thread per process, started lazily)
+        self.idps.watch(self.log)
+
+        # ACS stage and login hook timings
+        self.metrics = metrics if metrics else Metrics()
+
+        # login hooks - build_attrs_list must be first. The built-in hooks
+        # are quick and local: exempt from hook_budget, on the request thread
+        self.login_hooks = LoginHooks([self.__build_attrs_list],
+                budget=config.get('hook_budget'),
+                on_budget=config.get('hook_budget_action', 'log'),
+                workers=config.get('hook_workers', 8))
+        self.login_hooks.exempt(self.__build_attrs_list)
+
+        # declarative attribute transforms - one pass, in place of hooks
+        if config.get('attribute_map'):
+            self.login_hooks.exempt(self.login_hooks.add(AttrMapper(config['attribute_map'])))
+
+        # Accept responses from IDP initiated requests
+        self.idp_ok = config.get('idp_ok', True)
+
+        # Larger ACS posts are rejected unread
+        self.max_response_size = config.get('max_response_size', 102400)
+
+        # Request ID keys - shared by worker processes if configured
+        if keyring is None:
+            if config.get('reqid_keyfile'):
+                source = FileKeys(config['reqid_keyfile'])
+            elif config.get('reqid_keyenv'):
+                source = EnvKeys(config['reqid_keyenv'])
+            else:
+                source = None
+            keyring = KeyRing(source, rotate=config.get('reqid_rotate'))
+
+        # Request ID generator/validator
+        self.reqid = ReqID(idpok=self.idp_ok, ttl=config.get('reqid_life',60),
+                engine=config.get('reqid_engine', 'fernet'), keyring=keyring)
+
+        # Consumed request and assertion IDs - rejects replayed responses
+        self.replay_cache = replay_cache if replay_cache is not None else MemoryReplayCache(
+                ttl=config.get('replay_ttl', 600),
+                max_entries=config.get('replay_max', 100000))
+
+        # Runs validation and login hooks for the async ACS
+        self.executor = executor
+
+        # Opt-in: a limit on ACS requests in flight
+        limit = config.get('acs_limit')
+        self.admission = Admission(limit,
+                queue=config.get('acs_queue', 0),
+                wait=config.get('acs_queue_wait', 1.0),
+                retry_after=config.get('acs_retry_after', 5)) if limit else None
+
+        # Opt-in: bulky attribute values kept out of the session
+        self.attr_store = attr_store
+
+        # Opt-in: session['attributes'] stored compactly
+        self.session_codec = CompactAttrs.from_config(config, self.idps)
+
+        # Opt-in: signature verification on worker processes
+        processes = config.get('validate_processes', 0)
+        self.validator = ProcessValidator(processes,
+                pending=config.get('validate_pending')) if processes else None
+
+
+    # The default IdP's settings - read from it, so current after a metadata refresh
+
+    @property
+    def saml_endpoint(self):
+        return self.idps.default.saml_endpoint
+
+    @property
+    def saml_audience(self):
+        return self.idps.default.audience
+
+    @property
+    def saml_issuer(self):
+        return self.idps.default.issuer
+
+    @property
+    def attr_uid(self):
+        return self.idps.default.attr_uid
+
+    @property
+    def saml_attrs(self):
+        return self.idps.default.saml_attrs
+
+    @property
+    def authn_request(self):
+        return self.idps.default.authn_request
+
+    @property
+    def saml_certificate(self):
+        return self.idps.default.certificate
+
+
+    @property
+    def force_reauth(self):
+        """ The default IdP's force_reauth, unless set here for every IdP """
+
+        if self.__force_reauth is not None:
+            return self.__force_reauth
+        return self.idps.default.force_reauth
+
+
+    @force_reauth.setter
+    def force_reauth(self, value):
+
+        self.__force_reauth = value
+
+
+    def busy(self):
+        """ The Reply refusing an ACS request over the admission limit """
+
+        msg = 'SAML: ACS busy, retry later'
+        self.log.info(msg)
+        return Reply(503, None, msg, self.admission.retry_after)
+
+
+    def is_authenticated(self, session):
+        """
+        Return True iff:
+            - session has a username
+            - && the session has not expired
+            - && (with an attr_store) its stored attribute values are still there
+        """
+
+        return self.authenticate(session)[0]
+
+
+    def authenticate(self, session):
+        """
+        core.authenticate(session) => (is_authenticated(session), attrs)
+
+        - attrs: session_attrs(session) if they were resolved to tell (with an
+          attr_store), else None - so a request needing both resolves them once
+        """
+
+        try:
+            if session['username'] and self.__expires(session) >= int(time.time()):
+                if self.attr_store is None:
+                    return True, None
+                attrs = self.session_attrs(session)
+                return attrs is not None, attrs
+        except:
+            pass
+
+        return False, None
+
+
+    def __expires(self, session):
+        """ When the session's login expires """
+
+        attrs = session['attributes']
+        if self.session_codec is not None:
+            return self.session_codec.expires(attrs)
+        return attrs['_saml']['expires']
+
+
+    def renewal_due(self, session):
+        """
+        Should session be renewed now?
+
+        - True iff renew_window is configured, session is authenticated and
+          expires within renew_window seconds, and no renewal was tried
+        """
+
+        if not self.renew_window or RENEW_KEY in session:
+            return False
+
+        try:
+            expires = self.__expires(session)
+        except Exception:
+            return False
+
+        now = int(time.time())
+        return bool(session.get('username')) and now <= expires <= now + self.renew_window
+
+
+    def start_renewal(self, session, next_url):
+        """
+        core.start_renewal(session, next_url) => Reply
+
+        - A passive (IsPassive) SAMLRequest redirect renewing session's login,
+          with the IdP that issued it, returning to next_url
+        """
+
+        try:
+            expires = self.__expires(session)
+        except Exception:
+            expires = 0
+
+        issuer = self.__saml_info(session).get('issuer')
+
+        session[RENEW_KEY] = {'t': time.time(), 'x': expires, 'next': next_url}
+        self.log.info('SAML: Renewing login of user "%s"', session.get('username'))
+
+        return self.initiate_login(idp=issuer if issuer in self.idps else None,
+                is_passive=True, next=next_url)
+
+
+    def __saml_info(self, session):
+        """ The login's '_saml' dict (name_id, issuer, ...): {} if there's none it can read """
+
+        attrs = session.get('attributes')
+        if attrs is None:
+            return {}
+        if self.session_codec is not None:
+            attrs = self.session_codec.decode(attrs) or {}
+        return attrs.get('_saml', {})
+
+
+    def session_attrs(self, session):
+        """
+        The login's attribute dict from session (decoding a compact one, resolving stored values)
+
+        - None if encoded under another schema, or a stored value is gone
+        """
+
+        attrs = session['attributes']
+        if self.session_codec is not None:
+            attrs = self.session_codec.decode(attrs)
+        if self.attr_store is not None and attrs is not None:
+            attrs = self.attr_store.resolve(attrs, self.log)
+        return attrs
+
+
+    def initiate_login(self, force_reauth=False, userhint=None, idp=None, is_passive=False, **kwargs):
+        """
+        core.initiate_login(force_reauth, userhint, idp, is_passive, **kwargs) => Reply
+
+        - A SAMLRequest redirect to the IdP to initiate login
+
+        - parameters:
+            force_reauth - When true, the IdP is requested to demand a full login
+                        (i.e. not an SSO session) (optional)
+
+            userhint - provides the IdP with username hint (optional)
+
+            idp - issuer of the IdP to log in with (optional, def: the default IdP)
+
+            is_passive - When true, the IdP must not interact with the user
+                        (optional - see start_renewal())
+
+            **kwargs - arguments added to relay state
+        """
+
+        start = clock()
+        idp = self.idps[idp] if idp else self.idps.default
+
+        # Create a request id
+        request_id = self.reqid.new_requestID()
+
+        # encode relay state
+        relay_state = urlencode(kwargs, doseq=True) if kwargs else None
+
+        # Build the URL with SAMLRequest
+        url = idp.authn_request.redirect_url(
+                request_id,
+                force_reauthentication = force_reauth or (idp.force_reauth
+                        if self.__force_reauth is None else self.__force_reauth),
+                relay_state = relay_state,
+                is_passive = is_passive
+            )
+
+        if userhint:
+            sep = '&' if '?' in url else '?'
+            url = url + sep + 'login_hint=' + userhint
+
+        self.metrics.stage('redirect', clock() - start, 'ok')
+        self.log.info('SAML: SP created authentication request %s', request_id)
+
+        return redirect(url)
+
+
+    async def initiate_login_async(self, force_reauth=False, userhint=None, idp=None, is_passive=False, **kwargs):
+        """ initiate_login() as a coroutine (it doesn't block) """
+
+        return self.initiate_login(force_reauth, userhint, idp, is_passive, **kwargs)
+
+
+    def acs(self, session, form, content_length=None):
+        """
+        core.acs(session, form, content_length) => Reply
+
+        Assertion Control Service: log in session from an IdP's POST
+
+        - session: the session dict - login sets 'username' and 'attributes'
+        - form: the POST body (bytes), its decoded fields (a dict), or a
+          callable returning either - called only once content_length
+          is within max_response_size
+        - content_length: the POST body's size, if known (def: a bytes
+          form's length) - else the SAMLResponse is checked once read
+        """
+
+        steps = self.__login(session, form, content_length)
+        try:
+            call = next(steps)
+            while True:
+                try:
+                    result = call[0](*call[1:])
+                except Exception as e:
+                    call = steps.throw(e)
+                else:
+                    call = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+
+    async def acs_async(self, session, form, content_length=None):
+        """
+        acs() as a coroutine - every step that may block runs on executor:
+        the session check, the replay cache, validation, login hooks and
+        the attribute store
+        """
+
+        loop = asyncio.get_running_loop()
+
+        steps = self.__login(session, form, content_length)
+        try:
+            call = next(steps)
+            while True:
+                try:
+                    result = await loop.run_in_executor(self.executor, *call)
+                except Exception as e:
+                    call = steps.throw(e)
+                else:
+                    call = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+
+    def __login(self, session, form, content_length):
+        """
+        The ACS steps, accounting for a renewal
+
+        - a renewal in flight may replace an authenticated session's login
+        - a failed renewal returns the browser to where it was going, with
+          the session as it was (unless a login hook rejected the user, or
+          the response was for another user or from another IdP)
+        """
+
+        renewal = session.get(RENEW_KEY)
+        renewing = renewal is not None and not renewal.get('failed')
+
+        # (an attr_store lookup)
+        authenticated = yield (self.is_authenticated, session)
+
+        # a login replacing one that lapsed without a renewal tried
+        lapsed = (bool(self.renew_window and session.get('username')) and renewal is None
+                and not authenticated)
+
+        reply = yield from self.__acs(session, form, content_length, authenticated, renewing)
+
+        succeeded = reply.location is not None
+        if renewing:
+            if succeeded:
+                outcome = 'early' if renewal['x'] >= int(time.time()) else 'late'
+            else:
+                outcome = 'failed'
+                if 'username' in session:
+                    session[RENEW_KEY] = dict(renewal, failed=True)
+                    reply = redirect(renewal.get('next') or '/')
+            self.__renewed(outcome, time.time() - renewal['t'])
+        elif lapsed and succeeded:
+            self.__renewed('late', None)
+
+        return reply
+
+
+    def __renewed(self, outcome, seconds):
+
+        self.renewals[outcome] += 1
+        self.metrics.renewal(outcome, seconds)
+        self.log.info('SAML: Login renewal %s', outcome)
+
+
+    def __acs(self, session, form, content_length, authenticated, renewing=False):
+        """
+        The ACS, as steps
+
+        - yields its blocking calls, (f, *args), for acs() or acs_async()
+          to make and send back the result (or throw the exception)
+        - returns the Reply
+
+        - IdP found from the response's issuer
+        - SAML response signing verified with IdP cert
+        - Issuer verified
+        - Claims gathered as attributes and optionally massaged with login_hooks
+        - first login hook moves attributes from saml_response to a dict
+        - attributes and username set into session object
+        - redirect user to 'next' in RelayState or '/' if missing
+        """
+
+        if authenticated and not renewing:
+            return error(400, 'ACS invoked for authenticated user')
+
+        metrics = self.metrics
+
+        start = clock()
+        if content_length is None and isinstance(form, (bytes, bytearray)):
+            content_length = len(form)
+
+        too_large = f'SAML: response_validation failed: SAMLResponse exceeds {self.max_response_size} bytes'
+        if (content_length or 0) > self.max_response_size:
+            metrics.stage('form', clock() - start, 'fail')
+            self.log.info(too_large)
+            return error(400, too_large)
+
+        fields = _fields(form)
+        relay_state = parse_qs(fields.get('RelayState') or '')
+        raw_saml_resp = fields.get('SAMLResponse')
+
+        if raw_saml_resp is None:
+            metrics.stage('form', clock() - start, 'fail')
+            msg = 'SAML: response_validation failed: no SAMLResponse'
+            self.log.info(msg)
+            return error(400, msg)
+
+        # a body of unknown size (no Content-Length) is checked once read
+        if len(raw_saml_resp) > self.max_response_size:
+            metrics.stage('form', clock() - start, 'fail')
+            self.log.info(too_large)
+            return error(400, too_large)
+
+        metrics.stage('form', clock() - start, 'ok')
+
+        # Cheap reject of junk and replays before any crypto
+        start = clock()
+        try:
+            peek, idp = yield (self.__precheck, raw_saml_resp)
+
+        except PeekError as e:
+            metrics.stage('precheck', clock() - start, 'fail')
+            msg = f'SAML: response_validation failed: {str(e)}'
+            self.log.info(msg)
+            return error(400, msg)
+
+        metrics.stage('precheck', clock() - start, 'ok')
+
+        start = clock()
+        try:
+            saml_resp, assertion_id, expires = yield (self.validate, raw_saml_resp, idp)
+
+        except Exception as e:
+            metrics.stage('validate', clock() - start, 'fail' if isinstance(e, REJECTED) else 'error')
+            msg = f'SAML: response_validation failed: {str(e)}'
+            self.log.info(msg)
+            #session.clear()
+            return error(400, msg)
+
+        metrics.stage('validate', clock() - start, 'ok')
+
+        self.log.info('SAML: ACS received SAMLResponse to %s', saml_resp.in_response_to)
+
+        start = clock()
+        if self.reqid.validate_requestID(saml_resp.in_response_to) is False:
+            metrics.stage('request_id', clock() - start, 'fail')
+            msg = f'SAML: Invalid Request: "{saml_resp.in_response_to}"'
+            self.log.info(msg)
+
+            # If we're not allowing IdP initiated login,issue BadRequest
+            return error(400, msg)
+
+        metrics.stage('request_id', clock() - start, 'ok')
+
+        # Consume the IDs - a concurrent replay loses this race
+        # (the verified Assertion's ID - not one the precheck scan found -
+        # kept at least until the Assertion expires)
+        start = clock()
+        replay_keys = ['aid:' + assertion_id]
+        if saml_resp.in_response_to:
+            replay_keys.append('rid:' + saml_resp.in_response_to)
+
+        ttl = math.ceil(expires - time.time())
+        if not (yield (self.__consume, replay_keys, ttl)):
+            metrics.stage('replay', clock() - start, 'fail')
+            msg = f'SAML: Replayed SAMLResponse to "{saml_resp.in_response_to}" rejected'
+            self.log.info(msg)
+            return error(400, msg)
+
+        metrics.stage('replay', clock() - start, 'ok')
+
+        # Validate this was from where we requested it
+        start = clock()
+        if saml_resp.issuer != idp.issuer:
+            metrics.stage('issuer', clock() - start, 'fail')
+            msg = f'SAML: Issuer mismatch: rcvd "{saml_resp.issuer}" expected "{idp.issuer}"'
+            self.log.info(msg)
+            return error(400, msg)
+
+        # A renewal logs the same user in again, with the same IdP: a response
+        # for anyone else (even IdP initiated) mustn't take over the session
+        if renewing:
+            saml = self.__saml_info(session)
+            if (saml_resp.name_id, saml_resp.issuer) != (saml.get('name_id'), saml.get('issuer')):
+                metrics.stage('issuer', clock() - start, 'fail')
+                msg = (f'SAML: Renewal of "{saml.get("name_id")}" from "{saml.get("issuer")}" '
+                       f'answered for "{saml_resp.name_id}" from "{saml_resp.issuer}"')
+                self.log.info(msg)
+                session.clear()
+                return error(403, msg)
+
+        metrics.stage('issuer', clock() - start, 'ok')
+
+        # First login hook will convert saml_resp to dict
+        username = saml_resp.name_id
+        attrs = saml_resp
+
+        hooks_start = clock()
+        try:
+            # Run all the login hooks.
+            username, attrs = yield (self.login_hooks.run, username, attrs, metrics, self.log)
+
+            # set the actual session values
+            if self.attr_store is not None:
+                attrs = yield (self.attr_store.externalize, attrs)
+            if self.session_codec is not None:
+                session['attributes'] = self.session_codec.encode(attrs)
+            else:
+                session['attributes'] = attrs
+            session['username'] = username
+            session.pop(RENEW_KEY, None)
+
+            self.log.info('SAML: User "%s" authenticated', saml_resp.name_id)
+
+        except Exception as e:
+            metrics.stage('hooks', clock() - hooks_start, 'fail' if isinstance(e, LoginRejected) else 'error')
+            # failed hooks also fail the login
+            msg = f'SAML: login_hooks failed: {str(e)}'
+            self.log.info(msg)
+            session.clear()
+            return error(403, msg)
+
+        metrics.stage('hooks', clock() - hooks_start, 'ok')
+
+        # Quo vidas?
+        if 'next' in relay_state:
+            url = relay_state['next'][0]
+        else:
+            url = '/'
+
+        self.log.info('SAML: Authenticated user %s redirected to %s', username, url)
+
+        # Redirect back to the url that initiated the login
+        return redirect(url)
+
+
+    def validate(self, raw_saml_resp, idp):
+        """
+        Verify the SAMLResponse's signature and audience for idp
+
+        - returns the minisaml Response, and the verified Assertion's ID
+          and expiry (its NotOnOrAfter, epoch seconds)
+        """
+
+        if self.validator is not None:
+            saml_resp, assertion_id, expires = self.validator.validate(raw_saml_resp, idp)
+        else:
+            saml_resp, assertion_id, expires = verify_response(
+                    raw_saml_resp, idp.certificates, idp.audience)
+        idp.certificates.hit(saml_resp.certificate)
+        return saml_resp, assertion_id, expires
+
+
+    def __consume(self, keys, ttl):
+        """ Add keys to the replay cache: False if any was there already """
+
+        return all([self.replay_cache.add(key, ttl) for key in keys])
+
+
+    def __precheck(self, raw_saml_resp):
+        """
+        Pre-validation: reject a SAMLResponse that can't succeed
+
+        - well formed base64, with Issuer and Assertion elements
+        - an Issuer matching one of our IdPs (with a single IdP, unless
+          the scan couldn't read one)
+        - InResponseTo in our request ID format
+        - no Assertion ID already consumed
+        - raises PeekError, returns the Peek and the IdP
+        """
+
+        peek = peek_response(raw_saml_resp)
+
+        idps = self.idps
+        for issuer in peek.issuers:
+            idp = idps.get(issuer)
+            if idp is not None:
+                break
+        else:
+            if len(idps) == 1 and not all(peek.issuers):
+                idp = idps.default
+            else:
+                raise PeekError(f'Unknown Issuer: "{peek.issuers[0]}"')
+
+        in_response_to = peek.in_response_to or [None]
+        if not all(self.reqid.well_formed(reqid) for reqid in in_response_to):
+            raise PeekError(f'Invalid Request: "{in_response_to[0]}"')
+
+        if any(('aid:' + aid) in self.replay_cache for aid in peek.assertion_ids):
+            raise PeekError('Replayed SAMLResponse rejected')
+
+        return peek, idp
+
+
+    def add_login_hook(self, f=None, budget=None, reads=None, writes=None):
+        """
+        Add login hook Decorator
+
+        - budget: seconds allowed this hook (def: hook_budget)
+        - reads, writes: attribute keys the hook reads and writes - declared
+          hooks that don't conflict run concurrently
+        - @core.add_login_hook or @core.add_login_hook(budget=0.5)
+        """
+
+        if f is None:
+            return lambda f: self.login_hooks.add(f, budget, reads, writes)
+
+        return self.login_hooks.add(f, budget, reads, writes)
+
+
+    def __build_attrs_list(self, username, saml_resp):
+        """
+        Build attribute list from SAML response.
+
+        - This needs to be the first login hook
+        - creates dict to replace minisaml.SamlResponse
+        - items in the IdP's assertions list (and assertion_rules) are saved
+          in the dict, matched case-insensitively, renamed and shaped
+        - sets username to the IdP's attribute attr_uid, or response 'nameid'
+        - adds [_SAML] dict with authentication information
+        - returns updated username and atttribute dict
+        """
+
+        # the issuer was verified by the ACS
+        idp = self.idps.get(saml_resp.issuer, self.idps.default)
+
+        # we can deliver singles and lists
+        # from what minisaml parsed
+        attrs = idp.attr_projector.project(saml_resp.attributes)
+
+        # prefered username or use the name_id
+        if idp.attr_uid in attrs:
+            username = attrs[idp.attr_uid]
+
+        if not 'username' in attrs:
+            attrs['username'] = username
+
+        attrs['_saml'] = {
+            'name_id': saml_resp.name_id,
+            'request_id': saml_resp.in_response_to,
+            'issuer': saml_resp.issuer,
+            'audience': saml_resp.audience,
+            'expires': int(time.time()) + self.auth_duration
+        }
+
+        return username, attrs
+
+
+def _fields(form):
+    """ The ACS POST's fields, as a dict of strings """
+
+    if callable(form):
+        form = form()
+
+    if isinstance(form, (bytes, bytearray)):
+        form = {name: values[0] for name, values in
+                parse_qs(form.decode('latin-1'), keep_blank_values=True).items()}
+
+    return form
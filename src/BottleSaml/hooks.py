@@ -0,0 +1,365 @@
+"""
+LoginHooks - the login hook pipeline, timed and held to time budgets
+
+hooks = LoginHooks(budget=None, on_budget='log')
+hooks.add(f, budget=None, reads=None, writes=None)
+username, attrs = hooks.run(username, attrs, metrics, log)
+
+- Hooks run in the order added. Each is timed and reported to
+  metrics.hook(name, seconds, outcome) with outcome:
+    'ok'        returned normally
+    'slow'      returned, but over its budget (on_budget 'log')
+    'fail'      rejected the login (raised LoginRejected, e.g. MappingError)
+    'error'     raised any other exception
+    'timeout'   over its budget, abandoned (on_budget 'fail')
+- A hook's budget is seconds (def: the pipeline's budget, None for none).
+  Over budget, on_budget 'log' logs a warning; 'fail' fails the login
+  without waiting for the hook: budgeted hooks then run on a small thread
+  pool, so a stalled downstream (LDAP, a database) costs each login at most
+  the budget rather than piling up ACS requests. Such hooks run off the
+  request thread - they can't use bottle's request or response.
+- exempt(f) takes a hook out of the pipeline budget: it runs on the
+  request thread, untimed out (SamlCore's built-in hooks are exempt).
+- The budget runs from when the hook starts on the pool. A hook still
+  queued for a thread after its budget is cancelled, so a login waits at
+  most twice the budget.
+- A running hook can't be stopped: abandoned over budget, it holds its pool
+  thread until it returns. So that one stalled hook can't take every
+  thread, a hook with max_stalled calls abandoned and still running fails
+  logins at once ('timeout') until one of them returns.
+
+Concurrent hooks:
+- A hook added with reads and writes (attribute keys; 'username' for the
+  username) declares it touches nothing else. Consecutive declared hooks
+  that don't conflict - neither writes what the other reads or writes -
+  run at the same time on the thread pool, each with its own copy of the
+  attributes. Their writes are then merged in the order the hooks were
+  added, so the result doesn't depend on which finished first.
+- A hook without declarations runs alone, seeing every earlier hook's
+  results, as before.
+- A hook may be a coroutine function; it is run to completion with asyncio.
+"""
+import asyncio
+import inspect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+clock = time.perf_counter
+
+BUDGET_ACTIONS = ('log', 'fail')
+
+
+class LoginRejected(Exception):
+    """ Raised by a login hook to refuse the login """
+
+
+class HookTimeout(LoginRejected):
+    """ A login hook ran over its budget """
+
+
+def hook_name(f):
+    """ Name a login hook for metrics and logs """
+
+    return getattr(f, '__name__', None) or repr(f)
+
+
+class _Started(threading.Event):
+    """ Set by the pool thread as a hook call starts - at: when """
+
+    at = None
+
+
+def _call(f, username, attrs, started=None):
+    """ Run hook f (awaiting a coroutine hook): (result, seconds) """
+
+    start = clock()
+    if started is not None:
+        started.at = start
+        started.set()
+    result = f(username, attrs)
+    if inspect.isawaitable(result):
+        result = asyncio.run(_awaited(result))
+    return result, clock() - start
+
+
+async def _awaited(awaitable):
+
+    return await awaitable
+
+
+class LoginHooks(list):
+    """
+    Login hooks, in order
+
+    budget - default seconds allowed each hook (def: None - unlimited)
+    on_budget - 'log' or 'fail' when a hook exceeds its budget
+    workers - threads running budgeted and concurrent hooks
+    max_stalled - a hook's abandoned calls allowed to hold threads
+                  (def: None - half the workers)
+    """
+
+    def __init__(self, hooks=(), budget=None, on_budget='log', workers=8, max_stalled=None):
+
+        super().__init__(hooks)
+
+        if on_budget not in BUDGET_ACTIONS:
+            raise ValueError(f'on_budget "{on_budget}" not one of {BUDGET_ACTIONS}')
+
+        self.budget = budget
+        self.on_budget = on_budget
+        self.workers = workers
+        self.max_stalled = max_stalled if max_stalled is not None else max(1, workers // 2)
+
+        # hook => budget, for hooks added with their own (None: exempt)
+        self.budgets = {}
+
+        # hook => calls abandoned over budget and still running
+        self.stalled = {}
+        self.lock = threading.Lock()
+
+        # hook => (reads, writes), for hooks that declared them
+        self.declared = {}
+
+        # (hooks, waves) - the run plan, rebuilt when hooks change
+        self.plan = ((), [])
+
+        self.executor = None
+
+
+    def add(self, f, budget=None, reads=None, writes=None):
+        """
+        Append hook f
+
+        budget - its own budget in seconds (optional)
+        reads, writes - the attribute keys it reads and writes (optional,
+                        both or neither) - see Concurrent hooks
+        """
+
+        if (reads is None) != (writes is None):
+            raise ValueError(f'login hook {hook_name(f)} must declare both reads and writes')
+
+        self.append(f)
+        if budget is not None:
+            self.budgets[f] = budget
+        if reads is not None:
+            self.declared[f] = (frozenset(reads), frozenset(writes))
+        return f
+
+
+    def exempt(self, f):
+        """ Run hook f outside the pipeline budget, on the request thread """
+
+        self.budgets[f] = None
+        return f
+
+
+    def budget_for(self, f):
+
+        return self.budgets.get(f, self.budget)
+
+
+    def waves(self):
+        """ Hooks grouped into waves: each wave's hooks may run concurrently """
+
+        hooks = tuple(self)
+        if self.plan[0] != hooks:
+            self.plan = (hooks, self.__compile(hooks))
+        return self.plan[1]
+
+
+    def __compile(self, hooks):
+
+        waves = []
+
+        # [(hook, wave index)] of the current run of declared hooks
+        run = []
+        first = 0
+
+        for f in hooks:
+            decl = self.declared.get(f)
+            if decl is None:
+                waves.append([f])
+                run = []
+                continue
+
+            if not run:
+                first = len(waves)
+
+            wave = first
+            for other, index in run:
+                if _conflict(self.declared[other], decl):
+                    wave = max(wave, index + 1)
+
+            if wave == len(waves):
+                waves.append([])
+            waves[wave].append(f)
+            run.append((f, wave))
+
+        return waves
+
+
+    def __pool(self):
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='BottleSaml-hook')
+        return self.executor
+
+
+    def __enforced(self, f):
+        """ f's budget, if the login fails when it's spent, else None """
+
+        if self.on_budget != 'fail':
+            return None
+        return self.budget_for(f)
+
+
+    def __submit(self, f, username, attrs, metrics):
+        """ Run f on the pool: (future, _Started) - unless too many of its calls are stalled """
+
+        stalled = self.stalled.get(f, 0)
+        if stalled >= self.max_stalled:
+            name = hook_name(f)
+            metrics.hook(name, 0.0, 'timeout')
+            raise HookTimeout(f'login hook {name} has {stalled} calls stalled over its budget')
+
+        started = _Started()
+        return self.__pool().submit(_call, f, username, attrs, started), started
+
+
+    def __abandon(self, f, future):
+        """ Count f's call stalled until it returns """
+
+        with self.lock:
+            self.stalled[f] = self.stalled.get(f, 0) + 1
+        future.add_done_callback(lambda future: self.__returned(f))
+
+
+    def __returned(self, f):
+
+        with self.lock:
+            self.stalled[f] -= 1
+
+
+    def __done(self, f, seconds, metrics, log):
+        """ Report a hook that returned """
+
+        name = hook_name(f)
+        budget = self.budget_for(f)
+        if budget is not None and seconds > budget:
+            metrics.hook(name, seconds, 'slow')
+            log.warn('SAML: login hook %s took %.3fs, over its %ss budget', name, seconds, budget)
+        else:
+            metrics.hook(name, seconds, 'ok')
+
+
+    def __result(self, f, call, submitted, metrics):
+        """ A pooled hook's (result, seconds), reporting failures """
+
+        future, started = call
+        name = hook_name(f)
+        budget = self.__enforced(f)
+        try:
+            if budget is None:
+                return future.result()
+
+            # the budget runs from the start: first, a budget to get a thread
+            if not started.wait(max(0.0, submitted + budget - clock())) and future.cancel():
+                raise FutureTimeout()
+            started.wait()
+            return future.result(timeout=max(0.0, started.at + budget - clock()))
+
+        except FutureTimeout:
+            if not future.cancelled():
+                self.__abandon(f, future)
+            metrics.hook(name, clock() - submitted, 'timeout')
+            raise HookTimeout(f'login hook {name} exceeded its {budget}s budget')
+        except LoginRejected:
+            metrics.hook(name, clock() - submitted, 'fail')
+            raise
+        except Exception:
+            metrics.hook(name, clock() - submitted, 'error')
+            raise
+
+
+    def __run_one(self, f, username, attrs, metrics, log):
+
+        start = clock()
+        if self.__enforced(f) is not None:
+            result, seconds = self.__result(
+                    f, self.__submit(f, username, attrs, metrics), start, metrics)
+        else:
+            try:
+                result, seconds = _call(f, username, attrs)
+            except LoginRejected:
+                metrics.hook(hook_name(f), clock() - start, 'fail')
+                raise
+            except Exception:
+                metrics.hook(hook_name(f), clock() - start, 'error')
+                raise
+
+        self.__done(f, seconds, metrics, log)
+        return result
+
+
+    def __run_wave(self, wave, username, attrs, metrics, log):
+        """ Run a wave of declared hooks concurrently, merging in order """
+
+        start = clock()
+        calls = []
+        for f in wave:
+            try:
+                calls.append((f, self.__submit(f, username, dict(attrs), metrics)))
+            except HookTimeout as e:
+                calls.append((f, e))
+
+        results = []
+        error = None
+        for f, call in calls:
+            try:
+                if isinstance(call, HookTimeout):
+                    raise call
+                result, seconds = self.__result(f, call, start, metrics)
+            except Exception as e:
+                # the first failing hook, in order, fails the login
+                error = error or e
+                continue
+            self.__done(f, seconds, metrics, log)
+            results.append((f, result))
+
+        if error is not None:
+            raise error
+
+        merged = dict(attrs)
+        for f, (new_username, new_attrs) in results:
+            for key in self.declared[f][1]:
+                if key == 'username':
+                    username = new_username
+                if key in new_attrs:
+                    merged[key] = new_attrs[key]
+                else:
+                    merged.pop(key, None)
+
+        return username, merged
+
+
+    def run(self, username, attrs, metrics, log):
+        """ Run the hooks: returns the final username, attrs """
+
+        for wave in self.waves():
+            if len(wave) == 1:
+                username, attrs = self.__run_one(wave[0], username, attrs, metrics, log)
+            else:
+                username, attrs = self.__run_wave(wave, username, attrs, metrics, log)
+
+        return username, attrs
+
+
+def _conflict(a, b):
+    """ Must declared hooks a and b run one after the other? """
+
+    reads_a, writes_a = a
+    reads_b, writes_b = b
+    return bool(writes_a & (reads_b | writes_b) or writes_b & reads_a)
@@ -0,0 +1,297 @@
+"""
+IdP registry - the Identity Providers a SamlSP accepts, indexed by issuer
+
+- Each IdP's certificates are parsed, and its AuthnRequest template rendered,
+  once when it is added.
+- The ACS peeks at a SAMLResponse's issuer and looks up exactly one IdP:
+  a dict lookup, however many IdPs are registered.
+
+saml_config['idps'] lists IdPs beyond the one configured at the top level of
+saml_config. Each entry is a dict of the same per-IdP parameters; those it
+omits are taken from the top level:
+
+    'saml_endpoint', 'issuer', 'certificate'    (required)
+    'spid', 'acs_url', 'force_reauth', 'user_attr', 'assertions', 'assertion_rules'
+
+'certificate' may be a list of PEMs, or several PEMs in one string, so a new
+IdP certificate can be added ahead of its rollover and the old one removed
+after. Each is tried most recently used first.
+
+saml_config['idp_metadata'] (a path or URL, or a list of them) configures IdPs
+from SAML metadata instead: its issuer, saml_endpoint and certificates (see
+metadata.py), with the other parameters from the top level. These IdPs are
+replaced as their metadata changes: each process re-checks the metadata on
+its own thread, started when it first looks up an IdP - so a worker forked
+after the registry was built (a pre-forking server) still refreshes.
+"""
+import os
+import re
+import threading
+from functools import partial
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.x509 import load_pem_x509_certificate
+
+from .attrs import AttrProjector
+from .authnreq import AuthnRequestBuilder
+from .metadata import IdPMetadata
+
+_PEM = re.compile(r'-----BEGIN CERTIFICATE-----.*?-----END CERTIFICATE-----', re.S)
+
+# saml_config parameters an 'idps' entry may set
+IDP_PARAMS = ('saml_endpoint', 'issuer', 'certificate', 'spid', 'acs_url',
+        'force_reauth', 'user_attr', 'assertions', 'assertion_rules')
+
+
+class IdP:
+    """
+    One Identity Provider
+
+    idp = IdP(config)
+
+    config - dict of per-IdP parameters (see IDP_PARAMS)
+    """
+
+    def __init__(self, config):
+
+        self.saml_endpoint = config['saml_endpoint']
+        self.issuer = config['issuer']
+        self.audience = config['spid']
+        self.acs_url = config.get('acs_url')
+
+        # Optional 'ForceAuth' to IdP
+        self.force_reauth = config.get('force_reauth', False)
+
+        # A list of the SAML claims we will add to the session attribute
+        # Convert these all to lower case...
+        self.saml_attrs = [attr.lower() for attr in config.get('assertions', [])]
+
+        # ... compiled, with any per-attribute rename and shape rules
+        self.attr_projector = AttrProjector(
+                config.get('assertions', []), config.get('assertion_rules'))
+
+        # The keys attributes are saved under, as configured
+        self.attr_names = self.attr_projector.keys()
+
+        # This is SAML claim we use to set 'username' - under its saved key
+        self.attr_uid = self.attr_projector.key(config.get('user_attr', 'name_id'))
+
+        # Load IdP (public) certificates - use to validate assertions
+        self.certificates = CertSet(config['certificate'])
+        self.certificate = self.certificates.certs[0]
+
+        # SAMLRequest redirects from a pre-rendered AuthnRequest
+        self.authn_request = AuthnRequestBuilder(
+                self.saml_endpoint, self.audience, self.acs_url)
+
+
+class CertSet:
+    """
+    An IdP's signing certificates, most recently used first
+
+    certs = CertSet(pems)
+
+    pems - a PEM string (of one or more certificates) or a list of them
+
+    - Passed to validate_response() as its certificate collection: the
+      signature's certificate is looked for in most recently used order,
+      so during a rollover the usual login matches on the first compare.
+    - hit() records the certificate a response was verified with.
+    """
+
+    def __init__(self, pems):
+
+        if isinstance(pems, str):
+            pems = [pems]
+
+        self.certs = []
+        for pem in pems:
+            for block in _PEM.findall(pem) or [pem]:
+                self.certs.append(load_pem_x509_certificate(
+                    block.encode('utf-8'), default_backend()))
+
+        if not self.certs:
+            raise ValueError('No IdP certificate configured')
+
+        self.hits = {cert: 0 for cert in self.certs}
+
+
+    def __contains__(self, cert):
+
+        for known in self.certs:
+            if known == cert:
+                return True
+        return False
+
+
+    def __iter__(self):
+
+        return iter(self.certs)
+
+
+    def __len__(self):
+
+        return len(self.certs)
+
+
+    def hit(self, cert):
+        """ Count a verification with cert, moving it to the front """
+
+        if cert not in self.hits:
+            return
+
+        self.hits[cert] += 1
+        if self.certs[0] != cert:
+            self.certs = [cert] + [c for c in self.certs if c != cert]
+
+
+class IdPRegistry:
+    """
+    IdPs indexed by issuer
+
+    - the first IdP added is the default, used by initiate_login()
+      when no IdP is named
+    """
+
+    def __init__(self):
+
+        self.by_issuer = {}
+        self.__default = None
+
+        # [IdPMetadata, base config, current issuer] of IdPs configured by metadata
+        self.sources = []
+
+        # refresh them? (watch()) - and the process watching
+        self.watching = False
+        self.log = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+
+    @property
+    def default(self):
+
+        if self.watching and self.pid != os.getpid():
+            self.__start()
+        return self.__default
+
+
+    def add(self, idp):
+        """ Add (or replace) the IdP for idp.issuer """
+
+        self.by_issuer[idp.issuer] = idp
+        if self.__default is None or self.__default.issuer == idp.issuer:
+            self.__default = idp
+        return idp
+
+
+    def replace(self, old_issuer, idp):
+        """ Swap in idp for the IdP of old_issuer, in one step """
+
+        by_issuer = dict(self.by_issuer)
+        old = by_issuer.pop(old_issuer, None)
+        by_issuer[idp.issuer] = idp
+
+        self.by_issuer = by_issuer
+        if self.__default is None or self.__default is old:
+            self.__default = idp
+        return idp
+
+
+    def watch(self, log=None):
+        """
+        Refresh IdPs configured by metadata
+
+        - the refresh threads start on the first lookup in each process
+        """
+
+        self.log = log
+        self.watching = bool(self.sources)
+
+
+    def __start(self):
+        """ This process's metadata refresh threads """
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            for source in self.sources:
+                source[0].watch(partial(self.__refreshed, source), self.log)
+
+
+    def __refreshed(self, source, settings):
+        """ New metadata settings for source """
+
+        md, base, issuer = source
+        idp = self.replace(issuer, IdP(dict(base, **settings)))
+        source[2] = idp.issuer
+
+        if self.log:
+            self.log.info('SAML: IdP "%s" metadata refreshed', idp.issuer)
+
+
+    def get(self, issuer, default=None):
+
+        if self.watching and self.pid != os.getpid():
+            self.__start()
+        return self.by_issuer.get(issuer, default)
+
+
+    def __getitem__(self, issuer):
+
+        if self.watching and self.pid != os.getpid():
+            self.__start()
+        return self.by_issuer[issuer]
+
+
+    def __contains__(self, issuer):
+
+        return issuer in self.by_issuer
+
+
+    def __len__(self):
+
+        return len(self.by_issuer)
+
+
+    def __iter__(self):
+
+        return iter(self.by_issuer.values())
+
+
+    @classmethod
+    def from_config(cls, config, acs_url=None):
+        """
+        Registry of the top level IdP in config (if any) and config['idps']
+
+        - acs_url overrides the top level acs_url (e.g. from the environment)
+        """
+
+        registry = cls()
+
+        top = {k: config[k] for k in IDP_PARAMS if k in config}
+        if acs_url:
+            top['acs_url'] = acs_url
+
+        if 'issuer' in top:
+            registry.add(IdP(top))
+
+        for entry in config.get('idps', []):
+            registry.add(IdP(dict(top, **entry)))
+
+        sources = config.get('idp_metadata') or []
+        if isinstance(sources, str):
+            sources = [sources]
+
+        for source in sources:
+            md = IdPMetadata(source,
+                    cache_dir=config.get('idp_metadata_cache'),
+                    refresh=config.get('idp_metadata_refresh', 3600))
+            idp = registry.add(IdP(dict(top, **md.load())))
+            registry.sources.append([md, top, idp.issuer])
+
+        if not registry:
+            raise KeyError('saml_config has no IdP: set "issuer", "idps" or "idp_metadata"')
+
+        return registry
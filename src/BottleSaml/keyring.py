@@ -0,0 +1,234 @@
+"""
+KeyRing - request ID keys shared by every worker process
+
+keyring = KeyRing(source=FileKeys('/etc/myapp/reqid.keys'), rotate=3600)
+
+- A source holds one or more secrets, newest first. The newest makes new
+  request IDs, the others still validate them - so secrets can be replaced
+  by adding a new one ahead of the old and dropping the old one later.
+- Sources are re-read every refresh seconds (a file only if it changed).
+- Keys (32 bytes) are derived from each secret. With rotate, they are also
+  derived from the current rotate period. Every process derives the same keys without
+  coordinating, and the previous period's keys still validate, so rotation
+  never invalidates a request in flight (keep reqid_life <= rotate).
+- Without a source, a random secret is made - valid in this process only.
+
+Sources:
+    FileKeys(path)      one secret per line
+    EnvKeys(var)        comma separated secrets in an environment variable
+    KVKeys(store, name) a secret string under name in a key value store
+                        providing get(name) and set(name, value) - LocalKV
+                        is an in-process stand-in
+Secrets are urlsafe base64 (see new_secret()), at least 16 bytes.
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from secrets import token_bytes
+
+
+def new_secret():
+    """ A new random secret, encoded for a source """
+
+    return urlsafe_b64encode(token_bytes(32)).decode('ascii')
+
+
+def parse_secrets(text):
+    """ Secrets (bytes), newest first, from a source's text """
+
+    secrets = []
+    for line in text.replace(',', '\n').splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        secret = urlsafe_b64decode(line + '=' * (-len(line) % 4))
+        if len(secret) < 16:
+            raise ValueError('ReqID secrets must be at least 16 bytes')
+        secrets.append(secret)
+
+    if not secrets:
+        raise ValueError('No ReqID secrets found')
+    return secrets
+
+
+class FileKeys:
+    """ Secrets in a file, one per line, newest first """
+
+    def __init__(self, path):
+        self.path = path
+
+    def changed(self, since):
+        """ True if the file may have changed since the last load """
+        return os.stat(self.path).st_mtime != since
+
+    def version(self):
+        return os.stat(self.path).st_mtime
+
+    def load(self):
+        with open(self.path) as f:
+            return parse_secrets(f.read())
+
+    def add(self, secret, keep=2):
+        """ Put a new secret ahead of the others, keeping keep secrets """
+
+        with open(self.path) as f:
+            old = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            os.chmod(tmp, 0o600)
+            f.write('\n'.join([secret] + old[:keep - 1]) + '\n')
+        os.replace(tmp, self.path)
+
+
+class EnvKeys:
+    """ Secrets in an environment variable, comma separated, newest first """
+
+    def __init__(self, var):
+        self.var = var
+
+    def changed(self, since):
+        return os.environ.get(self.var) != since
+
+    def version(self):
+        return os.environ.get(self.var)
+
+    def load(self):
+        if self.var not in os.environ:
+            raise KeyError(f'ReqID secrets environment variable "{self.var}" is not set')
+        return parse_secrets(os.environ[self.var])
+
+
+class KVKeys:
+    """ Secrets stored under name in a key value store, comma separated, newest first """
+
+    def __init__(self, store, name='BottleSaml-reqid'):
+        self.store = store
+        self.name = name
+
+    def changed(self, since):
+        return self.store.get(self.name) != since
+
+    def version(self):
+        return self.store.get(self.name)
+
+    def load(self):
+        value = self.store.get(self.name)
+        if value is None:
+            raise KeyError(f'ReqID secrets "{self.name}" not found')
+        return parse_secrets(value)
+
+    def add(self, secret, keep=2):
+        """ Put a new secret ahead of the others, keeping keep secrets """
+
+        old = (self.store.get(self.name) or '').split(',')
+        self.store.set(self.name, ','.join([secret] + [s for s in old if s][:keep - 1]))
+
+
+class LocalKV:
+    """ In-process stand-in for a shared key value store """
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def set(self, name, value):
+        with self.lock:
+            self.data[name] = value
+
+
+class KeyRing:
+    """
+    Current and previous request ID keys
+
+    keyring = KeyRing(source=None, rotate=None, refresh=30)
+
+    source - FileKeys, EnvKeys or KVKeys (def: a random secret for this process)
+    rotate - seconds between derived key changes (def: None, never)
+    refresh - seconds between checks of the source for new secrets
+    """
+
+    def __init__(self, source=None, rotate=None, refresh=30):
+
+        self.source = source
+        self.rotate = rotate
+        self.refresh = refresh
+
+        self.derived = {}
+        self.checked = time.time()
+
+        if source is None:
+            self.secrets = [token_bytes(32)]
+            self.loaded = None
+        else:
+            self.loaded = source.version()
+            self.secrets = source.load()
+
+
+    def __reload(self):
+        """ Re-read the source at most every refresh seconds """
+
+        now = time.time()
+        if self.source is None or now - self.checked < self.refresh:
+            return
+
+        self.checked = now
+        try:
+            if self.source.changed(self.loaded):
+                loaded = self.source.version()
+                self.secrets = self.source.load()
+                self.loaded = loaded
+                self.derived = {}
+        except (OSError, KeyError, ValueError):
+            # keep the secrets we have until the source is fixed
+            pass
+
+
+    def __period(self, when):
+
+        return int(when // self.rotate) if self.rotate else 0
+
+
+    def __derive(self, secret, period):
+        """ Key for secret in rotate period (cached) """
+
+        key = self.derived.get((secret, period))
+        if key is None:
+            if len(self.derived) > 64:
+                self.derived = {}
+            key = hmac.new(secret, b'BottleSaml-ReqID:%d' % period, hashlib.sha256).digest()
+            self.derived[(secret, period)] = key
+        return key
+
+
+    def signing_key(self, when=None):
+        """ The key making new request IDs (at when) """
+
+        self.__reload()
+        return self.__derive(self.secrets[0], self.__period(when or time.time()))
+
+
+    def verify_keys(self, when=None):
+        """
+        Keys that may have made a request ID, most likely first
+
+        - when: the request ID's timestamp, if known, for an exact rotate period;
+          otherwise the current and previous periods.
+        """
+
+        self.__reload()
+        if not self.rotate:
+            periods = [0]
+        elif when is not None:
+            periods = [self.__period(when)]
+        else:
+            period = self.__period(time.time())
+            periods = [period, period - 1]
+
+        return [self.__derive(secret, period) for period in periods for secret in self.secrets]
@@ -0,0 +1,174 @@
+"""
+QueueLog - SamlSP's default logger: buffered JSON lines, off the request thread
+
+log = QueueLog(level='info', stream=sys.stderr)
+log.info('SAML: User "%s" authenticated', name_id)
+
+- Same methods as a flask/stdlib logger (debug, info, warn, warning, error),
+  with %-style arguments.
+- The level is checked first: a filtered call costs a comparison, and no
+  message is formatted.
+- Records are appended to a deque (a thread safe append, no lock taken by
+  the caller). A background thread formats them and writes them to stream
+  in batches as JSON lines - so a login never waits on a slow stderr pipe.
+- At most max_queued records wait; beyond that the oldest are dropped, and
+  the number dropped is logged with the next batch.
+- Records still queued are written at exit, or by flush().
+"""
+import atexit
+import datetime
+import json
+import os
+import sys
+import threading
+from collections import deque
+from time import time
+
+LEVELS = {'debug': 10, 'info': 20, 'warn': 30, 'warning': 30, 'error': 40}
+
+
+class QueueLog:
+    """
+    level - the least level logged: 'debug', 'info', 'warn' or 'error'
+    stream - file written to (def: sys.stderr)
+    name - 'logger' of each record
+    interval - seconds the writer waits between batches
+    max_queued - records held for the writer
+    """
+
+    def __init__(self, level='info', stream=None, name='BottleSaml', interval=0.2, max_queued=10000):
+
+        self.threshold = LEVELS[level]
+        self.stream = stream
+        self.name = name
+        self.interval = interval
+
+        self.records = deque(maxlen=max_queued)
+        self.dropped = 0
+
+        self.wake = threading.Event()
+        self.write_lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+        atexit.register(self.flush)
+
+
+    @property
+    def level(self):
+
+        for name, value in LEVELS.items():
+            if value == self.threshold:
+                return name
+
+
+    @level.setter
+    def level(self, level):
+
+        self.threshold = LEVELS[level]
+
+
+    def isEnabledFor(self, level):
+
+        return LEVELS.get(level, level) >= self.threshold
+
+
+    def log(self, level, msg, *args):
+        """ Queue a record, if level is logged """
+
+        value = LEVELS[level]
+        if value < self.threshold:
+            return
+
+        records = self.records
+        if len(records) == records.maxlen:
+            self.dropped += 1
+        records.append((time(), level, msg, args))
+
+        if self.pid != os.getpid():
+            self.__start()
+        if value >= 40:
+            self.wake.set()
+
+
+    def debug(self, msg, *args):
+        if self.threshold <= 10:
+            self.log('debug', msg, *args)
+
+    def info(self, msg, *args):
+        if self.threshold <= 20:
+            self.log('info', msg, *args)
+
+    def warn(self, msg, *args):
+        self.log('warn', msg, *args)
+
+    warning = warn
+
+    def error(self, msg, *args):
+        self.log('error', msg, *args)
+
+
+    def __start(self):
+        """ The writer thread - one per process (a forked child starts its own) """
+
+        with self.write_lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.__run, name='BottleSaml-log', daemon=True)
+            self.thread.start()
+
+
+    def __run(self):
+
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+
+    def flush(self):
+        """ Write the queued records """
+
+        with self.write_lock:
+            lines = []
+            records = self.records
+            while True:
+                try:
+                    record = records.popleft()
+                except IndexError:
+                    break
+                lines.append(self.format(*record))
+
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(self.format(time(), 'warn', 'SAML: %d log records dropped', (dropped,)))
+
+            if not lines:
+                return
+
+            stream = self.stream or sys.stderr
+            try:
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+            except (OSError, ValueError):
+                # a closed or broken stream - nothing better to do
+                pass
+
+
+    def format(self, when, level, msg, args):
+        """ A record as a JSON line """
+
+        if args:
+            try:
+                msg = msg % args
+            except (TypeError, ValueError):
+                msg = ' '.join([str(msg)] + [str(arg) for arg in args])
+
+        return json.dumps({
+            'time': datetime.datetime.fromtimestamp(when, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': level,
+            'logger': self.name,
+            'pid': os.getpid(),
+            'msg': str(msg),
+        })
@@ -0,0 +1,129 @@
+"""
+AttrMapper - declarative attribute transforms, run as one login hook
+
+mapper = AttrMapper({
+    'rename':  {'http://schemas.microsoft.com/identity/claims/objectidentifier': 'object_id'},
+    'flatten': {'http://schemas.microsoft.com/claims/authnmethodsreferences': {
+                    'msft_mfa': 'http://schemas.microsoft.com/claims/multipleauthn',
+                    'msft_pwd': 'http://schemas.microsoft.com/ws/2008/06/identity/authenticationmethod/password'}},
+    'member':  {'is_admin': ['groups', 'sysadmin']},
+    'require': {'groups': ['staff', 'sysadmin']},
+    'drop':    ['http://schemas.microsoft.com/identity/claims/tenantid'],
+})
+saml.add_login_hook(mapper)
+
+Spec operations, each optional:
+
+    'rename'    {attribute: new key}
+    'flatten'   {attribute: {key: value}} - key is True if value is one of the
+                attribute's values, else False; the attribute is dropped
+    'member'    {key: [attribute, value]} - as flatten, keeping the attribute
+    'require'   {attribute: value, or [values], or True} - the login fails
+                (MappingError) unless the attribute has one of the values,
+                or with True, is present
+    'drop'      [attribute, ...]
+
+- The spec is compiled once into actions per attribute. A login makes one
+  pass over the attributes, however many operations there are - in place of
+  a chain of hooks each scanning (and copying) the attribute dict.
+- Operations on one attribute apply in the order above: checks read the
+  attribute's values before it is renamed or dropped.
+"""
+
+from .hooks import LoginRejected
+
+OPERATIONS = ('rename', 'flatten', 'member', 'require', 'drop')
+
+# compiled actions
+FLAG = 0        # (FLAG, key, value)
+REQUIRE = 1     # (REQUIRE, index, values or None)
+
+
+class MappingError(LoginRejected):
+    """ An attribute requirement was not met """
+
+
+class AttrMapper:
+
+    def __init__(self, spec):
+
+        # login hook name in metrics and logs
+        self.__name__ = 'AttrMapper'
+
+        unknown = set(spec) - set(OPERATIONS)
+        if unknown:
+            raise ValueError(f'Unknown attribute mapping operations: {sorted(unknown)}')
+
+        # attribute => [actions], new key (None to drop, absent to keep)
+        self.actions = {}
+        self.keys = {}
+
+        # keys set False unless an attribute sets them True
+        self.flags = []
+
+        # [(attribute, description)] of each requirement, by index
+        self.requires = []
+
+        for name, flags in spec.get('flatten', {}).items():
+            for key, value in flags.items():
+                self.__flag(name, key, value)
+            self.keys[name] = None
+
+        for key, (name, value) in spec.get('member', {}).items():
+            self.__flag(name, key, value)
+
+        for name, values in spec.get('require', {}).items():
+            if values is True:
+                values = None
+            elif isinstance(values, str):
+                values = frozenset([values])
+            else:
+                values = frozenset(values)
+            self.actions.setdefault(name, []).append((REQUIRE, len(self.requires), values))
+            self.requires.append((name, 'present' if values is None else sorted(values)))
+
+        for name, key in spec.get('rename', {}).items():
+            if self.keys.get(name, key) is not None:
+                self.keys[name] = key
+
+        for name in spec.get('drop', []):
+            self.keys[name] = None
+
+
+    def __flag(self, name, key, value):
+
+        self.actions.setdefault(name, []).append((FLAG, key, value))
+        if key not in self.flags:
+            self.flags.append(key)
+
+
+    def __call__(self, username, attrs):
+        """ Login hook: map attrs in one pass """
+
+        mapped = dict.fromkeys(self.flags, False)
+        met = [False] * len(self.requires)
+
+        actions = self.actions
+        keys = self.keys
+
+        for name, value in attrs.items():
+
+            todo = actions.get(name)
+            if todo is not None:
+                values = value if isinstance(value, list) else [value]
+                for action in todo:
+                    if action[0] == FLAG:
+                        if action[2] in values:
+                            mapped[action[1]] = True
+                    elif action[2] is None or not action[2].isdisjoint(values):
+                        met[action[1]] = True
+
+            key = keys.get(name, name)
+            if key is not None:
+                mapped[key] = value
+
+        if not all(met):
+            name, wanted = self.requires[met.index(False)]
+            raise MappingError(f'Attribute "{name}" requirement not met: {wanted}')
+
+        return username, mapped
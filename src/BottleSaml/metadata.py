@@ -0,0 +1,304 @@
+"""
+IdPMetadata - IdP settings from SAML metadata, cached parsed on disk
+
+md = IdPMetadata('https://idp.example.com/metadata.xml', cache_dir='/var/cache/myapp')
+settings = md.load()    # {'issuer', 'saml_endpoint', 'certificate': [PEM, ...]}
+
+- source is a file path or an https URL of the IdP's metadata XML. The
+  metadata carries the certificates responses are verified with, so a
+  plain http URL (which anyone on the path could rewrite) is refused.
+- The parsed settings are written to a small JSON file in cache_dir. A cold
+  start loads that file instead of fetching and parsing the XML: a file
+  source is only re-parsed if it changed, a URL is fetched (conditionally)
+  only if the cache is more than refresh seconds old - or if it can't be
+  fetched, the cache is used.
+- watch() starts a thread re-checking the source every refresh seconds
+  (a URL conditionally, by ETag / Last-Modified) and hands new settings to
+  a callback - SamlSP swaps the IdP in its registry in one step. The thread
+  belongs to the process calling watch(): a forked worker calls it again.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from lxml import etree
+
+MD_NS = 'urn:oasis:names:tc:SAML:2.0:metadata'
+DS_NS = 'http://www.w3.org/2000/09/xmldsig#'
+NS = {'md': MD_NS, 'ds': DS_NS}
+
+REDIRECT_BINDING = 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect'
+
+# cache file format - bump to ignore caches written by older versions
+CACHE_VERSION = 1
+
+
+class MetadataError(ValueError):
+    """ Metadata that can't configure an IdP """
+
+
+def parse_metadata(xml, entity_id=None):
+    """
+    IdP settings from metadata XML (bytes)
+
+    - entity_id picks an EntityDescriptor from an EntitiesDescriptor
+      (def: the first with an IDPSSODescriptor)
+    - returns {'issuer', 'saml_endpoint', 'certificate': [PEM, ...]}
+    """
+
+    parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=False)
+    try:
+        root = etree.fromstring(xml, parser=parser)
+    except etree.XMLSyntaxError as e:
+        raise MetadataError(f'Metadata is not XML: {str(e)}')
+
+    if root.tag == f'{{{MD_NS}}}EntityDescriptor':
+        entities = [root]
+    else:
+        entities = root.iterfind('.//md:EntityDescriptor', NS)
+
+    for entity in entities:
+        if entity_id and entity.get('entityID') != entity_id:
+            continue
+        idpsso = entity.find('md:IDPSSODescriptor', NS)
+        if idpsso is not None:
+            break
+    else:
+        raise MetadataError(f'No IdP "{entity_id or "*"}" in metadata')
+
+    endpoint = None
+    for sso in idpsso.iterfind('md:SingleSignOnService', NS):
+        if sso.get('Binding') == REDIRECT_BINDING:
+            endpoint = sso.get('Location')
+            break
+    if not endpoint:
+        raise MetadataError('No HTTP-Redirect SingleSignOnService in metadata')
+
+    certificates = []
+    for key in idpsso.iterfind('md:KeyDescriptor', NS):
+        if key.get('use', 'signing') != 'signing':
+            continue
+        for cert in key.iterfind('ds:KeyInfo/ds:X509Data/ds:X509Certificate', NS):
+            certificates.append(_pem(cert.text))
+    if not certificates:
+        raise MetadataError('No signing certificate in metadata')
+
+    return {
+        'issuer': entity.get('entityID'),
+        'saml_endpoint': endpoint,
+        'certificate': certificates,
+    }
+
+
+def _pem(text):
+    """ PEM from the base64 of an X509Certificate element """
+
+    b64 = ''.join((text or '').split())
+    lines = [b64[i:i + 64] for i in range(0, len(b64), 64)]
+    return '-----BEGIN CERTIFICATE-----\n' + '\n'.join(lines) + '\n-----END CERTIFICATE-----\n'
+
+
+class IdPMetadata:
+    """
+    One IdP's metadata source
+
+    md = IdPMetadata(source, cache_dir=None, refresh=3600, entity_id=None, timeout=10)
+
+    source - metadata file path or https URL
+    cache_dir - directory for the parsed cache file (def: None - no cache)
+    refresh - seconds between re-checks of the source by watch()
+    entity_id - the IdP's entityID, if source lists several
+    timeout - seconds allowed to fetch a URL
+    """
+
+    def __init__(self, source, cache_dir=None, refresh=3600, entity_id=None, timeout=10):
+
+        self.source = source
+        self.refresh = refresh
+        self.entity_id = entity_id
+        self.timeout = timeout
+        self.is_url = source.startswith('https://')
+        if source.startswith('http://'):
+            raise MetadataError(f'IdP metadata "{source}" is not fetched over plain http: use https')
+
+        self.cache_file = None
+        if cache_dir:
+            name = hashlib.blake2b(f'{source}#{entity_id}'.encode('utf-8'), digest_size=12).hexdigest()
+            self.cache_file = os.path.join(cache_dir, f'idp-{name}.json')
+
+        # what the settings were parsed from: file mtime or URL validators
+        self.version = None
+        self.settings = None
+
+        # when the source was last checked
+        self.checked = 0.0
+
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+
+    def load(self):
+        """ Settings from the cache if current, else from the source """
+
+        cached = self.__read_cache()
+        if cached is not None:
+            version, settings, checked = cached
+            if not self.is_url:
+                if version == self.__file_version():
+                    self.version, self.settings, self.checked = version, settings, time.time()
+                    return settings
+            else:
+                # fetched with the cache's validators - unchanged is a 304
+                self.version, self.settings, self.checked = version, settings, checked
+                if self.refresh and time.time() < checked + self.refresh:
+                    return settings
+                try:
+                    self.fetch()
+                except Exception:
+                    # the next watch() check retries
+                    pass
+                return self.settings
+
+        self.fetch()
+        return self.settings
+
+
+    def fetch(self):
+        """
+        Re-read and parse the source if it changed
+
+        - returns the new settings, or None if unchanged
+        """
+
+        if self.is_url:
+            fetched = self.__fetch_url()
+            self.checked = time.time()
+            if fetched is None:
+                # other workers starting needn't ask again
+                self.__write_cache()
+                return None
+            version, xml = fetched
+        else:
+            self.checked = time.time()
+            version = self.__file_version()
+            if self.settings is not None and version == self.version:
+                return None
+            with open(self.source, 'rb') as f:
+                xml = f.read()
+
+        settings = parse_metadata(xml, self.entity_id)
+        self.version, self.settings = version, settings
+        self.__write_cache()
+        return settings
+
+
+    def watch(self, on_change, log=None):
+        """
+        Re-check the source every refresh seconds on a daemon thread
+
+        - one thread per process: call again in a forked child to start its own
+        - the first check is due refresh seconds after the source was last
+          checked (by any process, for a URL with a cache)
+        - on_change(settings) is called with new settings
+        - errors are logged, and the current settings kept
+        """
+
+        def run():
+            while not self.stopped.wait(max(0.0, self.checked + self.refresh - time.time())):
+                try:
+                    settings = self.fetch()
+                    if settings is not None:
+                        on_change(settings)
+                except Exception as e:
+                    self.checked = time.time()
+                    if log:
+                        log.warn('SAML: IdP metadata refresh from "%s" failed: %s', self.source, e)
+
+        if not self.refresh:
+            return None
+
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=run, name='BottleSaml-metadata', daemon=True)
+                self.thread.start()
+        return self.thread
+
+
+    def stop(self):
+        """ End the watch() thread """
+
+        self.stopped.set()
+
+
+    def __file_version(self):
+
+        try:
+            stat = os.stat(self.source)
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+
+    def __fetch_url(self):
+        """ (version, xml) from the URL, or None if not modified """
+
+        headers = {}
+        if self.settings is not None and self.version:
+            etag, modified = self.version
+            if etag:
+                headers['If-None-Match'] = etag
+            if modified:
+                headers['If-Modified-Since'] = modified
+
+        req = urllib.request.Request(self.source, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                xml = resp.read()
+                version = [resp.headers.get('ETag'), resp.headers.get('Last-Modified')]
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+
+        return version, xml
+
+
+    def __read_cache(self):
+        """ (version, settings, when checked) from the cache file, or None """
+
+        if not self.cache_file:
+            return None
+        try:
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if cached.get('v') != CACHE_VERSION or cached.get('source') != self.source:
+            return None
+        return cached.get('version'), cached['settings'], cached.get('fetched', 0)
+
+
+    def __write_cache(self):
+        """ Replace the cache file in one step - workers may be reading it """
+
+        if not self.cache_file:
+            return
+
+        cached = {'v': CACHE_VERSION, 'source': self.source, 'version': self.version,
+                'fetched': self.checked, 'settings': self.settings}
+        tmp = f'{self.cache_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp, self.cache_file)
+        except OSError:
+            # a cache we can't write only costs a parse at the next start
+            pass
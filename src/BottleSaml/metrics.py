@@ -0,0 +1,188 @@
+"""
+Metrics - instrumentation surface for SamlSP
+
+saml = SamlSP(app, sess, saml_config, metrics=MyMetrics())
+
+- SamlSP reports the duration of each stage of the ACS pipeline, and of each
+  login hook, to the metrics object along with an outcome label.
+- Durations are seconds measured with a monotonic clock (time.perf_counter)
+- The default, Metrics(), discards everything.
+
+ACS stages (in order):
+    'admission'     waiting for a slot under acs_limit (if configured)
+    'session_open'  session manager open_session()
+    'form'          size check, RelayState and SAMLResponse form decoding
+    'precheck'      cheap scan: base64, Issuer, InResponseTo format, replayed Assertion ID
+    'validate'      minisaml signature/audience validation
+    'request_id'    ReqID validation of InResponseTo
+    'replay'        consuming the request and Assertion IDs in the replay cache
+    'issuer'        issuer comparison
+    'hooks'         all login hooks (each hook is also reported to hook())
+    'session_close' session manager close_session()
+
+Outside the ACS:
+    'redirect'      building a SAMLRequest redirect (initiate_login) - one per
+                    login started
+
+Login renewals (with renew_window) are reported to renewal(outcome, seconds):
+'early', 'late' or 'failed' (see core.py), with the seconds since the
+renewal started (None for a lapsed login replaced by a full one).
+
+Outcomes:
+    'ok'    the stage passed
+    'fail'  the stage rejected the login
+    'error' the stage raised an exception
+Login hooks may also report 'slow' and 'timeout' (see hooks.py).
+
+StatsMetrics() keeps a latency histogram per stage and per hook, and counts
+by outcome, for an app to read or export. PrometheusMetrics (prometheus.py)
+exports them in the Prometheus text format, across worker processes.
+"""
+import threading
+
+# histogram bucket upper bounds, seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    """
+    No-op metrics - the default.
+
+    Subclass and override stage() and hook() to collect timings.
+    These are called on the request thread: keep them cheap.
+    """
+
+    def stage(self, stage, seconds, outcome):
+        """ A stage of the ACS pipeline completed """
+        pass
+
+
+    def hook(self, hook, seconds, outcome):
+        """ A login hook (by name) completed """
+        pass
+
+
+    def renewal(self, outcome, seconds):
+        """ A login renewal completed, or a login lapsed """
+        pass
+
+
+class Histogram:
+    """
+    Latency histogram
+
+    counts[i] counts observations <= bounds[i] (and > bounds[i-1]);
+    counts[-1] counts those over the last bound.
+    """
+
+    def __init__(self, bounds=BUCKETS):
+
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe(self, seconds):
+
+        i = 0
+        for bound in self.bounds:
+            if seconds <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q quantile (inf if over the last) """
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return 0.0
+
+
+class StatsMetrics(Metrics):
+    """
+    Histograms and outcome counters per stage and per login hook
+
+    metrics = StatsMetrics()
+    metrics.stages['validate'].quantile(0.95)
+    metrics.hooks['ldap_groups'].count
+    metrics.outcomes[('hook', 'ldap_groups', 'timeout')]
+    metrics.renewals['early'].quantile(0.95)
+    metrics.outcomes[('renewal', 'login', 'late')]
+    """
+
+    def __init__(self, bounds=BUCKETS):
+
+        self.bounds = bounds
+        self.stages = {}
+        self.hooks = {}
+        self.renewals = {}
+        self.outcomes = {}
+        self.lock = threading.Lock()
+
+
+    def __record(self, histograms, kind, name, seconds, outcome):
+
+        with self.lock:
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = Histogram(self.bounds)
+            histogram.observe(seconds)
+
+            key = (kind, name, outcome)
+            self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+
+    def stage(self, stage, seconds, outcome):
+
+        self.__record(self.stages, 'stage', stage, seconds, outcome)
+
+
+    def hook(self, hook, seconds, outcome):
+
+        self.__record(self.hooks, 'hook', hook, seconds, outcome)
+
+
+    def renewal(self, outcome, seconds):
+
+        with self.lock:
+            if seconds is not None:
+                histogram = self.renewals.get(outcome)
+                if histogram is None:
+                    histogram = self.renewals[outcome] = Histogram(self.bounds)
+                histogram.observe(seconds)
+
+            key = ('renewal', 'login', outcome)
+            self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+
+    def snapshot(self):
+        """ A dict of the counts so far """
+
+        with self.lock:
+            return {
+                'stages': {name: _summary(h) for name, h in self.stages.items()},
+                'hooks': {name: _summary(h) for name, h in self.hooks.items()},
+                'renewals': {name: _summary(h) for name, h in self.renewals.items()},
+                'outcomes': {'/'.join(key): count for key, count in self.outcomes.items()},
+            }
+
+
+def _summary(histogram):
+
+    return {
+        'count': histogram.count,
+        'sum': histogram.sum,
+        'p50': histogram.quantile(0.5),
+        'p95': histogram.quantile(0.95),
+        'p99': histogram.quantile(0.99),
+        'buckets': list(histogram.counts),
+    }
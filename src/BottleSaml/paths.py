@@ -0,0 +1,92 @@
+"""
+PathRules - path prefix rules deciding which paths require login
+
+rules = PathRules(protect=['/admin/'], exempt=['/admin/static/', '/health'], default=False)
+
+- The longest matching prefix decides: protect => True, exempt => False
+- A path matching no prefix gets default
+- Rules are compiled into a character trie once: a lookup walks the path,
+  so its cost is independent of the number of rules.
+"""
+
+# trie node: [children {char: node}, decision or None]
+CHILDREN = 0
+DECISION = 1
+
+
+class PathRules:
+
+    def __init__(self, protect=(), exempt=(), default=True):
+
+        self.default = default
+        self.root = [{}, None]
+
+        for prefix in protect:
+            self.__add(prefix, True)
+
+        # exempt wins where both list the same prefix
+        for prefix in exempt:
+            self.__add(prefix, False)
+
+
+    def __add(self, prefix, decision):
+
+        node = self.root
+        for ch in prefix:
+            node = node[CHILDREN].setdefault(ch, [{}, None])
+        node[DECISION] = decision
+
+
+    def __bool__(self):
+        """ Are there any rules? """
+
+        return bool(self.root[CHILDREN]) or self.root[DECISION] is not None
+
+
+    def requires_login(self, path):
+        """ Decision for path: longest matching prefix, else default """
+
+        decision = self.default
+        node = self.root
+        for ch in path:
+            node = node[CHILDREN].get(ch)
+            if node is None:
+                break
+            if node[DECISION] is not None:
+                decision = node[DECISION]
+
+        return decision
+
+
+    def decide(self, prefix):
+        """
+        Decision for every path starting with prefix
+
+        - returns True or False if all such paths are decided the same,
+          None if longer rules split them.
+        """
+
+        decision = self.default
+        node = self.root
+        for ch in prefix:
+            node = node[CHILDREN].get(ch)
+            if node is None:
+                # no rule is longer than this part of prefix
+                return decision
+            if node[DECISION] is not None:
+                decision = node[DECISION]
+
+        return decision if _uniform(node, decision) else None
+
+
+def _uniform(node, decision):
+    """ Every rule below node decides the same as decision """
+
+    stack = list(node[CHILDREN].values())
+    while stack:
+        child = stack.pop()
+        if child[DECISION] is not None and child[DECISION] != decision:
+            return False
+        stack.extend(child[CHILDREN].values())
+
+    return True
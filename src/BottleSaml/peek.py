@@ -0,0 +1,115 @@
+"""
+Peek - cheap, unverified scan of a SAMLResponse
+
+Finds the values SamlSP needs before (or without) a full XML parse and
+signature verification. Nothing found here is trusted: values are only
+used to reject early, never to accept - the replay cache records the ID
+of the Assertion verify_response() verified, not an ID found here.
+
+- peek_response() raises PeekError for junk that validate_response()
+  would certainly reject: malformed base64, or no Issuer or Assertion.
+"""
+import base64
+import re
+
+_BASE64 = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=\r\n\t '
+
+# patterns start with a literal, so the regex engine can skip ahead quickly
+_ISSUER = re.compile(rb'Issuer\b[^>]*>([^<]*)<')
+# an unprefixed ID attribute - not xmlns:ID, or any other prefixed or longer name
+_ASSERTION_ID = re.compile(rb'Assertion\s[^>]*?(?<![\w:.-])ID\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_IN_RESPONSE_TO = re.compile(rb'InResponseTo\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_TAG_OPEN = re.compile(rb'<(?:[\w.-]+:)?')
+_CHAR_REF = re.compile(r'&(#[0-9]+|#x[0-9a-fA-F]+|lt|gt|amp|quot|apos);')
+_ENTITIES = {'lt': '<', 'gt': '>', 'amp': '&', 'quot': '"', 'apos': "'"}
+
+
+class PeekError(ValueError):
+    """ The SAMLResponse can not be valid """
+    pass
+
+
+class Peek:
+    """
+    Result of peek_response()
+
+    xml             decoded SAMLResponse (bytes)
+    issuers         text of every Issuer element found (whitespace stripped)
+    assertion_ids   ID attribute of every Assertion element found
+    in_response_to  InResponseTo attributes found
+    """
+
+    __slots__ = ('xml', 'issuers', 'assertion_ids', 'in_response_to')
+
+    def __init__(self, xml, issuers, assertion_ids, in_response_to):
+        self.xml = xml
+        self.issuers = issuers
+        self.assertion_ids = assertion_ids
+        self.in_response_to = in_response_to
+
+
+def peek_response(data):
+    """ Decode and scan a base64 SAMLResponse - raises PeekError """
+
+    if isinstance(data, str):
+        data = data.encode('latin-1', 'replace')
+
+    if data.translate(None, _BASE64):
+        raise PeekError('malformed base64')
+
+    try:
+        xml = base64.b64decode(data)
+    except ValueError:
+        raise PeekError('malformed base64')
+
+    issuers = [issuer.strip() for issuer in _values(_ISSUER, xml, element=True)]
+    if not issuers:
+        raise PeekError('no Issuer')
+
+    assertion_ids = _values(_ASSERTION_ID, xml, element=True)
+    if not assertion_ids:
+        raise PeekError('no Assertion')
+
+    return Peek(xml,
+            issuers=issuers,
+            assertion_ids=assertion_ids,
+            in_response_to=_values(_IN_RESPONSE_TO, xml))
+
+
+def _values(pattern, xml, element=False):
+    """
+    Values matched by pattern, with character references resolved
+
+    - element: the match must be an element name (in a start tag)
+    """
+
+    values = []
+    for m in pattern.finditer(xml):
+        if element:
+            start = xml.rfind(b'<', 0, m.start())
+            if start < 0 or _TAG_OPEN.fullmatch(xml, start, m.start()) is None:
+                continue
+        value = next(g for g in m.groups() if g is not None)
+        values.append(_unescape(value.decode('utf-8', 'replace')))
+
+    return values
+
+
+def _unescape(value):
+    """ XML attribute value as the parser would see it """
+
+    if '&' not in value:
+        return value
+
+    def ref(m):
+        name = m.group(1)
+        try:
+            if name[:2] == '#x':
+                return chr(int(name[2:], 16))
+            if name[0] == '#':
+                return chr(int(name[1:]))
+        except (ValueError, OverflowError):
+            raise PeekError('bad character reference')
+        return _ENTITIES[name]
+
+    return _CHAR_REF.sub(ref, value)
@@ -0,0 +1,360 @@
+"""
+PrometheusMetrics - SamlSP metrics in the Prometheus text format
+
+metrics = PrometheusMetrics(directory='/run/myapp/saml-metrics')
+saml = SamlSP(app, sess, saml_config, metrics=metrics)    # 'metrics_route': True
+... GET /saml/metrics
+
+Exported:
+    bottlesaml_logins_started_total             SAMLRequest redirects built
+    bottlesaml_redirect_seconds                 histogram: building the redirect
+    bottlesaml_acs_total{outcome}               ACS requests: success or failure
+    bottlesaml_acs_failures_total{reason}       failed ACS requests, by stage:
+        busy, form, precheck, validation, request_id, replay, issuer, hook
+    bottlesaml_stage_seconds{stage}             histogram per ACS stage
+                                                (validate: validation latency)
+    bottlesaml_hook_total{hook,outcome}         login hooks run
+    bottlesaml_hook_seconds{hook}               histogram per login hook
+    bottlesaml_renewals_total{outcome}          login renewals: early, late or failed
+    bottlesaml_renewal_seconds{outcome}         histogram: renewal round trips
+
+- Without a directory, values are kept in this process.
+- With a directory (shared by the workers, and emptied before the app
+  starts), each process keeps its values in its own memory mapped file
+  there. Updating one is a write to memory - no system call - and
+  render() adds up every process's file, so any worker reports for all.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+
+from .metrics import BUCKETS, Metrics
+
+# ACS stage => failure reason
+REASONS = {
+    'admission': 'busy',
+    'form': 'form',
+    'precheck': 'precheck',
+    'validate': 'validation',
+    'request_id': 'request_id',
+    'replay': 'replay',
+    'issuer': 'issuer',
+    'hooks': 'hook',
+}
+
+HELP = {
+    'bottlesaml_logins_started_total': ('counter', 'SAMLRequest redirects built'),
+    'bottlesaml_redirect_seconds': ('histogram', 'Seconds building a SAMLRequest redirect'),
+    'bottlesaml_acs_total': ('counter', 'ACS requests by outcome'),
+    'bottlesaml_acs_failures_total': ('counter', 'Failed ACS requests by reason'),
+    'bottlesaml_stage_seconds': ('histogram', 'Seconds per ACS stage'),
+    'bottlesaml_hook_total': ('counter', 'Login hooks run by outcome'),
+    'bottlesaml_hook_seconds': ('histogram', 'Seconds per login hook'),
+    'bottlesaml_renewals_total': ('counter', 'Login renewals by outcome'),
+    'bottlesaml_renewal_seconds': ('histogram', 'Seconds from starting a login renewal to its end'),
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_HEADER = struct.Struct('<I4x')
+_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+INITIAL_SIZE = 1 << 16
+
+
+class MmapValues:
+    """
+    A file of named float values, memory mapped
+
+    Layout: used bytes (uint32, 4 pad), then entries of key length (uint32),
+    key (utf-8, padded to 8 bytes), value (double).
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.offsets = {}
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = os.fdopen(fd, 'r+b')
+        if os.fstat(fd).st_size == 0:
+            self.file.truncate(INITIAL_SIZE)
+        self.map = mmap.mmap(fd, 0)
+
+        self.used = _HEADER.unpack_from(self.map, 0)[0] or _HEADER.size
+        for key, offset, value in _entries(self.map, self.used):
+            self.offsets[key] = offset
+
+
+    def __add_key(self, key):
+
+        encoded = key.encode('utf-8')
+        padded = (_LENGTH.size + len(encoded) + 7) // 8 * 8
+        size = padded + _VALUE.size
+
+        if self.used + size > len(self.map):
+            grown = max(len(self.map) * 2, self.used + size)
+            self.map.close()
+            self.file.truncate(grown)
+            self.map = mmap.mmap(self.file.fileno(), 0)
+
+        entry = self.used
+        _LENGTH.pack_into(self.map, entry, len(encoded))
+        self.map[entry + _LENGTH.size:entry + _LENGTH.size + len(encoded)] = encoded
+        offset = entry + padded
+        _VALUE.pack_into(self.map, offset, 0.0)
+
+        self.used += size
+        _HEADER.pack_into(self.map, 0, self.used)
+        self.offsets[key] = offset
+        return offset
+
+
+    def add(self, key, amount):
+
+        offset = self.offsets.get(key)
+        if offset is None:
+            offset = self.__add_key(key)
+        value = _VALUE.unpack_from(self.map, offset)[0] + amount
+        _VALUE.pack_into(self.map, offset, value)
+
+
+def _entries(buf, used):
+    """ (key, value offset, value) of each entry in a values file """
+
+    pos = _HEADER.size
+    while pos < used:
+        length = _LENGTH.unpack_from(buf, pos)[0]
+        key = bytes(buf[pos + _LENGTH.size:pos + _LENGTH.size + length]).decode('utf-8')
+        offset = pos + (_LENGTH.size + length + 7) // 8 * 8
+        yield key, offset, _VALUE.unpack_from(buf, offset)[0]
+        pos = offset + _VALUE.size
+
+
+def read_values(path):
+    """ {key: value} from a values file (another process's, possibly) """
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        return {}
+    used = min(_HEADER.unpack_from(data, 0)[0], len(data))
+    return {key: value for key, offset, value in _entries(data, used)}
+
+
+class PrometheusMetrics(Metrics):
+    """
+    directory - where each process keeps its values file (def: None - in memory)
+    bounds - histogram bucket upper bounds, seconds
+    """
+
+    def __init__(self, directory=None, bounds=BUCKETS):
+
+        self.directory = directory
+        self.bounds = bounds
+        self.lock = threading.Lock()
+
+        self.values = {}
+        self.file = None
+        self.pid = None
+
+        # (name, labels) => [bucket keys..., sum key, count key]
+        self.histograms = {}
+
+
+    def __store(self):
+        """ This process's values file, if keeping them in a directory """
+
+        if self.directory is None:
+            return None
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.values = {}
+            self.file = MmapValues(os.path.join(self.directory, f'bottlesaml-{self.pid}.db'))
+        return self.file
+
+
+    def __add(self, key, amount):
+        # holds self.lock
+
+        store = self.__store()
+        if store is not None:
+            store.add(key, amount)
+        else:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+
+    def inc(self, name, labels=(), amount=1.0):
+        """ Add to a counter """
+
+        with self.lock:
+            self.__add(_key(name, labels), amount)
+
+
+    def observe(self, name, labels, seconds):
+        """ Add an observation to a histogram """
+
+        keys = self.histograms.get((name, labels))
+        if keys is None:
+            keys = [_key(name + '_bucket', labels + (('le', _le(bound)),)) for bound in self.bounds]
+            keys.append(_key(name + '_bucket', labels + (('le', '+Inf'),)))
+            keys.append(_key(name + '_sum', labels))
+            keys.append(_key(name + '_count', labels))
+            self.histograms[(name, labels)] = keys
+
+        i = 0
+        for bound in self.bounds:
+            if seconds <= bound:
+                break
+            i += 1
+
+        with self.lock:
+            # buckets are stored per bucket, made cumulative by render()
+            self.__add(keys[i], 1.0)
+            self.__add(keys[-2], seconds)
+            self.__add(keys[-1], 1.0)
+
+
+    def stage(self, stage, seconds, outcome):
+
+        if stage == 'redirect':
+            self.inc('bottlesaml_logins_started_total')
+            self.observe('bottlesaml_redirect_seconds', (), seconds)
+            return
+
+        self.observe('bottlesaml_stage_seconds', (('stage', stage),), seconds)
+
+        if outcome != 'ok' and stage in REASONS:
+            self.inc('bottlesaml_acs_total', (('outcome', 'failure'),))
+            self.inc('bottlesaml_acs_failures_total', (('reason', REASONS[stage]),))
+        elif stage == 'hooks':
+            self.inc('bottlesaml_acs_total', (('outcome', 'success'),))
+
+
+    def hook(self, hook, seconds, outcome):
+
+        self.inc('bottlesaml_hook_total', (('hook', hook), ('outcome', outcome)))
+        self.observe('bottlesaml_hook_seconds', (('hook', hook),), seconds)
+
+
+    def renewal(self, outcome, seconds):
+
+        self.inc('bottlesaml_renewals_total', (('outcome', outcome),))
+        if seconds is not None:
+            self.observe('bottlesaml_renewal_seconds', (('outcome', outcome),), seconds)
+
+
+    def collect(self):
+        """ {key: value} summed over every process """
+
+        if self.directory is None:
+            with self.lock:
+                return dict(self.values)
+
+        totals = {}
+        for name in os.listdir(self.directory):
+            if not (name.startswith('bottlesaml-') and name.endswith('.db')):
+                continue
+            try:
+                values = read_values(os.path.join(self.directory, name))
+            except (OSError, ValueError, struct.error):
+                continue
+            for key, value in values.items():
+                totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format """
+
+        families = {}
+        for key, value in self.collect().items():
+            name, labels = json.loads(key)
+            families.setdefault(_family(name), []).append((name, labels, value))
+
+        lines = []
+        for family in sorted(families):
+            kind, text = HELP.get(family, ('untyped', family))
+            lines.append(f'# HELP {family} {text}')
+            lines.append(f'# TYPE {family} {kind}')
+
+            samples = families[family]
+            if kind == 'histogram':
+                samples = _cumulative(samples, self.bounds)
+            for name, labels, value in sorted(samples, key=_sample_order):
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _key(name, labels):
+
+    return json.dumps([name, list(labels)])
+
+
+def _le(bound):
+
+    return repr(float(bound))
+
+
+def _family(name):
+
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in HELP:
+            return name[:-len(suffix)]
+    return name
+
+
+def _cumulative(samples, bounds):
+    """ Histogram samples with running bucket totals """
+
+    order = {_le(bound): i for i, bound in enumerate(bounds)}
+    order['+Inf'] = len(bounds)
+
+    buckets = {}
+    others = []
+    for name, labels, value in samples:
+        if name.endswith('_bucket'):
+            base = tuple(tuple(label) for label in labels if label[0] != 'le')
+            le = dict(labels)['le']
+            buckets.setdefault(base, {})[le] = value
+        else:
+            others.append((name, labels, value))
+
+    result = []
+    family = _family(samples[0][0])
+    for base, counts in buckets.items():
+        total = 0.0
+        for le in sorted(order, key=order.get):
+            total += counts.get(le, 0.0)
+            result.append((family + '_bucket', [list(label) for label in base] + [['le', le]], total))
+    return result + others
+
+
+def _sample_order(sample):
+
+    name, labels, value = sample
+    plain = [label for label in labels if label[0] != 'le']
+    le = dict(map(tuple, labels)).get('le')
+    rank = float('inf') if le in (None, '+Inf') else float(le)
+    return (json.dumps(plain), name, rank)
+
+
+def _labels(labels):
+
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _escape(value):
+
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value):
+
+    return str(int(value)) if value == int(value) else repr(value)
@@ -0,0 +1,331 @@
+"""
+Replay caches - bounded, TTL evicting stores of consumed IDs
+
+SamlSP records the InResponseTo request ID and the Assertion ID(s) of every
+accepted SAMLResponse. A response carrying an ID already in the cache is a
+replay and is rejected - before signature verification when the IDs can be
+found by a cheap scan of the response.
+
+cache.add(key, ttl=None)    => True if key was added, False if already present (a replay)
+key in cache                => True if key is present and unexpired
+
+A key is kept the cache's ttl, or ttl seconds if that's longer: SamlSP keeps
+an Assertion's ID until the Assertion expires, however long it is valid for.
+
+Keys are hashed to a fixed 16 byte digest, so memory use is predictable:
+max_entries bounds the size of every backend.
+
+- MemoryReplayCache         in-process (default)
+- SqliteReplayCache         a SQLite file shared by processes on a host
+- SharedMemoryReplayCache   a shared memory hash table shared by processes on a host
+"""
+import heapq
+import itertools
+import os
+import sqlite3
+import struct
+import threading
+import time
+from hashlib import blake2b
+from multiprocessing import shared_memory
+
+
+def digest(key):
+    """ Fixed size digest of a key """
+
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return blake2b(key, digest_size=16).digest()
+
+
+class MemoryReplayCache:
+    """
+    In-process replay cache
+
+    cache = MemoryReplayCache(ttl=300, max_entries=100000)
+
+    - Entries are also kept in a heap by expiry: eviction pops the entry
+      expiring soonest, O(log n).
+    - When full, the entry expiring soonest is evicted.
+    """
+
+    def __init__(self, ttl=300, max_entries=100000):
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+
+        # (expires, order added, key) - oldest first among equal expiries
+        self.expiry = []
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+
+
+    def __contains__(self, key):
+
+        expires = self.entries.get(digest(key))
+        return expires is not None and expires >= time.time()
+
+
+    def __len__(self):
+
+        return len(self.entries)
+
+
+    def add(self, key, ttl=None):
+        """ Add key (for ttl seconds, if longer than the cache's), returns False if it was already present """
+
+        key = digest(key)
+        now = time.time()
+
+        with self.lock:
+            self.__evict(now)
+
+            if key in self.entries:
+                return False
+
+            expires = now + max(self.ttl, ttl or 0)
+            self.entries[key] = expires
+            heapq.heappush(self.expiry, (expires, next(self.order), key))
+            return True
+
+
+    def __evict(self, now):
+        """ Drop expired entries and make room for one more """
+
+        entries = self.entries
+        expiry = self.expiry
+        while expiry:
+            expires, order, soonest = expiry[0]
+            if expires >= now and len(entries) < self.max_entries:
+                break
+            heapq.heappop(expiry)
+            del entries[soonest]
+
+
+class SqliteTable:
+    """
+    A SQLite table of expiring rows - shared by every process opening the same file
+
+    - One connection per thread, WAL journal
+    - Expired rows are purged every purge_every writes, and the soonest
+      expiring trimmed to max_entries
+    - A subclass names its table, key column and columns (beside expires)
+    """
+
+    purge_every = 256
+
+    table = None
+    key = None
+    columns = None
+
+    def __init__(self, path, ttl, max_entries):
+
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.local = threading.local()
+
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {self.table} '
+                f'({self.columns}, expires REAL NOT NULL) WITHOUT ROWID')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_expires ON {self.table} (expires)')
+
+
+    def _conn(self):
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None,
+                    check_same_thread=False)
+            self.local.conn = conn
+            self.local.writes = 0
+        return conn
+
+
+    def _wrote(self, now):
+        """ Count a write, purging every purge_every """
+
+        self.local.writes += 1
+        if self.local.writes % self.purge_every == 0:
+            self.purge(now)
+
+
+    def __len__(self):
+
+        return self._conn().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+
+    def purge(self, now=None):
+        """ Remove expired rows and trim to max_entries """
+
+        conn = self._conn()
+        now = now if now else time.time()
+        conn.execute(f'DELETE FROM {self.table} WHERE expires < ?', (now,))
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            conn.execute(f'DELETE FROM {self.table} WHERE {self.key} IN '
+                    f'(SELECT {self.key} FROM {self.table} ORDER BY expires LIMIT ?)', (excess,))
+
+
+class SqliteReplayCache(SqliteTable):
+    """
+    SQLite replay cache - shared by every process opening the same file
+
+    cache = SqliteReplayCache(path, ttl=300, max_entries=100000)
+
+    - One connection per thread, WAL journal
+    - Expired entries are purged every purge_every adds
+    """
+
+    table = 'seen'
+    key = 'key'
+    columns = 'key BLOB PRIMARY KEY'
+
+    def __init__(self, path, ttl=300, max_entries=100000):
+
+        super().__init__(path, ttl, max_entries)
+
+
+    def __contains__(self, key):
+
+        row = self._conn().execute('SELECT 1 FROM seen WHERE key = ? AND expires >= ?',
+                (digest(key), time.time())).fetchone()
+        return row is not None
+
+
+    def add(self, key, ttl=None):
+        """ Add key (for ttl seconds, if longer than the cache's), returns False if it was already present """
+
+        conn = self._conn()
+        now = time.time()
+
+        # insert, or take over an expired entry - atomic in SQLite
+        cur = conn.execute('INSERT INTO seen (key, expires) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET expires = excluded.expires '
+                'WHERE seen.expires < ?',
+                (digest(key), now + max(self.ttl, ttl or 0), now))
+        added = cur.rowcount == 1
+
+        self._wrote(now)
+        return added
+
+
+class SharedMemoryReplayCache:
+    """
+    Shared memory replay cache - shared by every process attaching to name
+
+    cache = SharedMemoryReplayCache(name='BottleSaml-replay', ttl=300, max_entries=65536)
+
+    - An open addressing hash table of (digest, expires) slots in a
+      multiprocessing.shared_memory segment, sized for max_entries.
+    - A lookup scans a fixed window of probe slots: O(1) independent of size
+    - When a window is full the slot expiring soonest is evicted
+    - Writers serialize on an flock()ed lock file (POSIX only)
+    - The segment outlives its creator: call unlink() to remove it
+    """
+
+    slot = struct.Struct('16sd')
+    probes = 16
+
+    def __init__(self, name='BottleSaml-replay', ttl=300, max_entries=65536, lockfile=None):
+
+        import fcntl
+        self.fcntl = fcntl
+
+        self.ttl = ttl
+
+        # power of two, half full at max_entries
+        self.nslots = 1 << max(self.probes, max_entries * 2 - 1).bit_length()
+        size = self.nslots * self.slot.size
+
+        try:
+            self.shm = _shared_memory(name, create=True, size=size)
+        except FileExistsError:
+            self.shm = _shared_memory(name, create=False, size=size)
+
+        if self.shm.size < size:
+            raise ValueError(f'Shared memory "{name}" is smaller than max_entries requires')
+
+        self.buf = self.shm.buf
+        self.lockfile = lockfile or os.path.join('/tmp', f'{name}.lock')
+        self.lockfd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o600)
+        self.lock = threading.Lock()
+
+
+    def __window(self, key):
+        """ First slot of key's probe window """
+
+        return int.from_bytes(key[:8], 'little') & (self.nslots - 1)
+
+
+    def __slots(self, key):
+        """ (slot index, digest, expires) of key's probe window """
+
+        first = self.__window(key)
+        for n in range(self.probes):
+            index = (first + n) & (self.nslots - 1)
+            yield (index,) + self.slot.unpack_from(self.buf, index * self.slot.size)
+
+
+    def __contains__(self, key):
+
+        key = digest(key)
+        now = time.time()
+        return any(k == key and expires >= now for _, k, expires in self.__slots(key))
+
+
+    def add(self, key, ttl=None):
+        """ Add key (for ttl seconds, if longer than the cache's), returns False if it was already present """
+
+        key = digest(key)
+        now = time.time()
+
+        with self.lock:
+            self.fcntl.flock(self.lockfd, self.fcntl.LOCK_EX)
+            try:
+                victim = victim_expires = None
+                for index, k, expires in self.__slots(key):
+                    if k == key and expires >= now:
+                        return False
+                    if victim is None or expires < victim_expires:
+                        victim, victim_expires = index, expires
+
+                self.slot.pack_into(self.buf, victim * self.slot.size, key, now + max(self.ttl, ttl or 0))
+                return True
+
+            finally:
+                self.fcntl.flock(self.lockfd, self.fcntl.LOCK_UN)
+
+
+    def close(self):
+        """ Detach from the shared memory segment """
+
+        self.buf = None
+        self.shm.close()
+        os.close(self.lockfd)
+
+
+    def unlink(self):
+        """ Remove the shared memory segment """
+
+        if getattr(self.shm, 'untracked', False):
+            # python < 3.13 unlink() also unregisters from the resource tracker
+            from multiprocessing import resource_tracker
+            resource_tracker.register(self.shm._name, 'shared_memory')
+        self.shm.unlink()
+
+
+def _shared_memory(name, create, size):
+    """ SharedMemory not removed by the resource tracker when this process exits """
+
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:
+        # python < 3.13
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        shm.untracked = True
+        return shm
@@ -1,31 +1,72 @@
+import hashlib
+import hmac
 import os
-from secrets import token_urlsafe
+import re
+import time
+from base64 import urlsafe_b64encode
+from secrets import token_bytes, token_urlsafe
 
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet
+
+from .keyring import KeyRing
 
 DEBUG = os.getenv('DEBUG',False)
 
+# 'Id' + unpadded urlsafe base64 Fernet token
+FERNET_ID = re.compile(r'Id[A-Za-z0-9_-]{40,200}')
+
+# 'Id' + 8 hex timestamp + 8 char nonce + 16 char truncated HMAC-SHA256
+HMAC_ID = re.compile(r'Id[0-9a-f]{8}[A-Za-z0-9_-]{24}')
+HMAC_ID_LEN = 34
+
+# seconds a request ID's timestamp may be ahead of our clock
+CLOCK_SKEW = 5
+
 
 class ReqID:
     """ 
     Create and validate request ID's
+
+    engine - how request ID's are made when IdP initiated logins are refused:
+        'fernet'    Fernet encrypted (default)
+        'hmac'      Id<timestamp><nonce><truncated HMAC> - no encryption,
+                    validated by a constant time compare
+
+    keyring - KeyRing of keys shared by worker processes
+        (def: a random key valid in this process only)
     """
 
-    def __init__(self, idpok=False, id='ReqID', ttl=30):
+    def __init__(self, idpok=False, id='ReqID', ttl=30, engine='fernet', keyring=None):
+
+        if engine not in ('fernet', 'hmac'):
+            raise ValueError(f'Unknown request ID engine "{engine}"')
 
-        if not idpok:
+        if not idpok and engine == 'hmac':
             # Not accepting IDP initiated Logon
-            self.key = Fernet.generate_key()
-            self.f = Fernet(self.key)
+            self.keyring = keyring if keyring else KeyRing()
+            self.id = id.encode('utf-8')
+            self.ttl = ttl
+
+            self.new_requestID = self.__hmac_new_requestID
+            self.validate_requestID = self.__hmac_validate_requestID
+            self.well_formed = self.__hmac_well_formed
+
+        elif not idpok:
+            # Not accepting IDP initiated Logon
+            self.keyring = keyring if keyring else KeyRing()
+            self.signing = self.verifying = None
             self.id = id.encode('utf-8')
             self.ttl = ttl
 
             self.new_requestID = self.__noidp_new_requestID
             self.validate_requestID = self.__noidp_validate_requestID
+            self.well_formed = self.__noidp_well_formed
+
         else:
             # Accepting IDP initiated Logon
             self.new_requestID = self.__idpok_new_requestID
             self.validate_requestID = self.__idpok_validate_requestID
+            self.well_formed = self.__idpok_well_formed
 
 
     def __idpok_new_requestID(self):
@@ -39,13 +80,37 @@ class ReqID:
 
         return True
 
+
+    def __idpok_well_formed(self, reqid):
+        """ IDP OK so anything goes """
+
+        return True
+
 #
 # For NoIDP accepted, Request ID is Frenet encrypted
 #
+    def __fernet(self):
+        """ Fernet for the keyring's current key """
+
+        key = self.keyring.signing_key()
+        if self.signing is None or self.signing[0] != key:
+            self.signing = (key, Fernet(urlsafe_b64encode(key)))
+        return self.signing[1]
+
+
+    def __multifernet(self):
+        """ MultiFernet for every key that may have made a request ID """
+
+        keys = tuple(self.keyring.verify_keys())
+        if self.verifying is None or self.verifying[0] != keys:
+            self.verifying = (keys, MultiFernet([Fernet(urlsafe_b64encode(k)) for k in keys]))
+        return self.verifying[1]
+
+
     def __noidp_new_requestID(self):
         """ Create a new request ID """
 
-        reqid = self.f.encrypt(self.id).decode()
+        reqid = self.__fernet().encrypt(self.id).decode()
         # Azure AD particulars: can't start with a digit
         # and barfs on '=' padding
         return 'Id' + reqid[:reqid.find('=')]
@@ -64,7 +129,7 @@ class ReqID:
             # convert to bytes
             reqid = reqid.encode('utf-8')
 
-            mess = self.f.decrypt(reqid, self.ttl)
+            mess = self.__multifernet().decrypt(reqid, self.ttl)
             if mess:
                 if mess == self.id:
                     return True
@@ -77,3 +142,55 @@ class ReqID:
         return False
 
 
+    def __noidp_well_formed(self, reqid):
+        """ Cheap check reqid could be one of ours - no crypto """
+
+        return reqid is not None and FERNET_ID.fullmatch(reqid) is not None
+
+#
+# For NoIDP accepted, HMAC engine: Request ID is a signed timestamp and nonce
+#
+    def __hmac_mac(self, key, body):
+        """ Truncated HMAC of the request ID body (str) """
+
+        mac = hmac.new(key, self.id + body.encode('ascii'), hashlib.sha256).digest()
+        return urlsafe_b64encode(mac[:12]).decode('ascii')
+
+
+    def __hmac_new_requestID(self):
+        """ Create a new request ID """
+
+        now = int(time.time())
+        # 8 hex digit timestamp, 6 random bytes as 8 base64 characters
+        body = f'{now:08x}' + urlsafe_b64encode(token_bytes(6)).decode('ascii')
+        return 'Id' + body + self.__hmac_mac(self.keyring.signing_key(now), body)
+
+
+    def __hmac_validate_requestID(self, reqid):
+        """ Validate request ID """
+        try:
+            if len(reqid) != HMAC_ID_LEN or not reqid.startswith('Id'):
+                return False
+
+            issued = int(reqid[2:10], 16)
+            age = int(time.time()) - issued
+            if age > self.ttl or age < -CLOCK_SKEW:
+                return False
+
+            # the timestamp picks the rotate period's keys
+            body, mac = reqid[2:18], reqid[18:]
+            return any(hmac.compare_digest(self.__hmac_mac(key, body), mac)
+                    for key in self.keyring.verify_keys(issued))
+
+        except Exception as e:
+            if DEBUG:
+                raise e
+            pass
+
+        return False
+
+
+    def __hmac_well_formed(self, reqid):
+        """ Cheap check reqid could be one of ours - no crypto """
+
+        return reqid is not None and HMAC_ID.fullmatch(reqid) is not None
@@ -0,0 +1,235 @@
+"""
+ProcessValidator - SAMLResponse verification on a pool of processes
+
+validator = ProcessValidator(processes=4)
+saml_resp, assertion_id, expires = validator.validate(raw_saml_resp, idp)
+
+- verify_response() (XML parsing, canonicalization, RSA) is CPU bound and
+  holds the GIL throughout. A ProcessValidator ships the raw SAMLResponse,
+  the IdP's certificates (DER) and audience to a worker process and gets
+  back the parsed fields - so verification scales with cores, not with one
+  interpreter.
+- Workers parse each certificate once and keep it.
+- At most pending validations are queued or running (def: 2 per process);
+  further callers wait for a slot.
+- The pool is started on first use in each process, so it can be created
+  before a server forks its workers.
+- Workers are started by a forkserver (spawned where there is none), not
+  forked from the calling process: a threaded server's worker may hold
+  locks - the log writer's, a database connection's - that a forked copy
+  would find held forever.
+- Results are (minisaml Response, Assertion ID, its expiry), as
+  verify_response() returns; rejections are raised as ValidationFailed with the worker's
+  message, and anything else the worker raised as ValidationError.
+
+verify_response() is minisaml's validate_response(), also returning the ID
+of the Assertion whose signature it verified - the ID the replay cache must
+record - and its NotOnOrAfter (epoch seconds): how long it must be kept. An ID found by scanning the XML can't be trusted for that: the
+scan may pick up another attribute, or another Assertion, than the one the
+signature covers.
+"""
+import base64
+import datetime
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509 import Certificate, load_der_x509_certificate
+from lxml.etree import QName, XMLSyntaxError
+from minisaml.errors import (AudienceMismatch, MalformedSAMLResponse, MiniSAMLError, ResponseExpired,
+        ResponseTooEarly)
+from minisaml.internal.constants import NAMES_SAML2_ASSERTION, NAMES_SAML2_PROTOCOL
+from minisaml.internal.saml import saml_to_datetime
+from minisaml.internal.utils import find_or_raise
+from minisaml.response import Response, gather_attributes
+from minisignxml.config import VerifyConfig
+from minisignxml.errors import ElementNotFound, MiniSignXMLError
+from minisignxml.verify import extract_verified_element_and_certificate
+
+
+class ValidationFailed(Exception):
+    """ verify_response() rejected the response in a worker """
+
+
+class ValidationError(Exception):
+    """ verify_response() raised something else in a worker """
+
+
+# what verify_response() raises for a response it rejects - anything else is an error
+# (bad base64 and forbidden XML constructs are ValueErrors)
+REJECTED = (MiniSAMLError, MiniSignXMLError, XMLSyntaxError, ValueError, ValidationFailed)
+
+
+def verify_response(data, certificate, expected_audience):
+    """
+    minisaml's validate_response(), and the verified Assertion's ID and expiry
+
+    - returns (Response, assertion ID, NotOnOrAfter as epoch seconds), or
+      raises as validate_response()
+    - the same checks in the same order as minisaml 22.4's validate_response()
+    """
+
+    xml = base64.b64decode(data)
+    certificates = {certificate} if isinstance(certificate, Certificate) else certificate
+    element, certificate_used = extract_verified_element_and_certificate(
+            xml=xml, certificates=certificates, config=VerifyConfig.default())
+
+    if element.tag == QName(NAMES_SAML2_PROTOCOL, 'Response'):
+        assertion = find_or_raise(element, './saml:Assertion')
+    elif element.tag == QName(NAMES_SAML2_ASSERTION, 'Assertion'):
+        assertion = element
+    else:
+        raise MalformedSAMLResponse(
+                'Signed element is neither a Response with an Assertion, nor an Assertion')
+
+    assertion_id = assertion.get('ID')
+    if not assertion_id:
+        raise MalformedSAMLResponse('Assertion has no ID')
+
+    issuer = find_or_raise(assertion, './saml:Issuer').text
+    subject = find_or_raise(assertion, './saml:Subject')
+    name_id = find_or_raise(subject, './saml:NameID').text
+    confirmation = find_or_raise(subject, './saml:SubjectConfirmation')
+    confirmation_data = find_or_raise(confirmation, './saml:SubjectConfirmationData')
+    in_response_to = confirmation_data.attrib.get('InResponseTo', None)
+
+    conditions = find_or_raise(assertion, './saml:Conditions')
+    not_before = saml_to_datetime(conditions.attrib['NotBefore'])
+    not_on_or_after = saml_to_datetime(conditions.attrib['NotOnOrAfter'])
+    now = datetime.datetime.utcnow()
+    if now < not_before:
+        raise ResponseTooEarly()
+    if now >= not_on_or_after:
+        raise ResponseExpired()
+
+    audience = find_or_raise(conditions, './saml:AudienceRestriction/saml:Audience').text
+    if audience != expected_audience:
+        raise AudienceMismatch(received_audience=audience, expected_audience=expected_audience)
+
+    raw_session_not_on_or_after = find_or_raise(
+            assertion, './saml:AuthnStatement').attrib.get('SessionNotOnOrAfter', None)
+    session_not_on_or_after = raw_session_not_on_or_after and saml_to_datetime(raw_session_not_on_or_after)
+
+    try:
+        attribute_statement = find_or_raise(assertion, './saml:AttributeStatement')
+    except ElementNotFound:
+        attribute_statement = None
+    attributes = list(gather_attributes(attribute_statement)) if attribute_statement is not None else []
+
+    saml_resp = Response(issuer=issuer, name_id=name_id, audience=audience,
+            attributes=attributes, session_not_on_or_after=session_not_on_or_after,
+            in_response_to=in_response_to, certificate=certificate_used)
+    expires = not_on_or_after.replace(tzinfo=datetime.timezone.utc).timestamp()
+    return saml_resp, assertion_id, expires
+
+
+# worker process: DER => Certificate
+_certificates = {}
+
+
+def _validate(raw_saml_resp, ders, audience):
+    """
+    Worker: verify_response() with picklable arguments and result
+
+    - returns ('ok', fields, index of the certificate used, assertion ID, expires),
+      ('fail', message) if rejected, or ('error', message)
+    """
+
+    certs = []
+    for der in ders:
+        cert = _certificates.get(der)
+        if cert is None:
+            cert = _certificates[der] = load_der_x509_certificate(der)
+        certs.append(cert)
+
+    try:
+        saml_resp, assertion_id, expires = verify_response(raw_saml_resp, certs, audience)
+    except REJECTED as e:
+        return ('fail', f'{e.__class__.__name__}: {str(e)}')
+    except Exception as e:
+        return ('error', f'{e.__class__.__name__}: {str(e)}')
+
+    fields = (saml_resp.issuer, saml_resp.name_id, saml_resp.audience,
+            saml_resp.attributes, saml_resp.session_not_on_or_after,
+            saml_resp.in_response_to)
+    return ('ok', fields, certs.index(saml_resp.certificate), assertion_id, expires)
+
+
+class ProcessValidator:
+    """
+    verify_response() on worker processes
+
+    processes - worker processes
+    pending - validations queued or running at once (def: 2 per process)
+    start_method - how workers are started (def: None - 'forkserver', or
+                   'spawn' where there is no forkserver)
+    """
+
+    def __init__(self, processes, pending=None, start_method=None):
+
+        self.processes = processes
+        if start_method is None:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.context = multiprocessing.get_context(start_method)
+        self.slots = threading.BoundedSemaphore(pending or processes * 2)
+
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+        # Certificate => DER
+        self.ders = {}
+
+
+    def __pool(self):
+        """ The pool of this process (a forked worker starts its own) """
+
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=self.context)
+                    self.pid = os.getpid()
+        return self.pool
+
+
+    def __der(self, cert):
+
+        der = self.ders.get(cert)
+        if der is None:
+            der = self.ders[cert] = cert.public_bytes(Encoding.DER)
+        return der
+
+
+    def validate(self, raw_saml_resp, idp):
+        """ As SamlCore.validate(): the verified (Response, assertion ID, expires), or raises """
+
+        certs = list(idp.certificates)
+        ders = tuple(self.__der(cert) for cert in certs)
+
+        if isinstance(raw_saml_resp, str):
+            raw_saml_resp = raw_saml_resp.encode('ascii')
+
+        with self.slots:
+            result = self.__pool().submit(_validate, raw_saml_resp, ders, idp.audience).result()
+
+        if result[0] == 'fail':
+            raise ValidationFailed(result[1])
+        if result[0] == 'error':
+            raise ValidationError(result[1])
+
+        issuer, name_id, audience, attributes, session_not_on_or_after, in_response_to = result[1]
+        saml_resp = Response(issuer=issuer, name_id=name_id, audience=audience,
+                attributes=attributes, session_not_on_or_after=session_not_on_or_after,
+                in_response_to=in_response_to, certificate=certs[result[2]])
+        return saml_resp, result[3], result[4]
+
+
+    def close(self):
+        """ Shut down this process's pool """
+
+        if self.pool is not None and self.pid == os.getpid():
+            self.pool.shutdown()
+        self.pool = None
+        self.pid = None
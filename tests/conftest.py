@@ -0,0 +1,10 @@
+import pytest
+
+from benchmarks.fakeidp import FakeIdP
+
+
+@pytest.fixture(scope='session')
+def idp():
+    """ One throwaway IdP (key generation is slow) for the whole run """
+
+    return FakeIdP(key_size=1024)
@@ -0,0 +1,79 @@
+import base64
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+from BottleSaml import AttrStore, MemoryAttrBackend, SamlCore, SqliteAttrBackend
+from BottleSaml.attrstore import REFS
+from BottleSaml.log import QueueLog
+
+GROUPS = [f'urn:example:groups:{n:04d}' for n in range(100)]
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+
+    if request.param == 'memory':
+        return MemoryAttrBackend(ttl=60, max_entries=8)
+    return SqliteAttrBackend(str(tmp_path / 'attrs.db'), ttl=60, max_entries=8)
+
+
+def test_values_are_shared_by_content(backend):
+
+    store = AttrStore(backend, threshold=64)
+    a = store.externalize({'groups': GROUPS, 'mail': 'a@example.test'})
+    b = store.externalize({'groups': list(GROUPS), 'mail': 'b@example.test'})
+
+    assert a[REFS] == b[REFS] and 'groups' not in a
+    assert store.resolve(a) == {'groups': GROUPS, 'mail': 'a@example.test'}
+
+
+def test_each_resolve_gets_its_own_copy(backend):
+
+    store = AttrStore(backend, threshold=64)
+    a = store.externalize({'groups': list(GROUPS)})
+    b = store.externalize({'groups': list(GROUPS)})
+
+    store.resolve(a)['groups'].append('admins')
+    assert store.resolve(b)['groups'] == GROUPS
+
+    # also once the value comes from the backend
+    store.lru.clear()
+    store.resolve(a)['groups'].append('admins')
+    assert store.resolve(b)['groups'] == GROUPS
+
+
+def test_the_backend_is_bounded(backend):
+
+    for n in range(20):
+        backend.put(f'digest{n}', b'[]')
+    if isinstance(backend, SqliteAttrBackend):
+        backend.purge()
+
+    kept = [n for n in range(20) if backend.get(f'digest{n}') is not None]
+    assert kept == list(range(12, 20))
+
+
+def test_a_session_whose_values_are_gone_is_not_authenticated(backend, idp, monkeypatch):
+
+    store = AttrStore(backend, threshold=64)
+    core = SamlCore(idp.saml_config(idp_ok=True, assertions=['groups']),
+            log=QueueLog(level='error'), attr_store=store)
+
+    xml = idp.response_xml(core.saml_audience, attributes={'groups': GROUPS})
+    session = {}
+    body = urlencode({'SAMLResponse': base64.b64encode(xml).decode('ascii'), 'RelayState': ''})
+    assert core.acs(session, body.encode()).status == 302
+
+    assert core.is_authenticated(session)
+    assert core.session_attrs(session)['groups'] == GROUPS
+
+    # the backend's ttl has passed, and this process's LRU has been evicted
+    later = time.time() + 120
+    monkeypatch.setattr(time, 'time', lambda: later)
+    store.lru.clear()
+    session['attributes']['_saml']['expires'] = later + 60
+
+    assert core.session_attrs(session) is None
+    assert not core.is_authenticated(session)
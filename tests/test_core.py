@@ -0,0 +1,189 @@
+import asyncio
+import base64
+import threading
+import zlib
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit
+
+import pytest
+
+from BottleSaml import AttrStore, LoginRejected, Metrics, SamlCore, SqliteAttrBackend, SqliteReplayCache
+from BottleSaml.idp import IdP
+from BottleSaml.log import QueueLog
+
+
+@pytest.fixture
+def core(idp):
+
+    return SamlCore(idp.saml_config(), log=QueueLog(level='error'))
+
+
+def test_default_idp_settings_follow_the_registry(core, idp):
+
+    assert core.saml_endpoint == 'https://idp.example.test/sso'
+
+    # as a metadata refresh does
+    config = idp.saml_config(saml_endpoint='https://idp.example.test/sso2', force_reauth=True)
+    core.idps.replace(idp.issuer, IdP(config))
+
+    assert core.saml_endpoint == 'https://idp.example.test/sso2'
+    assert core.authn_request is core.idps.default.authn_request
+    assert core.force_reauth is True
+    assert 'ForceAuthn' in _request_xml(core.initiate_login())
+
+    with pytest.raises(AttributeError):
+        core.saml_endpoint = 'https://elsewhere.example.test/'
+
+
+def test_force_reauth_set_on_the_core_applies_to_every_idp(core):
+
+    assert 'ForceAuthn' not in _request_xml(core.initiate_login())
+
+    core.force_reauth = True
+    assert core.force_reauth is True
+    assert core.idps.default.force_reauth is False
+    assert 'ForceAuthn' in _request_xml(core.initiate_login())
+
+
+def _request_xml(reply):
+
+    saml_request = parse_qs(urlsplit(reply.location).query)['SAMLRequest'][0]
+    return zlib.decompress(base64.b64decode(saml_request), -15).decode('utf-8')
+
+
+def test_attributes_are_saved_under_their_configured_names(idp):
+
+    core = SamlCore(idp.saml_config(idp_ok=True, user_attr='UID', assertions=['uid', 'memberOf'],
+            assertion_rules={'DisplayName': {'shape': 'single'}}, session_encoding='compact'),
+            log=QueueLog(level='error'))
+
+    xml = idp.response_xml(core.saml_audience, attributes={
+            'Uid': 'jdoe', 'MEMBEROF': ['a', 'b'], 'displayname': 'J Doe'})
+    session = {}
+    assert core.acs(session, _acs_body(xml)).status == 302
+
+    assert session['username'] == 'jdoe'
+    # every name is in the compact schema: stored as its index
+    assert all(isinstance(key, int) for key in session['attributes']['a'][::2])
+
+    attrs = core.session_attrs(session)
+    assert {k: v for k, v in attrs.items() if k != '_saml'} == {
+            'uid': 'jdoe', 'memberOf': ['a', 'b'], 'DisplayName': 'J Doe', 'username': 'jdoe'}
+
+
+def _acs_body(xml):
+
+    return urlencode({'SAMLResponse': base64.b64encode(xml).decode('ascii'), 'RelayState': ''}).encode()
+
+
+class Stages(Metrics):
+
+    def __init__(self):
+        self.outcomes = {}
+
+    def stage(self, stage, seconds, outcome):
+        self.outcomes[stage] = outcome
+
+
+def test_stage_outcomes_tell_rejections_from_errors(idp):
+
+    metrics = Stages()
+    core = SamlCore(idp.saml_config(idp_ok=True), log=QueueLog(level='error'), metrics=metrics)
+
+    # a response for another audience is rejected
+    xml = idp.response_xml('https://other.example.test/')
+    assert core.acs({}, _acs_body(xml)).status == 400
+    assert metrics.outcomes['validate'] == 'fail'
+
+    @core.add_login_hook
+    def refuse(username, attrs):
+        raise LoginRejected('not today')
+
+    assert core.acs({}, _acs_body(idp.response_xml(core.saml_audience))).status == 403
+    assert metrics.outcomes['hooks'] == 'fail'
+
+    core.login_hooks.remove(refuse)
+
+    @core.add_login_hook
+    def crash(username, attrs):
+        raise KeyError('bug')
+
+    assert core.acs({}, _acs_body(idp.response_xml(core.saml_audience))).status == 403
+    assert metrics.outcomes['hooks'] == 'error'
+
+    def broken(raw_saml_resp, idp):
+        raise RuntimeError('bug')
+
+    core.validate = broken
+    assert core.acs({}, _acs_body(idp.response_xml(core.saml_audience))).status == 400
+    assert metrics.outcomes['validate'] == 'error'
+
+
+def test_oversized_responses_are_rejected_without_a_content_length(idp):
+
+    core = SamlCore(idp.saml_config(idp_ok=True, max_response_size=100), log=QueueLog(level='error'))
+    body = _acs_body(idp.response_xml(core.saml_audience))
+
+    # raw bytes (as an ASGI app passes), and decoded fields of unknown size
+    assert core.acs({}, body).status == 400
+    assert core.acs({}, lambda: dict(parse_qsl(body.decode()))).status == 400
+    assert 'exceeds' in core.acs({}, {'SAMLResponse': 'x' * 101}).body
+
+
+def test_acs_async_keeps_blocking_steps_off_the_event_loop(idp, tmp_path):
+
+    threads = set()
+
+    class Recorded(SqliteReplayCache):
+
+        def __contains__(self, key):
+            threads.add(threading.current_thread())
+            return super().__contains__(key)
+
+        def add(self, key, ttl=None):
+            threads.add(threading.current_thread())
+            return super().add(key, ttl)
+
+    store = AttrStore(SqliteAttrBackend(str(tmp_path / 'attrs.db')), threshold=16)
+    store.externalize = _recorded(store.externalize, threads)
+    core = SamlCore(idp.saml_config(idp_ok=True, assertions=['groups']), log=QueueLog(level='error'),
+            replay_cache=Recorded(str(tmp_path / 'replay.db')), attr_store=store)
+    core.is_authenticated = _recorded(core.is_authenticated, threads)
+
+    async def login():
+        xml = idp.response_xml(core.saml_audience, attributes={'groups': ['a' * 20, 'b' * 20]})
+        return threading.current_thread(), await core.acs_async({}, _acs_body(xml))
+
+    loop_thread, reply = asyncio.run(login())
+    assert reply.status == 302
+    assert threads and loop_thread not in threads
+
+
+def _recorded(f, threads):
+
+    def recorded(*args):
+        threads.add(threading.current_thread())
+        return f(*args)
+    return recorded
+
+
+def test_a_renewal_answered_for_another_user_logs_the_session_out(idp):
+
+    core = SamlCore(idp.saml_config(idp_ok=True, renew_window=600), log=QueueLog(level='error'))
+    session = {}
+    assert core.acs(session, _acs_body(idp.response_xml(core.saml_audience, name_id='alice@example.test'))).status == 302
+
+    session['cart'] = ['a']
+    core.start_renewal(session, '/cart')
+    xml = idp.response_xml(core.saml_audience, name_id='bob@example.test')
+    assert core.acs(session, _acs_body(xml)).status == 403
+
+    assert session == {} and core.renewals['failed'] == 1
+
+    # the same user is renewed
+    assert core.acs(session, _acs_body(idp.response_xml(core.saml_audience, name_id='alice@example.test'))).status == 302
+    session['cart'] = ['a']
+    core.start_renewal(session, '/cart')
+    reply = core.acs(session, _acs_body(idp.response_xml(core.saml_audience, name_id='alice@example.test')))
+    assert reply.status == 302
+    assert session['username'] == 'alice@example.test' and session['cart'] == ['a']
+    assert core.renewals['early'] == 1
@@ -0,0 +1,168 @@
+import threading
+import time
+
+import pytest
+
+from BottleSaml import SamlCore
+from BottleSaml.hooks import HookTimeout, LoginHooks
+from BottleSaml.log import QueueLog
+from BottleSaml.metrics import Metrics
+
+
+class Outcomes(Metrics):
+
+    def __init__(self):
+        self.outcomes = []
+
+    def hook(self, hook, seconds, outcome):
+        self.outcomes.append((hook, outcome))
+
+
+def run(hooks, metrics=None):
+
+    return hooks.run('user', {}, metrics or Outcomes(), QueueLog(level='error'))
+
+
+def test_an_exempt_hook_runs_on_the_request_thread():
+
+    threads = []
+
+    def builtin(username, attrs):
+        threads.append(threading.current_thread())
+        time.sleep(0.05)
+        return username, attrs
+
+    hooks = LoginHooks(budget=0.01, on_budget='fail')
+    hooks.exempt(hooks.add(builtin))
+
+    assert run(hooks) == ('user', {})
+    assert threads == [threading.current_thread()]
+
+
+def test_the_budget_runs_from_when_a_hook_starts():
+
+    def hook(username, attrs):
+        time.sleep(0.15)
+        return username, attrs
+
+    # one thread: the second login's hook waits for the first's
+    hooks = LoginHooks([hook], budget=0.2, on_budget='fail', workers=1)
+    metrics = Outcomes()
+    logins = [threading.Thread(target=run, args=(hooks, metrics)) for n in range(2)]
+    for login in logins:
+        login.start()
+    for login in logins:
+        login.join()
+
+    assert metrics.outcomes == [('hook', 'ok'), ('hook', 'ok')]
+
+
+def test_a_hook_queued_past_its_budget_is_cancelled():
+
+    release = threading.Event()
+    calls = []
+
+    def stalled(username, attrs):
+        release.wait()
+        return username, attrs
+
+    def queued(username, attrs):
+        calls.append(1)
+        return username, attrs
+
+    hooks = LoginHooks([stalled], budget=0.05, on_budget='fail', workers=1)
+    with pytest.raises(HookTimeout):
+        run(hooks)
+
+    hooks[:] = [queued]
+    with pytest.raises(HookTimeout):
+        run(hooks)
+
+    release.set()
+    hooks.executor.shutdown(wait=True)
+    assert calls == []
+
+
+def test_stalled_calls_are_bounded_per_hook():
+
+    release = threading.Event()
+    calls = []
+
+    def stalled(username, attrs):
+        calls.append(1)
+        release.wait()
+        return username, attrs
+
+    hooks = LoginHooks([stalled], budget=0.05, on_budget='fail', workers=4, max_stalled=2)
+    for n in range(2):
+        with pytest.raises(HookTimeout):
+            run(hooks)
+    assert len(calls) == 2
+
+    # at the limit: refused without a call, or waiting out the budget
+    metrics = Outcomes()
+    start = time.perf_counter()
+    with pytest.raises(HookTimeout):
+        run(hooks, metrics)
+    assert time.perf_counter() - start < 0.05
+    assert len(calls) == 2 and metrics.outcomes == [('stalled', 'timeout')]
+
+    release.set()
+    deadline = time.time() + 5
+    while hooks.stalled[stalled] and time.time() < deadline:
+        time.sleep(0.01)
+    assert run(hooks) == ('user', {})
+    assert len(calls) == 3
+
+
+def test_a_wave_runs_concurrently_and_merges_in_hook_order():
+
+    finished = []
+
+    def writer(key, seconds):
+        def hook(username, attrs):
+            time.sleep(seconds)
+            attrs[key] = True
+            attrs['undeclared'] = key
+            finished.append(key)
+            return username, attrs
+        hook.__name__ = key
+        return hook
+
+    # the first added finishes last
+    hooks = LoginHooks()
+    hooks.add(writer('first', 0.3), reads=['username'], writes=['first'])
+    hooks.add(writer('second', 0.2), reads=['username'], writes=['second'])
+    hooks.add(writer('third', 0.1), reads=['username'], writes=['third'])
+    assert [len(wave) for wave in hooks.waves()] == [3]
+
+    start = time.perf_counter()
+    username, attrs = run(hooks)
+    assert time.perf_counter() - start < 0.5
+    assert finished == ['third', 'second', 'first']
+
+    # only declared writes are kept, merged in the order the hooks were added
+    assert list(attrs) == ['first', 'second', 'third']
+
+
+def test_conflicting_declared_hooks_run_in_order():
+
+    def hook(username, attrs):
+        attrs['n'] = attrs.get('n', 0) + 1
+        return username, attrs
+
+    def double(username, attrs):
+        attrs['n'] = attrs['n'] * 2
+        return username, attrs
+
+    hooks = LoginHooks()
+    hooks.add(hook, reads=[], writes=['n'])
+    hooks.add(double, reads=['n'], writes=['n'])
+    assert [len(wave) for wave in hooks.waves()] == [1, 1]
+    assert run(hooks) == ('user', {'n': 2})
+
+
+def test_hook_workers_sizes_the_pool(idp):
+
+    core = SamlCore(idp.saml_config(hook_workers=32), log=QueueLog(level='error'))
+    assert core.login_hooks.workers == 32
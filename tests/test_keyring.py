@@ -0,0 +1,101 @@
+import time
+
+import pytest
+
+from BottleSaml import EnvKeys, FileKeys, KeyRing, KVKeys, LocalKV, new_secret
+from BottleSaml.keyring import parse_secrets
+from BottleSaml.reqID import ReqID
+
+
+@pytest.fixture(params=['fernet', 'hmac'])
+def engine(request):
+    return request.param
+
+
+def reqid(keyring, engine):
+    return ReqID(idpok=False, engine=engine, keyring=keyring, ttl=60)
+
+
+def test_workers_sharing_a_source_accept_each_others_ids(tmp_path, engine):
+
+    path = tmp_path / 'reqid.keys'
+    path.write_text(new_secret() + '\n')
+
+    a = reqid(KeyRing(FileKeys(str(path))), engine)
+    b = reqid(KeyRing(FileKeys(str(path))), engine)
+
+    assert b.validate_requestID(a.new_requestID())
+    assert b.well_formed(a.new_requestID())
+
+
+def test_without_a_source_ids_are_valid_in_this_process_only(engine):
+
+    a = reqid(KeyRing(), engine)
+    b = reqid(KeyRing(), engine)
+
+    request_id = a.new_requestID()
+    assert a.validate_requestID(request_id)
+    assert not b.validate_requestID(request_id)
+
+
+def test_a_replaced_secret_still_validates_until_dropped(engine):
+
+    kv = LocalKV()
+    source = KVKeys(kv)
+    kv.set(source.name, new_secret())
+
+    old = reqid(KeyRing(source), engine)
+    request_id = old.new_requestID()
+
+    source.add(new_secret())
+    new = reqid(KeyRing(source), engine)
+    assert new.validate_requestID(request_id)
+
+    source.add(new_secret(), keep=1)
+    newest = reqid(KeyRing(source), engine)
+    assert not newest.validate_requestID(request_id)
+
+
+def test_keyring_reloads_a_changed_source(monkeypatch):
+
+    monkeypatch.setenv('BSAML_TEST_KEYS', new_secret())
+    keyring = KeyRing(EnvKeys('BSAML_TEST_KEYS'), refresh=0)
+    before = keyring.signing_key()
+
+    monkeypatch.setenv('BSAML_TEST_KEYS', new_secret())
+    assert keyring.signing_key() != before
+
+
+def test_keyring_keeps_its_secrets_while_the_source_is_broken(monkeypatch):
+
+    monkeypatch.setenv('BSAML_TEST_KEYS', new_secret())
+    keyring = KeyRing(EnvKeys('BSAML_TEST_KEYS'), refresh=0)
+    before = keyring.signing_key()
+
+    monkeypatch.setenv('BSAML_TEST_KEYS', 'short')
+    assert keyring.signing_key() == before
+
+
+def test_rotation_keeps_the_previous_period_valid(monkeypatch, engine):
+
+    monkeypatch.setenv('BSAML_TEST_KEYS', new_secret())
+    keyring = KeyRing(EnvKeys('BSAML_TEST_KEYS'), rotate=3600)
+
+    start = 3600 * 1000 + 3590
+    monkeypatch.setattr(time, 'time', lambda: start)
+    ids = reqid(keyring, engine)
+    request_id = ids.new_requestID()
+
+    # the next period has begun: new keys, but the last period's still validate
+    monkeypatch.setattr(time, 'time', lambda: start + 20)
+    assert keyring.signing_key() != keyring.signing_key(start)
+    assert ids.validate_requestID(request_id)
+
+
+def test_parse_secrets_rejects_short_and_empty_sources():
+
+    with pytest.raises(ValueError):
+        parse_secrets('# only a comment\n')
+    with pytest.raises(ValueError):
+        parse_secrets('c2hvcnQ')
+    assert len(parse_secrets(new_secret() + ',' + new_secret())) == 2
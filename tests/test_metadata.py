@@ -0,0 +1,119 @@
+import email.message
+import io
+import json
+import os
+import time
+import urllib.error
+from types import SimpleNamespace
+
+import pytest
+
+from BottleSaml import metadata
+from BottleSaml.idp import IdPRegistry
+from BottleSaml.metadata import IdPMetadata, MetadataError
+
+URL = 'https://idp.example.test/metadata.xml'
+
+
+class FakeResponse(io.BytesIO):
+
+    def __init__(self, body, etag):
+
+        super().__init__(body)
+        self.headers = email.message.Message()
+        self.headers['ETag'] = etag
+
+
+@pytest.fixture
+def server(idp, monkeypatch):
+    """ The metadata URL: records each request's headers """
+
+    server = SimpleNamespace(down=False, requests=[])
+
+    def urlopen(req, timeout=None):
+        server.requests.append(dict(req.header_items()))
+        if server.down:
+            raise urllib.error.URLError('down')
+        if req.get_header('If-none-match') == '"v1"':
+            raise urllib.error.HTTPError(req.full_url, 304, 'Not Modified', None, None)
+        return FakeResponse(idp.metadata_xml(), '"v1"')
+
+    monkeypatch.setattr(metadata.urllib.request, 'urlopen', urlopen)
+    return server
+
+
+def test_plain_http_is_refused():
+
+    with pytest.raises(MetadataError):
+        IdPMetadata('http://idp.example.test/metadata.xml')
+
+
+def test_a_fresh_url_cache_is_not_fetched(server, tmp_path):
+
+    IdPMetadata(URL, cache_dir=str(tmp_path)).load()
+    assert len(server.requests) == 1
+
+    settings = IdPMetadata(URL, cache_dir=str(tmp_path)).load()
+    assert len(server.requests) == 1
+    assert settings['saml_endpoint'] == 'https://idp.example.test/sso'
+
+
+def test_a_stale_url_cache_is_fetched_conditionally(server, tmp_path):
+
+    md = IdPMetadata(URL, cache_dir=str(tmp_path), refresh=60)
+    md.load()
+    _age_cache(md, 120)
+
+    settings = IdPMetadata(URL, cache_dir=str(tmp_path), refresh=60).load()
+    assert len(server.requests) == 2
+    assert server.requests[1]['If-none-match'] == '"v1"'
+    assert settings['saml_endpoint'] == 'https://idp.example.test/sso'
+
+    # the 304 renewed the cache
+    IdPMetadata(URL, cache_dir=str(tmp_path), refresh=60).load()
+    assert len(server.requests) == 2
+
+
+def test_a_stale_url_cache_is_used_if_the_fetch_fails(server, tmp_path):
+
+    md = IdPMetadata(URL, cache_dir=str(tmp_path), refresh=60)
+    md.load()
+    _age_cache(md, 120)
+    server.down = True
+
+    settings = IdPMetadata(URL, cache_dir=str(tmp_path), refresh=60).load()
+    assert len(server.requests) == 2
+    assert settings['saml_endpoint'] == 'https://idp.example.test/sso'
+
+
+def test_watch_threads_start_on_first_lookup_in_each_process(idp, tmp_path):
+
+    source = tmp_path / 'md.xml'
+    source.write_bytes(idp.metadata_xml())
+    registry = IdPRegistry.from_config(idp.saml_config(idp_metadata=str(source)))
+    md = registry.sources[0][0]
+
+    registry.watch()
+    assert md.thread is None
+
+    assert registry.default.issuer == idp.issuer
+    assert md.pid == os.getpid() and md.thread.is_alive()
+
+    pid = os.fork()
+    if pid == 0:
+        # a forked worker inherits no thread, and starts its own
+        ok = not md.thread.is_alive()
+        registry.get(idp.issuer)
+        os._exit(0 if ok and md.pid == os.getpid() and md.thread.is_alive() else 1)
+
+    assert os.waitpid(pid, 0)[1] == 0
+    md.stop()
+
+
+def _age_cache(md, seconds):
+
+    with open(md.cache_file) as f:
+        cached = json.load(f)
+    cached['fetched'] = time.time() - seconds
+    with open(md.cache_file, 'w') as f:
+        json.dump(cached, f)
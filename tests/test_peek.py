@@ -0,0 +1,56 @@
+import base64
+
+import pytest
+
+from BottleSaml.peek import PeekError, peek_response
+
+AUDIENCE = 'https://sp.example.test/'
+
+
+def b64(xml):
+    return base64.b64encode(xml).decode('ascii')
+
+
+def test_peek_finds_issuer_assertion_id_and_in_response_to(idp):
+
+    xml = idp.response_xml(AUDIENCE, in_response_to='id-123')
+    peek = peek_response(b64(xml))
+
+    assert peek.issuers == [idp.issuer, idp.issuer]
+    assert len(peek.assertion_ids) == 1
+    assert peek.assertion_ids[0].startswith('_')
+    assert peek.in_response_to == ['id-123', 'id-123']
+
+
+@pytest.mark.parametrize('decoy', [
+    b'xmlns:ID="urn:xN"',
+    b'foo:ID="urn:xN"',
+    b'XID="urn:xN"',
+    b'my-ID="urn:xN"',
+    b'x.ID="urn:xN"',
+])
+def test_peek_ignores_prefixed_and_longer_id_attributes(idp, decoy):
+
+    xml = idp.response_xml(AUDIENCE)
+    real = peek_response(b64(xml)).assertion_ids
+
+    mutated = xml.replace(b'<saml:Assertion ', b'<saml:Assertion ' + decoy + b' ', 1)
+    assert peek_response(b64(mutated)).assertion_ids == real
+
+
+def test_peek_resolves_character_references():
+
+    xml = (b'<samlp:Response xmlns:samlp="p"><saml:Issuer xmlns:saml="a">i</saml:Issuer>'
+           b'<saml:Assertion xmlns:saml="a" ID="_a&#x41;&amp;"/></samlp:Response>')
+    assert peek_response(b64(xml)).assertion_ids == ['_aA&']
+
+
+@pytest.mark.parametrize('data, reason', [
+    ('not base64!', 'malformed base64'),
+    (b64(b'<samlp:Response><saml:Assertion ID="_a"/></samlp:Response>'), 'no Issuer'),
+    (b64(b'<samlp:Response><saml:Issuer>i</saml:Issuer></samlp:Response>'), 'no Assertion'),
+])
+def test_peek_rejects_junk(data, reason):
+
+    with pytest.raises(PeekError, match=reason):
+        peek_response(data)
@@ -0,0 +1,103 @@
+import base64
+import os
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+from BottleSaml import MemoryReplayCache, SamlCore, SharedMemoryReplayCache, SqliteReplayCache
+from BottleSaml.log import QueueLog
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'shm'])
+def cache(request, tmp_path):
+
+    if request.param == 'memory':
+        yield MemoryReplayCache(ttl=60, max_entries=8)
+    elif request.param == 'sqlite':
+        yield SqliteReplayCache(str(tmp_path / 'replay.db'), ttl=60, max_entries=8)
+    else:
+        cache = SharedMemoryReplayCache(name=f'bsaml-test-{os.getpid()}', ttl=60, max_entries=8,
+                lockfile=str(tmp_path / 'replay.lock'))
+        yield cache
+        cache.unlink()
+
+
+def test_add_is_false_for_a_replay(cache):
+
+    assert cache.add('aid:one') is True
+    assert 'aid:one' in cache
+    assert cache.add('aid:one') is False
+    assert 'aid:two' not in cache
+
+
+def test_expired_keys_can_be_added_again(cache, monkeypatch):
+
+    assert cache.add('aid:one') is True
+    later = time.time() + 120
+    monkeypatch.setattr(time, 'time', lambda: later)
+    assert 'aid:one' not in cache
+    assert cache.add('aid:one') is True
+
+
+def test_a_longer_ttl_keeps_a_key_longer(cache, monkeypatch):
+
+    now = time.time()
+    assert cache.add('aid:long', ttl=3600) is True
+    assert cache.add('aid:short', ttl=10) is True
+
+    monkeypatch.setattr(time, 'time', lambda: now + 700)
+    assert 'aid:long' in cache and 'aid:short' not in cache
+    assert cache.add('aid:long') is False
+
+
+def test_memory_cache_is_bounded():
+
+    cache = MemoryReplayCache(ttl=60, max_entries=4)
+    for n in range(10):
+        cache.add(f'aid:{n}')
+    assert len(cache) == 4
+    assert 'aid:9' in cache and 'aid:0' not in cache
+
+
+def acs_body(xml, relay_state=''):
+    return urlencode({'SAMLResponse': base64.b64encode(xml).decode('ascii'),
+            'RelayState': relay_state}).encode()
+
+
+@pytest.fixture
+def core(idp):
+    # idp_ok True: IdP initiated responses - no request ID to fall back on
+    return SamlCore(idp.saml_config(idp_ok=True), log=QueueLog(level='error'))
+
+
+def test_acs_rejects_a_replayed_response(core, idp):
+
+    xml = idp.response_xml(core.saml_audience)
+    assert core.acs({}, acs_body(xml)).status == 302
+    assert core.acs({}, acs_body(xml)).status == 400
+
+
+@pytest.mark.parametrize('decoy', [
+    b'xmlns:ID="urn:xN"',
+    b'xmlns:ID="urn:xN" xmlns:xID="urn:xM"',
+])
+def test_acs_rejects_a_replay_with_a_decoy_id(core, idp, decoy):
+    """ Exclusive C14N drops unused namespace declarations: the signature still verifies """
+
+    xml = idp.response_xml(core.saml_audience)
+    assert core.acs({}, acs_body(xml)).status == 302
+
+    mutated = xml.replace(b'<saml:Assertion ', b'<saml:Assertion ' + decoy + b' ', 1)
+    assert core.acs({}, acs_body(mutated)).status == 400
+
+
+def test_acs_rejects_a_replay_while_the_assertion_is_valid(core, idp, monkeypatch):
+
+    xml = idp.response_xml(core.saml_audience, lifetime=3600)
+    assert core.acs({}, acs_body(xml)).status == 302
+
+    # past replay_ttl, but the assertion is still valid
+    later = time.time() + 700
+    monkeypatch.setattr(time, 'time', lambda: later)
+    assert core.acs({}, acs_body(xml)).status == 400
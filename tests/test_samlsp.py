@@ -0,0 +1,66 @@
+import base64
+from urllib.parse import urlencode
+
+import pytest
+from bottle import Bottle, request
+
+from benchmarks.bench_acs import StubSessions
+from BottleSaml import AttrStore, SamlSP
+from BottleSaml.log import QueueLog
+
+
+@pytest.fixture
+def saml(idp):
+
+    return SamlSP(Bottle(), StubSessions(), saml_config=idp.saml_config(), log=QueueLog(level='error'))
+
+
+def test_core_settings_are_set_through_the_plugin(saml):
+
+    saml.auth_duration = 5
+    saml.force_reauth = True
+    saml.idp_ok = False
+
+    assert saml.core.auth_duration == 5
+    assert saml.core.force_reauth is True
+    assert saml.core.idp_ok is False
+    assert 'auth_duration' not in vars(saml)
+
+
+def test_plugin_attributes_stay_on_the_plugin(saml):
+
+    saml.authn_all_routes = False
+    saml.extra = 1
+
+    assert vars(saml)['authn_all_routes'] is False
+    assert saml.extra == 1 and not hasattr(saml.core, 'extra')
+
+
+def test_default_idp_settings_are_read_only(saml):
+
+    with pytest.raises(AttributeError):
+        saml.saml_endpoint = 'https://elsewhere.example.test/'
+
+
+def test_stored_attributes_are_resolved_once_per_request(idp):
+
+    store = AttrStore(threshold=64)
+    saml = SamlSP(Bottle(), StubSessions(), saml_config=idp.saml_config(idp_ok=True, assertions=['groups']),
+            log=QueueLog(level='error'), attr_store=store)
+
+    groups = [f'urn:example:groups:{n:04d}' for n in range(20)]
+    xml = idp.response_xml(saml.saml_audience, attributes={'groups': groups})
+    session = {}
+    body = urlencode({'SAMLResponse': base64.b64encode(xml).decode('ascii'), 'RelayState': ''})
+    assert saml.core.acs(session, body.encode()).status == 302
+
+    gets = []
+    get = store.get
+    store.get = lambda digest: gets.append(digest) or get(digest)
+
+    request.bind({})
+    request.session = session
+    assert saml.is_authenticated
+    assert saml.my_attrs['groups'] == groups
+    assert saml.is_authenticated and saml.my_attrs['groups'] == groups
+    assert len(gets) == 1
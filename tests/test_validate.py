@@ -0,0 +1,37 @@
+import base64
+import multiprocessing
+import time
+
+import pytest
+
+from BottleSaml.idp import IdP
+from BottleSaml.validate import ProcessValidator, ValidationFailed, verify_response
+
+
+@pytest.fixture(scope='module')
+def validator():
+
+    validator = ProcessValidator(1)
+    yield validator
+    validator.close()
+
+
+def test_workers_are_not_forked(validator):
+
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        assert validator.context.get_start_method() == 'forkserver'
+    else:
+        assert validator.context.get_start_method() == 'spawn'
+
+
+def test_a_worker_verifies_as_verify_response(validator, idp):
+
+    trusted = IdP(idp.saml_config())
+    data = base64.b64encode(idp.response_xml(trusted.audience))
+
+    verified = validator.validate(data, trusted)
+    assert verified == verify_response(data, trusted.certificate, trusted.audience)
+    assert verified[2] > time.time() + 200
+
+    with pytest.raises(ValidationFailed):
+        validator.validate(data[:-8] + b'AAAAAAA=', trusted)